@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+import importlib
+import os
+import sys
+
+# the scripts import each other by module name
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import click
+import warm_worker
+
+# Single entry point for the pipeline scripts. The subcommands are the click
+# commands of the individual scripts; a script (and with it astropy,
+# matplotlib, scipy, ...) is only imported when its subcommand is run, so
+# 'alfosc.py --help' and light commands start quickly.
+
+
+COMMANDS = {
+    'prepare':   ('prepare_dataset', 'Unpack the raw archive of a night and write the inventory'),
+    'trim':      ('trim_image', 'Trim raw frames into a separate tree'),
+    'headers':   ('header_index', 'Build the header index of a night'),
+    'datasets':  ('create_datasets', 'Create the PypeIt datasets of one or more nights'),
+    'run':       ('run_datasets', 'Reduce all datasets of a night'),
+    'watch':     ('watch_night', 'Create and reduce datasets while the night is observed'),
+    'store':     ('calib_store', 'List or evict calibrations in the calibration store'),
+    'history':   ('runtime_history', 'Show the runtime history and predicted costs of reductions'),
+    'sensfunc':  ('create_sensfunc', 'Build the sensitivity functions of a night'),
+    'sweep':     ('sweep_sensfunc', 'Grid search over sensfunc parameters'),
+    'sens':      ('sens_index', 'List the indexed sensitivity functions'),
+    'fluxcal':   ('apply_fluxcal', 'Flux calibrate spec1d files'),
+    'catalog':   ('spec1d_catalog', 'List the traces of spec1d files'),
+    'combine':   ('combine_spectra', 'Coadd the spectra of one target'),
+    'coadd':     ('coadd_night', 'Coadd all multi-exposure targets of a night'),
+    'convert':   ('convert_spec1d', 'Convert spectra to ASCII'),
+    'plot':      ('plot_snr', 'Plot the SNR of a spectrum'),
+    'plot-sens': ('plot_sens', 'Plot a sensitivity function'),
+    'qa':        ('qa_night', 'Render the QA figures of a night'),
+    'metrics':   ('metrics', 'Summarize the recorded stage metrics'),
+    'benchmark': ('benchmark', 'Benchmark the pipeline on synthetic nights'),
+    'worker':    ('warm_worker', 'Start, stop or query the warm worker'),
+}
+
+
+class LazyGroup(click.Group):
+
+    def list_commands(self, ctx):
+        return list(COMMANDS)
+
+    def get_command(self, ctx, name):
+        if name not in COMMANDS:
+            return None
+        import metrics
+        metrics.SCRIPT = COMMANDS[name][0] + '.py'
+        return importlib.import_module(COMMANDS[name][0]).main
+
+    def format_commands(self, ctx, formatter):
+        # the help text is listed without importing the scripts
+        with formatter.section('Commands'):
+            formatter.write_dl([(name, help) for name, (_, help) in COMMANDS.items()])
+
+
+@click.group(cls=LazyGroup)
+def main():
+    """NOT/ALFOSC data reduction pipeline."""
+
+
+if __name__ == '__main__':
+    # commands are run by the warm worker of this directory, if one is running
+    if len(sys.argv) > 1:
+        returncode = warm_worker.forward(sys.argv[1], sys.argv[2:])
+        if returncode is not None:
+            sys.exit(returncode)
+    main()
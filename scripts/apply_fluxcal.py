@@ -1,60 +1,100 @@
 #!/usr/bin/env python
-import glob
-import subprocess
+import concurrent.futures
 import click
-import astropy.io.fits as fits
 import os
-import numpy as np
+import metrics
+import warm_worker
+from   fits_headers import read_headers
+from   job_runner import Job, JobRunner
+from   misc import make_workdir
+from   sens_index import get_sens_index
 
 
-def load_sens_lib():
-    files = glob.glob('sens/*.fits')
+def write_fluxcal_par(fname, entries):
+    with open(fname, 'w') as f:
+        f.write('[fluxcalib]\n')
+        f.write('extinct_correct=True\n')
+        f.write('extrap_sens=False\n')
+        f.write('flux read\n')
+        f.write('\tfilename | sensfile\n')
+        for entry in entries:
+            f.write('\t%s | %s\n' % entry)
+        f.write('flux end\n')
+
+
+def fluxcal_job(entries):
+    workdir = make_workdir('fluxcal')
+    fname = os.path.join(workdir, 'fluxcal.para')
+    write_fluxcal_par(fname, entries)
+    print(' * generated %s' % fname)
+    print('   Run this command to fluxcal:')
+    print('\t(pipenv run) pypeit_flux_calib %s' % fname)
+    return Job(['pypeit_flux_calib', fname], 'pypeit_flux_calib', fname, os.path.join(workdir, 'fluxcal.log'),
+               metrics.night_of(*[x[0] for x in entries]))
+
+
+def native_fluxcal(entries, extinction_file):
+    # no parameter file and no pypeit_flux_calib session; sens curves are cached per process
+    import flux_calib
+    failed = 0
+    with metrics.span('native_fluxcal', metrics.night_of(*[x[0] for x in entries]), n_spectra=len(entries)):
+        for fname, sensfile in entries:
+            try:
+                flux_calib.flux_calibrate(fname, sensfile, extinction_file)
+            except Exception as e:
+                # beyond the sensfunc, EXPTIME or AIRMASS missing, unreadable file, ...: the other spectra go on
+                print(' * ERR: cannot flux calibrate %s: %s' % (fname, e))
+                failed += 1
+                continue
+            print(' * %s -> %s' % (sensfile, fname))
+    return failed
 
-    # extract mjd
-    entries = {}
-    for f in files:
-        # TODO: ignore files that break this instead of crashing here
-        mjd = int(float(os.path.basename(f).replace('.fits', ''))*10000)
-        entries[mjd] = f
-    return entries
 
 @click.command()
 @click.argument('frames', nargs=-1)
-def main(frames):
-    # load known sensfuncs {mjd -> fname}
-    sensfuncs = load_sens_lib()
-    sensfuncs_mjds = np.array(list(sensfuncs.keys()))
-    
-    entries = []
-    for fname in frames:
-        hdr = fits.getheader(fname)
-        mjd = int(hdr['MJD']*10000)
-        best_mjd = sensfuncs_mjds[np.argmin(np.abs(mjd - sensfuncs_mjds))]
-        sensfile = sensfuncs[best_mjd]
-        entries.append((fname, sensfile))
-    ctr = 0
-    while True:
-        fname = 'fluxcal.%d.para' % ctr
-        if os.path.isfile(fname):
-            ctr += 1
-            continue
-        with open(fname, 'w') as f:
-            f.write('[fluxcalib]\n')
-            f.write('extinct_correct=True\n')
-            f.write('extrap_sens=False\n')
-            f.write('flux read\n')
-            f.write('\tfilename | sensfile\n')
-            for entry in entries:
-                f.write('\t%s | %s\n' % entry)
-            f.write('flux end\n')
-        print('\n\ngenerated %s' % fname)
-        print('Run this command to fluxcal:')
-        print('\t(pipenv run) pypeit_flux_calib %s' % fname)
-        print('\n\n\n')
-        os.system('pypeit_flux_calib %s' % fname)
-
-        break
+@click.option('--match-slit', is_flag=True, help="Only use sensitivity functions taken with the same slit")
+@click.option('--jobs', type=click.IntRange(min=1), default=1, help="Number of parallel flux calibration jobs")
+@click.option('--native', is_flag=True, help="Flux calibrate in-process instead of calling pypeit_flux_calib")
+@click.option('--extinction', default=None, help="Extinction curve (wavelength, mag/airmass). Default: PypeIt's curve for the observatory")
+@click.option('--timeout', type=float, default=1800, help="Stop pypeit_flux_calib after this many seconds")
+@click.option('--allow-any-grism', is_flag=True, help="Use the sensitivity function of another grism if there is none for the grism of a frame")
+def main(frames, match_slit, jobs, native, extinction, timeout, allow_any_grism):
+    # find the sensfunc closest in time with the same grism for all frames at once
+    day = metrics.night_of(*frames)
+    with metrics.span('sens_match', day, n_spectra=len(frames)):
+        sensfuncs = get_sens_index()
+        hdrs = read_headers(frames, ['MJD', 'DISPNAME', 'DECKER'])
+        missing = [fname for fname, hdr in zip(frames, hdrs) if hdr.get('MJD') is None]
+        if missing:
+            raise click.ClickException('No MJD in the header of %s' % ', '.join(missing))
+        try:
+            sensfiles = sensfuncs.match([hdr['MJD'] for hdr in hdrs], [hdr.get('DISPNAME') for hdr in hdrs],
+                                        [hdr.get('DECKER') for hdr in hdrs] if match_slit else None, allow_any_grism)
+        except ValueError as e:
+            raise click.ClickException('%s. Use --allow-any-grism to flux with another grism' % e)
+    entries = list(zip(frames, sensfiles))
+
+    if native:
+        # contiguous batches sorted by sensfile, so each worker loads as few sens curves as possible
+        entries = sorted(entries, key=lambda x: x[1])
+        if warm_worker.in_process(jobs):
+            # the sens curves cached in this process (e.g. the warm worker) are reused
+            returncodes = [native_fluxcal(entries, extinction)]
+        else:
+            chunks = [entries[i*len(entries)//jobs:(i+1)*len(entries)//jobs] for i in range(jobs)]
+            chunks = [x for x in chunks if x]
+            with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as pool:
+                returncodes = list(pool.map(native_fluxcal, chunks, [extinction]*len(chunks)))
+    else:
+        # one batch of spectra per job, each with its own working directory
+        chunks = [entries[i::jobs] for i in range(jobs) if entries[i::jobs]]
+        results = JobRunner(jobs, timeout).run_all([fluxcal_job(chunk) for chunk in chunks])
+        returncodes = [result.returncode for result in results]
 
+    if native and any(returncodes):
+        raise click.ClickException('Flux calibration failed for %d of %d spectra' % (sum(returncodes), len(entries)))
+    if any(returncodes):
+        raise click.ClickException('pypeit_flux_calib failed for %d of %d batches' % (sum(x != 0 for x in returncodes), len(chunks)))
 
 
 if __name__ == '__main__':
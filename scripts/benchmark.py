@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+import click
+import datetime
+import glob
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import astropy.table as table
+import numpy as np
+
+import synthetic_night
+
+# Benchmark of the pipeline stages on synthetic nights. A working directory
+# with raw nights of the requested size is generated, the PypeIt tools are
+# replaced by the stubs of synthetic_night.py, and every stage is run as a
+# separate process, exactly as from the command line. The wall clock time of
+# each stage is appended to a JSON lines file together with the version of
+# the scripts, so runs of different versions can be compared.
+
+RESULTS_FILE = 'benchmark_results.jsonl'
+SCALES = [100, 1000, 10000]
+
+def script(name):
+    return [sys.executable, os.path.join(synthetic_night.SCRIPTS_DIR, name)]
+
+
+def version():
+    try:
+        return subprocess.run(['git', 'describe', '--always', '--dirty'], cwd=synthetic_night.SCRIPTS_DIR,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def science_spectra():
+    return sorted(f for f in glob.glob('sci/*/spec1d*.fits') if '-STD-' not in f)
+
+
+def convert_pairs():
+    # the first exposure of every science dataset with its parameter file
+    pairs = []
+    for dataset in sorted(glob.glob('sci/*')):
+        spectra = sorted(glob.glob(os.path.join(dataset, 'spec1d*.fits')))
+        if '-STD-' in dataset or not spectra:
+            continue
+        pairs += [spectra[0], os.path.join('datasets', os.path.basename(dataset) + '.pypeit')]
+    return pairs
+
+
+def stages(days, jobs):
+    """(name, function returning the commands of the stage); commands are built when the stage starts."""
+    first_target = lambda: sorted(glob.glob('sci/%s-ZTF*' % days[0]))[0]
+    return [
+        ('create_datasets', lambda: [script('create_datasets.py') + ['--start', days[0], '--end', days[-1], '--jobs', str(jobs)]]),
+        ('create_datasets_cached', lambda: [script('create_datasets.py') + ['--start', days[0], '--end', days[-1], '--jobs', str(jobs), '--overwrite']]),
+        ('run_datasets', lambda: [script('run_datasets.py') + [day, '--jobs', str(jobs)] for day in days]),
+        ('create_sensfunc', lambda: [script('create_sensfunc.py') + [day, '--jobs', str(jobs), '--no-debug'] for day in days]),
+        ('apply_fluxcal', lambda: [script('apply_fluxcal.py') + ['--jobs', str(jobs)] + science_spectra()]),
+        ('apply_fluxcal_native', lambda: [script('apply_fluxcal.py') + ['--native', '--jobs', str(jobs), '--extinction', 'etc/extinction.dat'] + science_spectra()]),
+        ('combine_spectra', lambda: [script('combine_spectra.py') + ['-o', 'combine.fits', '--overwrite'] + sorted(glob.glob(os.path.join(first_target(), 'spec1d*.fits')))]),
+        ('coadd_night', lambda: [script('coadd_night.py') + [day, '--jobs', str(jobs), '--overwrite'] for day in days]),
+        ('convert_spec1d', lambda: [script('convert_spec1d.py') + ['--jobs', str(jobs)] + convert_pairs()]),
+    ]
+
+
+def run_stage(commands, log):
+    start = time.perf_counter()
+    for cmd in commands:
+        log.write('$ %s\n' % ' '.join(cmd[:8] + (['...'] if len(cmd) > 8 else [])))
+        log.flush()
+        returncode = subprocess.run(cmd, stdout=log, stderr=subprocess.STDOUT).returncode
+        if returncode != 0:
+            return time.perf_counter() - start, returncode
+    return time.perf_counter() - start, 0
+
+
+def run_scale(n_frames, jobs, workdir, only, results):
+    root = os.path.join(workdir, 'scale_%d' % n_frames)
+    if os.path.isdir(root):
+        shutil.rmtree(root)
+
+    start = time.perf_counter()
+    days, total = synthetic_night.make_tree(root, n_frames)
+    print(' * %d frames, %d nights: generated in %.1f s' % (total, len(days), time.perf_counter() - start))
+
+    env_path = os.environ['PATH']
+    cwd = os.getcwd()
+    os.environ['PATH'] = os.path.join(root, 'bin') + os.pathsep + env_path
+    os.environ['MPLBACKEND'] = 'Agg'
+    os.chdir(root)
+    try:
+        with open('benchmark.log', 'w') as log:
+            for name, commands in stages(days, jobs):
+                if only and name not in only:
+                    continue
+                seconds, returncode = run_stage(commands(), log)
+                status = 'ok' if returncode == 0 else 'failed'
+                print('   * %-24s %8.2f s %s' % (name, seconds, '' if returncode == 0 else '(FAILED, see %s/benchmark.log)' % root))
+                results.append({'stage': name, 'scale': n_frames, 'frames': total, 'nights': len(days), 'jobs': jobs,
+                                'seconds': round(seconds, 3), 'status': status})
+    finally:
+        os.chdir(cwd)
+        os.environ['PATH'] = env_path
+
+
+@click.group()
+def main():
+    pass
+
+
+@main.command()
+@click.option('--scale', 'scales', type=int, multiple=True, help="Number of raw frames (default: %s)" % ', '.join(str(x) for x in SCALES))
+@click.option('--jobs', type=click.IntRange(min=1), default=4, help="--jobs passed to the stages")
+@click.option('--stage', 'only', multiple=True, help="Only run these stages (create_datasets also needs to run before the others)")
+@click.option('--workdir', default=None, help="Directory for the synthetic data (default: temporary)")
+@click.option('--keep', is_flag=True, help="Keep the synthetic data")
+@click.option('--results', 'results_file', default=RESULTS_FILE, help="JSON lines file the timings are appended to")
+def run(scales, jobs, only, workdir, keep, results_file):
+    """Generate synthetic nights and time every stage."""
+    workdir = os.path.abspath(workdir or tempfile.mkdtemp(prefix='alfosc_bench.'))
+    results_file = os.path.abspath(results_file)
+    run_info = {'version': version(), 'date': datetime.datetime.now().isoformat(timespec='seconds'),
+                'python': platform.python_version(), 'host': platform.node()}
+    print(' * Benchmarking version %s in %s' % (run_info['version'], workdir))
+
+    for n_frames in scales or SCALES:
+        results = []
+        run_scale(n_frames, jobs, workdir, only, results)
+        with open(results_file, 'a') as f:
+            for result in results:
+                f.write(json.dumps(dict(run_info, **result)) + '\n')
+    print(' * Results appended to %s' % results_file)
+
+    if not keep:
+        shutil.rmtree(workdir)
+
+
+@main.command()
+@click.option('--results', 'results_file', default=RESULTS_FILE)
+@click.option('--scale', type=int, default=None, help="Only show this scale")
+def report(results_file, scale):
+    """Compare the timings of the benchmarked versions (median over runs)."""
+    with open(results_file) as f:
+        rows = [json.loads(line) for line in f if line.strip()]
+    rows = [x for x in rows if x['status'] == 'ok' and (scale is None or x['scale'] == scale)]
+    if not rows:
+        raise click.ClickException('No results in %s' % results_file)
+
+    # one column per version, in the order they were first benchmarked
+    versions = list(dict.fromkeys(x['version'] for x in rows))
+    keys = list(dict.fromkeys((x['scale'], x['stage']) for x in rows))
+    report = table.Table(rows=[key for key in keys], names=['scale', 'stage'], dtype=[int, str])
+    for v in versions:
+        report[v] = [np.median([x['seconds'] for x in rows if x['version'] == v and (x['scale'], x['stage']) == key] or [np.nan]) for key in keys]
+        report[v].format = '.2f'
+    if len(versions) > 1:
+        report['change'] = ['%+.0f%%' % (100*(b/a - 1)) if a > 0 else '' for a, b in zip(report[versions[-2]], report[versions[-1]])]
+    report.pprint(max_lines=-1, max_width=-1)
+
+
+if __name__ == '__main__':
+    main()
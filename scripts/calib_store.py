@@ -0,0 +1,252 @@
+#!/usr/bin/env python
+import click
+import contextlib
+import fcntl
+import glob
+import hashlib
+import json
+import os
+import shutil
+import time
+
+# Content-addressed store for calibration products. The directory of a
+# calibration set is named after a hash of its input frames and the setup
+# keywords, so datasets with the same calibration frames find and reuse
+# products that were already built. A '.complete' marker is written once
+# the calibrations were processed successfully; its mtime records the last
+# use and drives the eviction. Reductions hold a shared lock on '.in_use'
+# while they work with a calibration set; eviction skips sets that are
+# locked.
+#
+# A calibration set is shared between datasets whose calibration frames
+# (biases, flats and arcs) all agree, as PypeIt reads all products of a
+# reduction from its single calib_dir. The master bias and the flats are
+# shared more widely: they are stored as components of their own, keyed on
+# the bias frames, DETWIN1 and binning and on the flat frames, grism, slit,
+# DETWIN1 and binning. A component is built by the first calibration set
+# that needs it and published into the store; other sets get its products
+# hard-linked into their calib_dir before 'run_pypeit -c', and PypeIt loads
+# them instead of building them again. All datasets use setup B and
+# calibration group 0, so the products have the same names in every set.
+
+CALIB_STORE = 'calibs/store'
+COMPLETE_MARKER = '.complete'
+IN_USE_LOCK = '.in_use'
+
+# products of the shared components, as named by PypeIt in a calib_dir
+COMPONENTS = {
+    'bias': ['Bias_*'],
+    'flat': ['Edges_*', 'Slits_*', 'Flat_*'],
+}
+
+def _key(payload):
+    return hashlib.sha1(json.dumps(payload, sort_keys=True).encode()).hexdigest()[:16]
+
+
+def calib_key(calib_frames, detwin1, grism, slit, binning):
+    # calib_frames: (filename, frametype) of all non-science frames
+    return _key({
+        'frames': sorted([str(f), str(t)] for f, t in calib_frames),
+        'detwin1': str(detwin1),
+        'grism': str(grism),
+        'slit': str(slit),
+        'binning': str(binning),
+    })
+
+
+def bias_key(bias_frames, detwin1, binning):
+    return _key({'bias': sorted(str(f) for f in bias_frames), 'detwin1': str(detwin1), 'binning': str(binning)})
+
+
+def flat_key(flat_frames, grism, slit, detwin1, binning):
+    return _key({'flat': sorted(str(f) for f in flat_frames), 'grism': str(grism), 'slit': str(slit),
+                 'detwin1': str(detwin1), 'binning': str(binning)})
+
+
+def calib_dir(key):
+    return os.path.join(CALIB_STORE, key)
+
+
+def is_store_dir(path):
+    return os.path.dirname(os.path.normpath(path)) == os.path.normpath(CALIB_STORE)
+
+
+def is_complete(path):
+    return os.path.isfile(os.path.join(path, COMPLETE_MARKER))
+
+
+def mark_complete(path):
+    os.makedirs(path, exist_ok=True)
+    with open(os.path.join(path, COMPLETE_MARKER), 'w') as f:
+        f.write('%s\n' % time.strftime('%Y-%m-%dT%H:%M:%S'))
+
+
+def touch(path):
+    marker = os.path.join(path, COMPLETE_MARKER)
+    if os.path.isfile(marker):
+        os.utime(marker)
+
+
+@contextlib.contextmanager
+def in_use(path):
+    """Keep the calibration set from being evicted while the block runs."""
+    os.makedirs(path, exist_ok=True)
+    with open(os.path.join(path, IN_USE_LOCK), 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_SH)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+@contextlib.contextmanager
+def _exclusive(path):
+    # yields False if a reduction uses the calibration set
+    with open(os.path.join(path, IN_USE_LOCK), 'a') as f:
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def component_dir(kind, key):
+    return os.path.join(CALIB_STORE, '%s-%s' % (kind, key))
+
+
+def _link(src, dest):
+    try:
+        os.link(src, dest)
+    except OSError:
+        shutil.copy2(src, dest)
+
+
+def link_component(kind, key, path):
+    """Link the products of a built component into the calibration set path. False if it is not in the store."""
+    src = component_dir(kind, key)
+    if not is_complete(src):
+        return False
+    with in_use(src):
+        # not evicted in the meantime
+        if not is_complete(src):
+            return False
+        os.makedirs(path, exist_ok=True)
+        for fname in os.listdir(src):
+            dest = os.path.join(path, fname)
+            if fname not in (COMPLETE_MARKER, IN_USE_LOCK) and not os.path.exists(dest):
+                _link(os.path.join(src, fname), dest)
+        touch(src)
+    return True
+
+
+def publish_component(kind, key, path):
+    """Add the products of a component built in the calibration set path to the store."""
+    dest = component_dir(kind, key)
+    products = sorted(f for pattern in COMPONENTS[kind] for f in glob.glob(os.path.join(path, pattern)))
+    if is_complete(dest) or not products:
+        return
+    tmp_dir = '%s.%d' % (dest, os.getpid())
+    os.makedirs(tmp_dir, exist_ok=True)
+    for fname in products:
+        _link(fname, os.path.join(tmp_dir, os.path.basename(fname)))
+    mark_complete(tmp_dir)
+    try:
+        os.rename(tmp_dir, dest)
+    except OSError:
+        # published by another reduction meanwhile
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def dir_size(path):
+    total = 0
+    for root, dirs, files in os.walk(path):
+        for fname in files:
+            try:
+                total += os.lstat(os.path.join(root, fname)).st_size
+            except FileNotFoundError:
+                pass
+    return total
+
+
+def last_used(path):
+    marker = os.path.join(path, COMPLETE_MARKER)
+    return os.path.getmtime(marker if os.path.isfile(marker) else path)
+
+
+def list_entries():
+    if not os.path.isdir(CALIB_STORE):
+        return []
+    entries = []
+    for key in os.listdir(CALIB_STORE):
+        path = calib_dir(key)
+        if os.path.isdir(path):
+            entries.append({'key': key, 'path': path, 'size': dir_size(path),
+                            'last_used': last_used(path), 'complete': is_complete(path)})
+    return sorted(entries, key=lambda x: x['last_used'])
+
+
+def evict(max_bytes, dry_run=False):
+    # remove the least recently used calibration sets until the store fits into max_bytes
+    entries = list_entries()
+    total = sum(x['size'] for x in entries)
+    removed = []
+    for entry in entries:
+        if total <= max_bytes:
+            break
+        # the lock is held while removing, so no reduction starts to use the set meanwhile
+        with _exclusive(entry['path']) as free:
+            if not free:
+                print(' * %s is in use, not removed' % entry['path'])
+                continue
+            if not dry_run:
+                shutil.rmtree(entry['path'], ignore_errors=True)
+        total -= entry['size']
+        removed.append(entry)
+    return removed, total
+
+
+def parse_size(size):
+    units = {'K': 1024, 'M': 1024**2, 'G': 1024**3, 'T': 1024**4}
+    size = size.strip().upper().rstrip('B')
+    if size and size[-1] in units:
+        return int(float(size[:-1]) * units[size[-1]])
+    return int(size)
+
+
+def format_size(size):
+    for unit in ['B', 'K', 'M', 'G']:
+        if size < 1024:
+            return '%.1f%s' % (size, unit)
+        size /= 1024.
+    return '%.1fT' % size
+
+
+@click.group()
+def main():
+    pass
+
+
+@main.command('list')
+def list_cmd():
+    entries = list_entries()
+    for x in entries:
+        print('%s %8s %s %s' % (x['key'], format_size(x['size']), time.strftime('%Y-%m-%d %H:%M', time.localtime(x['last_used'])),
+                                'complete' if x['complete'] else 'incomplete'))
+    print(' * %d calibration sets, %s' % (len(entries), format_size(sum(x['size'] for x in entries))))
+
+
+@main.command('evict')
+@click.option('--max-size', required=True, help="Maximum size of the store, e.g. 500G")
+@click.option('--dry-run', is_flag=True, help="Only show what would be removed")
+def evict_cmd(max_size, dry_run):
+    removed, total = evict(parse_size(max_size), dry_run)
+    for x in removed:
+        print(' * Removing %s (%s)' % (x['path'], format_size(x['size'])))
+    print(' * Store size after eviction: %s' % format_size(total))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,150 @@
+import os
+
+import astropy.io.fits as fits
+import numpy as np
+
+# In-process coaddition of flux calibrated 1D spectra. The selected traces are
+# resampled onto a common linear wavelength grid with a flux conserving
+# resampler (differences of the cumulative integral of the spectrum at the
+# edges of the new pixels), then combined with inverse variance weights and
+# iterative sigma clipping. The output has the layout of the files written by
+# pypeit_coadd_1dspec (a SPECTRUM table with wave, flux, ivar and mask), so it
+# can be converted with convert_spec1d.py.
+
+SIGREJ = 3.
+MAXITER = 5
+
+def load_trace(fname, trace):
+    with fits.open(fname) as hdulist:
+        data = hdulist[trace].data
+        if 'OPT_FLAM' not in data.columns.names:
+            raise ValueError('%s[%s] is not flux calibrated' % (fname, trace))
+        wave = np.asarray(data['OPT_WAVE'], dtype=float)
+        flux = np.asarray(data['OPT_FLAM'], dtype=float)
+        ivar = np.asarray(data['OPT_FLAM_IVAR'], dtype=float)
+
+    good = wave > 1
+    order = np.argsort(wave[good], kind='stable')
+    return wave[good][order], flux[good][order], ivar[good][order]
+
+
+def pixel_edges(wave):
+    mid = 0.5*(wave[1:] + wave[:-1])
+    return np.concatenate([[wave[0] - (mid[0] - wave[0])], mid, [wave[-1] + (wave[-1] - mid[-1])]])
+
+
+def wave_grid(waves):
+    """Linear grid covering all spectra, sampled with the median dispersion of the inputs."""
+    dwave = np.median([np.median(np.diff(w)) for w in waves])
+    wmin = min(w[0] for w in waves)
+    wmax = max(w[-1] for w in waves)
+    return wmin + dwave*np.arange(int(np.floor((wmax - wmin)/dwave)) + 1)
+
+
+def resample(wave, flux, ivar, grid):
+    """Flux conserving resampling of one spectrum onto grid.
+
+    Returns the flux, the inverse variance and the fraction of every new pixel
+    that is covered by good input pixels.
+    """
+    edges = pixel_edges(wave)
+    width = np.diff(edges)
+    good = ivar > 0
+    var = np.zeros_like(ivar)
+    var[good] = 1/ivar[good]
+
+    new_edges = pixel_edges(grid)
+    new_width = np.diff(new_edges)
+
+    def rebin(density):
+        # integral of a piecewise constant density between the new edges
+        cum = np.concatenate([[0.], np.cumsum(density*width)])
+        return np.diff(np.interp(new_edges, edges, cum))
+
+    coverage = rebin(good.astype(float)) / new_width
+    covered = coverage > 0
+    new_flux = np.zeros_like(grid)
+    new_flux[covered] = rebin(np.where(good, flux, 0.))[covered] / (coverage*new_width)[covered]
+
+    # the variance of an average of n input pixels drops by n, but not below the input variance
+    n_pix = new_width / np.interp(grid, wave, width)
+    new_var = np.zeros_like(grid)
+    new_var[covered] = rebin(var)[covered] / (coverage*new_width)[covered] / np.maximum(n_pix[covered], 1)
+    new_ivar = np.zeros_like(grid)
+    valid = covered & (new_var > 0)
+    new_ivar[valid] = 1/new_var[valid]
+
+    return new_flux, new_ivar, coverage
+
+
+def combine(fluxes, ivars, sigrej=SIGREJ, maxiter=MAXITER):
+    """Inverse variance weighted mean of a stack of spectra with iterative sigma clipping.
+
+    Every input is compared with the weighted mean of the other inputs, so an
+    outlier does not pull the reference towards itself; per iteration only
+    the worst input of a pixel is rejected, and at least two inputs are kept.
+    """
+    fluxes = np.asarray(fluxes)
+    ivars = np.asarray(ivars)
+    use = ivars > 0
+    pixels = np.arange(fluxes.shape[1])
+
+    for _ in range(maxiter):
+        weights = np.where(use, ivars, 0.)
+        wsum = weights.sum(axis=0)
+        fsum = (weights*fluxes).sum(axis=0)
+
+        # mean and variance of the other inputs
+        wothers = wsum - weights
+        others = np.divide(fsum - weights*fluxes, wothers, out=np.zeros_like(fluxes), where=wothers > 0)
+        var = np.divide(1., ivars, out=np.zeros_like(ivars), where=use) + np.divide(1., wothers, out=np.zeros_like(ivars), where=wothers > 0)
+        chi = np.divide(np.abs(fluxes - others), np.sqrt(var), out=np.zeros_like(fluxes), where=use & (wothers > 0))
+
+        # with two inputs a single outlier cannot be identified
+        worst = np.argmax(chi, axis=0)
+        rejected = (chi[worst, pixels] > sigrej) & (use.sum(axis=0) >= 3)
+        if not np.any(rejected):
+            break
+        use[worst[rejected], pixels[rejected]] = False
+
+    weights = np.where(use, ivars, 0.)
+    wsum = weights.sum(axis=0)
+    mean = np.divide((weights*fluxes).sum(axis=0), wsum, out=np.zeros(fluxes.shape[1]), where=wsum > 0)
+    return mean, wsum, use.sum(axis=0)
+
+
+def coadd(spectra, traces, output, sigrej=SIGREJ):
+    """Coadd the given traces of the spec1d files and write the result to output."""
+    inputs = [load_trace(fname, trace) for fname, trace in zip(spectra, traces)]
+    grid = wave_grid([wave for wave, _, _ in inputs])
+
+    fluxes, ivars = [], []
+    for wave, flux, ivar in inputs:
+        new_flux, new_ivar, coverage = resample(wave, flux, ivar, grid)
+        # pixels at the edge of the input spectrum are not used
+        new_ivar[coverage < 0.5] = 0.
+        fluxes.append(new_flux)
+        ivars.append(new_ivar)
+
+    flux, ivar, nused = combine(fluxes, ivars, sigrej)
+    mask = ivar > 0
+    sigma = np.zeros_like(ivar)
+    sigma[mask] = 1/np.sqrt(ivar[mask])
+
+    hdr = fits.getheader(spectra[0], 0)
+    hdr['NSPEC'] = (len(spectra), 'Number of coadded spectra')
+    for ii, (fname, trace) in enumerate(zip(spectra, traces)):
+        hdr['SPEC%04d' % ii] = ('%s[%s]' % (os.path.basename(fname), trace))
+    hdr['COADDSIG'] = (sigrej, 'Sigma clipping threshold of the coadd')
+
+    cols = [fits.Column(name='wave', format='D', array=grid),
+            fits.Column(name='flux', format='D', array=flux),
+            fits.Column(name='ivar', format='D', array=ivar),
+            fits.Column(name='sigma', format='D', array=sigma),
+            fits.Column(name='mask', format='L', array=mask),
+            fits.Column(name='nused', format='J', array=nused)]
+
+    tmp_output = output + '.tmp'
+    fits.HDUList([fits.PrimaryHDU(header=hdr), fits.BinTableHDU.from_columns(cols, name='SPECTRUM')]).writeto(tmp_output, overwrite=True)
+    os.replace(tmp_output, output)
+    return output
@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+import click
+import concurrent.futures
+import glob
+import os
+
+import coadd
+import metrics
+import warm_worker
+from   spec1d_catalog import get_catalog
+
+# Coadd all targets of a night that were observed with more than one
+# exposure. Every dataset sci/<day>-<target> is coadded in-process into
+# sci/<day>-<target>/<day>-<target>_coadd.fits; the targets are distributed
+# over several processes.
+
+def find_targets(day):
+    targets = {}
+    for dataset in sorted(glob.glob('sci/%s-*' % day)):
+        if '-STD-' in dataset:
+            continue
+        spectra = sorted(glob.glob(os.path.join(dataset, 'spec1d*.fits')))
+        if len(spectra) > 1:
+            targets[os.path.join(dataset, '%s_coadd.fits' % os.path.basename(dataset))] = spectra
+    return targets
+
+
+def coadd_target(spectra, traces, output):
+    try:
+        with metrics.span('coadd', metrics.night_of(output), n_spectra=len(spectra)):
+            coadd.coadd(spectra, traces, output)
+    except Exception as e:
+        print(' * ERR: coadd of %s failed: %s' % (output, e))
+        return 1
+    print(' * %s' % output)
+    return 0
+
+
+@click.command()
+@click.argument('day')
+@click.option('--objid', default=None, help="Trace to coadd, default is the trace closest to pixel 250")
+@click.option('--jobs', type=click.IntRange(min=1), default=4, help="Number of targets coadded in parallel")
+@click.option('--overwrite', is_flag=True, help="Overwrite existing coadds")
+def main(day, objid, jobs, overwrite):
+    targets = find_targets(day)
+    if not overwrite:
+        targets = {output: spectra for output, spectra in targets.items() if not os.path.isfile(output)}
+    print(' * %d targets to coadd for %s' % (len(targets), day))
+
+    # the traces of all targets are selected with one catalog query
+    all_spectra = [fname for spectra in targets.values() for fname in spectra]
+    with metrics.span('select_traces', day, n_spectra=len(all_spectra)):
+        traces = dict(zip(all_spectra, get_catalog(spectra=all_spectra).select(all_spectra, objid)))
+
+    failed = []
+    tasks = {}
+    for output, spectra in targets.items():
+        if any(traces[fname] is None for fname in spectra):
+            print(' * ERR: no trace catalog for some spectra of %s' % output)
+            failed.append(output)
+            continue
+        tasks[output] = (spectra, [traces[fname] for fname in spectra], output)
+
+    if warm_worker.in_process(jobs):
+        failed += [output for output, args in tasks.items() if coadd_target(*args) != 0]
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as pool:
+            futures = {output: pool.submit(coadd_target, *args) for output, args in tasks.items()}
+            failed += [output for output, future in futures.items() if future.result() != 0]
+
+    if failed:
+        raise click.ClickException('%d coadds failed: %s' % (len(failed), ', '.join(failed)))
+
+if __name__ == '__main__':
+    main()
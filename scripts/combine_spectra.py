@@ -1,18 +1,23 @@
 #!/usr/bin/env python
-import subprocess
 import click
 import numpy as np
 import os
-import astropy.table as table
+import coadd
+import metrics
+from   job_runner import Job, JobRunner
+from   misc import make_workdir
+from   spec1d_catalog import get_catalog
 
 
 @click.command()
 @click.option('-o', '--output', required = True)
 @click.option(      '--objid', default=None)
 @click.option('--overwrite', is_flag=True, help="Overwrite configuration file")
+@click.option('--native', is_flag=True, help="Coadd in-process instead of calling pypeit_coadd_1dspec")
+@click.option('--timeout', type=float, default=1800, help="Stop pypeit_coadd_1dspec after this many seconds")
 @click.argument('spectra', nargs=-1)
 
-def main(spectra, output, objid, overwrite):
+def main(spectra, output, objid, overwrite, native, timeout):
     if len(spectra) < 2:
         raise ValueError('Need at least two input spectra!')
 
@@ -22,43 +27,37 @@ def main(spectra, output, objid, overwrite):
         else:
             print('Destination file already exists, but will be overwritten.')
     
-    # find the objid for each input spectrum
-    objids = []
+    day = metrics.night_of(*spectra)
 
-    for fname in spectra:
+    # select the trace of each input spectrum from the spec1d catalog
+    with metrics.span('select_traces', day, n_spectra=len(spectra)):
+        catalog = get_catalog(spectra=spectra)
+    cat = catalog.table(list(spectra))
+    print(cat)
 
-        _objid = objid
+    if objid is None and np.any(np.unique(cat['spec1d'], return_counts=True)[1] > 1):
+        msg = 'Pypeit extracted multiple spectra. We assume that you want to have the trace closest to y=250 px.capitalize().\n Use the keyword \'--objid\' if this is not your preferred choice.'
+        print(msg)
 
-        fname_txt = fname.replace('.fits', '.txt')
-        cat = table.Table.read(fname_txt, format='ascii.fixed_width')
+    try:
+        objids = catalog.select(list(spectra), objid)
+    except KeyError as e:
+        raise ValueError(e.args[0])
 
-        cat['objid'] = np.linspace(0, len(cat)-1, len(cat), dtype=int)
-        print(cat[['objid', 'slit', 'name', 'spat_pixpos', 'spat_fracpos', 'box_width', 'opt_fwhm', 's2n']])
+    for fname, name in zip(spectra, objids):
+        if name is None:
+            raise ValueError('No trace catalog found for %s' % fname)
 
-        if len(cat) > 1 and objid is None:
-            # If there is more than 1 
-            # We select the center pixel (closest to 250)
-            pixpos = cat['spat_pixpos']
-            idx_pixpos_middle = np.argmin([np.abs(p-250) for p in pixpos])
-            _objid = idx_pixpos_middle
+    if native:
+        with metrics.span('coadd', day, n_spectra=len(spectra)):
+            coadd.coadd(spectra, objids, output)
+        print(' * Coadded %d spectra into %s' % (len(spectra), output))
+        return
 
-            msg = 'Pypeit extracted multiple spectra. We assume that you want to have the trace closest to y=250 px.capitalize().\n Use the keyword \'--objid\' if this is not your preferred choice.'
-            print(msg)
-        
-
-        elif len(cat) == 1:
-            _objid = 0
-
-        try:
-            objids.append(cat['name'][int(_objid)])
-
-        except ValueError:
-            if _objid not in cat['name']:
-                raise ValueError('objid %s not found in catalog %s' % (_objid, fname_txt))
-            objids.append(_objid)
-        
-
-    with open('combine.par', 'w') as f:
+    # private working directory, so several coadds can run in the same directory
+    workdir = make_workdir('coadd')
+    par_file = os.path.join(workdir, 'combine.par')
+    with open(par_file, 'w') as f:
         f.write('[coadd1d]\n')
         f.write('coaddfile=%s\n' % output)
         f.write('\n')
@@ -68,7 +67,9 @@ def main(spectra, output, objid, overwrite):
             f.write('  %s | %s\n' % (spec, objid))
         f.write('coadd1d end\n')
     
-    subprocess.run(['pypeit_coadd_1dspec', 'combine.par'])
+    job = Job(['pypeit_coadd_1dspec', par_file], 'pypeit_coadd_1dspec', output, os.path.join(workdir, 'coadd.log'), day)
+    if not JobRunner(1, timeout).run_all([job])[0].ok:
+        raise click.ClickException('pypeit_coadd_1dspec failed for %s' % output)
 
 if __name__ == '__main__':
     main()
@@ -1,26 +1,29 @@
 #!/usr/bin/env python
 
-from   astropy import time
+from   astropy import table, time
+from   astropy.io import fits
 import click
+import glob
+import metrics
+import numpy as np
+import os
+import sys
+import warm_worker
+from   header_index import find_raw, get_header
 from   misc import bcolors
-from   plotsettings import *
-from   standard_libraries import *
+from   pypeit_files import read_pypeit
+from   spec1d_catalog import get_catalog
 
 def create_header(param_file, obs_name, red_name):
 
     # Convert the Pypeit parameter file into a table and only keep the science files.
 
-    data_pypeit       = open(param_file, mode='r')
-    table_pypeit      = []
+    # The parsed parameter file is memoized, batch conversions of one dataset parse it once
+    params, rows_pypeit     = read_pypeit(param_file)
+    scidir                  = params['scidir']
 
-    for line in data_pypeit.readlines():
-        if line[0] == '|':
-            table_pypeit.append(line.replace(' ', '').split('|')[1:-1])
-        
-        elif 'scidir' in line:
-            scidir = line.split('=')[-1].split(' ')[-1][:-1]
-
-    table_pypeit            = table.Table(np.array(table_pypeit)[1:], names=np.array(table_pypeit)[0])
+    # spaces are removed from all cells, e.g. target names with blanks (the memoized rows are not modified)
+    table_pypeit            = table.Table(rows=[{key: value.replace(' ', '') for key, value in row.items()} for row in rows_pypeit])
     table_pypeit            = table_pypeit[table_pypeit['frametype'] == 'science']
     table_pypeit['mjd']     = [float(x) for x in table_pypeit['mjd']]
     table_pypeit['exptime'] = [float(x) for x in table_pypeit['exptime']]
@@ -49,13 +52,13 @@ def create_header(param_file, obs_name, red_name):
 
     # Prepare header
 
-    # Original header
-    header_orig = fits.open(glob.glob('raw/*/{}'.format(table_pypeit['filename'][0]))[0])[0].header
+    # Original header (from the header index, the raw frame is not opened)
+    header_orig = get_header(find_raw(table_pypeit['filename'][0]))
     
     # Header after the data reduction
-    hdulist_pypeit            = fits.open(sci_files[0])
-    header_pypeit             = hdulist_pypeit[0].header
-    header_pypeit_2           = hdulist_pypeit[1].header
+    with fits.open(sci_files[0]) as hdulist_pypeit:
+        header_pypeit         = hdulist_pypeit[0].header
+        header_pypeit_2       = hdulist_pypeit[1].header
     reduction_history         = header_pypeit['HISTORY']
 
     # Build the header
@@ -122,107 +125,170 @@ def create_header(param_file, obs_name, red_name):
     return comments
     
 
-@click.command()
-@click.argument('fname', nargs=1, required=True)
-@click.argument('param_file', nargs=1, required=True)
-@click.option('--objid', default=None)
-@click.option('--obs-name', default='Steve Schulze')
-@click.option('--red-name', default='Steve Schulze')
-@click.option('--wlen-min', type=float, default=4000)
+def select_traces(spectra, objid):
+    """Name of the trace to export for each spectrum, None for co-added spectra."""
+    catalog = get_catalog(spectra=spectra)
+    cat = catalog.table(list(spectra))
+    if len(cat):
+        print(cat)
 
-def main(fname, param_file, wlen_min, obs_name, red_name, objid):
+    if objid is None and np.any(np.unique(cat['spec1d'], return_counts=True)[1] > 1):
+        msg = 'Pypeit extracted multiple spectra. We assume that you want to have the trace closest to y=250 px.capitalize().\n Use the keyword \'--objid\' if this is not your preferred choice.'
+        print(msg)
 
     try:
+        return catalog.select(list(spectra), objid)
+    except KeyError:
+        # unknown objid: read the first extension, as for co-added spectra
+        return [None]*len(spectra)
+
+
+def read_spectrum(fname, trace):
+
+    if trace is not None:
         # If an object has only 1 exposure (i.e., you didn't use combine_spectra.py)
+        data              = table.Table.read(fname, hdu=trace) 
 
-        _objid = objid
+    else:
+        # If an object has more than 1 exposure (i.e., you used combine_spectra.py)
+        data              = table.Table.read(fname, hdu=1) 
 
-        fname_txt = fname.replace('.fits', '.txt')
-        cat = table.Table.read(fname_txt, format='ascii.fixed_width')
+    return data
 
-        cat['objid'] = np.linspace(0, len(cat)-1, len(cat), dtype=int)
-        print(cat[['objid', 'slit', 'name', 'spat_pixpos', 'spat_fracpos', 'box_width', 'opt_fwhm', 's2n']])
 
-        if len(cat) > 1 and objid is None:
-            # If there is more than 1 
-            # We select the center pixel (closest to 250)
-            pixpos = cat['spat_pixpos']
-            idx_pixpos_middle = np.argmin([np.abs(p-250) for p in pixpos])
-            _objid = idx_pixpos_middle
+def format_rows(*columns):
+    # Format every row once; str() of the values, as the astropy no_header writer does
+    rows = columns[0].astype(str)
+    for col in columns[1:]:
+        rows = np.char.add(np.char.add(rows, ' '), col.astype(str))
+    return rows
 
-            msg = 'Pypeit extracted multiple spectra. We assume that you want to have the trace closest to y=250 px.capitalize().\n Use the keyword \'--objid\' if this is not your preferred choice.'
-            print(msg)
 
-        else:
-            _objid = objid
+def export_spectrum(fname, param_file, wlen_min, obs_name, red_name, trace, show=True):
 
-        data              = table.Table.read(fname, hdu=cat['name'][int(_objid)]) 
+    day               = metrics.night_of(fname)
 
-    except:
-        # If an object has more than 1 exposure (i.e., you used combine_spectra.py)
-        data              = table.Table.read(fname, hdu=1) 
+    with metrics.span('read_spectrum', day):
+        data          = read_spectrum(fname, trace)
 
     # Header
-    header            = create_header(param_file, obs_name, red_name)
-
-    # Create output files
+    with metrics.span('create_header', day):
+        header        = create_header(param_file, obs_name, red_name)
+    comments          = ['# ' + key + ': ' + str(header[key]) for key in list(header.keys())] + ['# COLUMNS: WAVE FLUX FLUX_ERR']
 
-    waves = [3000, 3250, 3500, 3850, wlen_min]
+    # Select right column labels for wavelength, flux and error 
+    # PypeIt changes column names if 1D spectra were co-added
 
-    for x in waves:
+    wave_column = 'OPT_WAVE'      if 'OPT_WAVE'      in data.keys() else 'wave'
+    flux_column = 'OPT_FLAM'      if 'OPT_FLAM'      in data.keys() else 'flux'
+    ivar_column = 'OPT_FLAM_IVAR' if 'OPT_FLAM_IVAR' in data.keys() else 'ivar'
 
-        # Read data
+    missing     = [x for x in (wave_column, flux_column, ivar_column) if x not in data.keys()]
+    if missing:
+        raise click.ClickException('%s has no fluxed spectrum (missing columns: %s), run apply_fluxcal.py first'
+                                   % (fname, ', '.join(missing)))
 
+    # Sort once, then every cut-off is a slice of the same rows
 
-        # Select right column labels for wavelength, flux and error 
-        # PypeIt changes column names if 1D spectra were co-added
+    order       = np.argsort(np.asarray(data[wave_column]), kind='stable')
+    wave        = np.asarray(data[wave_column])[order]
+    flux        = np.asarray(data[flux_column])[order]
+    ivar        = np.asarray(data[ivar_column], dtype=float)[order]
 
-        wave_column = 'OPT_WAVE'      if 'OPT_WAVE'      in data.keys() else 'wave'
-        flux_column = 'OPT_FLAM'      if 'OPT_FLAM'      in data.keys() else 'flux'
-        err_column  = 'OPT_FLAM_IVAR' if 'OPT_FLAM_IVAR' in data.keys() else 'ivar'
+    # FLUX_ERR is the 1 sigma error; pixels without a valid inverse variance get 0
+    err         = np.sqrt(np.divide(1., ivar, out=np.zeros_like(ivar), where=ivar > 0))
+    rows        = format_rows(wave, flux, err)
 
-        try:
-            data.sort('OPT_WAVE')
-        except:
-            data.sort('wave')
+    # Create output files
 
-        # Post-process
+    waves = [3000, 3250, 3500, 3850, wlen_min]
 
-        # Get the data with lambda >= lambda_cut
-        mask_good   = data[wave_column] >= x
+    with metrics.span('write_ascii', day):
+        for x in waves:
 
-        # Convert inverse variance to 1-sigma error
-        data['err'] = pow(data[err_column], -0.5)
-        
-        t = table.Table([data[wave_column][mask_good], data[flux_column][mask_good], data[err_column][mask_good]], names=('wave', 'flux', 'err'))
-        t.meta['comments']  = list([key + ': ' +  str(header[key]) for key in list(header.keys())]) + ['COLUMNS: WAVE FLUX FLUX_ERR']
+            # Get the data with lambda >= lambda_cut
+            start     = np.searchsorted(wave, x, side='left')
 
-        new_fname = os.path.basename(fname).replace('.fits', '_' + str(int(x)) + '.ascii')
-        t.write(new_fname, format='ascii.no_header', overwrite=True)
+            new_fname = os.path.basename(fname).replace('.fits', '_' + str(int(x)) + '.ascii')
+            with open(new_fname, 'w') as f:
+                f.write('\n'.join(comments) + '\n')
+                if start < len(rows):
+                    f.write('\n'.join(rows[start:]) + '\n')
 
-    # Diagnostic plot
+    # Diagnostic plot (matplotlib is only loaded here)
 
-    plt.figure(figsize=(9*np.sqrt(2), 9))
-    ax = plt.subplot(111)
+    with metrics.span('plot', day):
+        from plotsettings import plt
+        plt.figure(figsize=(9*np.sqrt(2), 9))
+        ax = plt.subplot(111)
 
-    ax.errorbar(data[wave_column], data[flux_column], color='tab:blue', lw=1)
+        ax.errorbar(wave, flux, color='tab:blue', lw=1)
 
-    idx = data[wave_column] > 4000
+        idx = wave > 4000
 
-    ax.set_xlim(2950, 10000)
-    ax.set_ylim(0, max(data[flux_column][idx])*1.05)
+        ax.set_xlim(2950, 10000)
+        ax.set_ylim(0, max(flux[idx])*1.05)
 
-    ax.set_xlabel('Wavelength $\\left({\\rm vacuum,\\,\\AA}\\right)$')
-    ax.set_ylabel('$F_\\lambda \\left(10^{-17}\\,{\\rm erg\\,cm}^{-2}\\,{\\rm s}^{-1}\\,{\\rm \\AA}^{-1}\\right)$ ')
+        ax.set_xlabel('Wavelength $\\left({\\rm vacuum,\\,\\AA}\\right)$')
+        ax.set_ylabel('$F_\\lambda \\left(10^{-17}\\,{\\rm erg\\,cm}^{-2}\\,{\\rm s}^{-1}\\,{\\rm \\AA}^{-1}\\right)$ ')
 
     
-    for idx, wave in enumerate(waves):
-        ax.axvline(wave, lw=2 + idx, color='k', zorder=999)
+        for idx, wave_cut in enumerate(waves):
+            ax.axvline(wave_cut, lw=2 + idx, color='k', zorder=999)
 
-    plt.savefig(new_fname.replace('ascii', 'pdf').replace('_' + str(int(wlen_min)), ''))
-    plt.show()
+        plt.savefig(new_fname.replace('ascii', 'pdf').replace('_' + str(int(wlen_min)), ''))
+
+    if show:
+        plt.show()
     plt.close()
 
 
+def export_batch(jobs, wlen_min, obs_name, red_name):
+    # worker process of the batch mode: no display, one spectrum after the other
+    import matplotlib
+    matplotlib.use('Agg')
+    for fname, param_file, trace in jobs:
+        print(' * %s' % fname)
+        export_spectrum(fname, param_file, wlen_min, obs_name, red_name, trace, show=False)
+
+
+@click.command()
+@click.argument('files', nargs=-1, required=True)
+@click.option('--objid', default=None)
+@click.option('--obs-name', default='Steve Schulze')
+@click.option('--red-name', default='Steve Schulze')
+@click.option('--wlen-min', type=float, default=4000)
+@click.option('--jobs', type=click.IntRange(min=1), default=1, help="Number of worker processes for batch conversion")
+
+def main(files, wlen_min, obs_name, red_name, objid, jobs):
+
+    # FILES are pairs of spec1d file and PypeIt parameter file
+    if len(files) % 2 != 0:
+        raise click.UsageError('Expected pairs of spec1d and .pypeit files')
+    pairs = list(zip(files[0::2], files[1::2]))
+    # trace numbers and names differ between spectra
+    if objid is not None and len(pairs) > 1:
+        raise click.UsageError('--objid can only be given for a single spectrum')
+
+    # the traces of all spectra are selected at once from the spec1d catalog
+    with metrics.span('select_traces', metrics.night_of(*files), n_spectra=len(pairs)):
+        traces = select_traces([fname for fname, _ in pairs], objid)
+
+    if len(pairs) == 1:
+        export_spectrum(pairs[0][0], pairs[0][1], wlen_min, obs_name, red_name, traces[0])
+        return
+
+    jobs_list = [(fname, param_file, trace) for (fname, param_file), trace in zip(pairs, traces)]
+    if warm_worker.in_process(jobs):
+        export_batch(jobs_list, wlen_min, obs_name, red_name)
+        return
+
+    import concurrent.futures
+    chunks = [jobs_list[i::jobs] for i in range(jobs) if jobs_list[i::jobs]]
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as pool:
+        for future in [pool.submit(export_batch, chunk, wlen_min, obs_name, red_name) for chunk in chunks]:
+            future.result()
+
+
 if __name__ == '__main__':
     main()
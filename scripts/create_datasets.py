@@ -1,14 +1,14 @@
 #!/usr/bin/env python
 import click
-import astropy.io.fits as fits
+import concurrent.futures
+import functools
 import glob
-import ccdproc
-import astropy.coordinates as coordinates
-import astropy.units as u
-import astropy.time as time
+import json
 import numpy as np
-import jinja2
 import os
+import calib_store
+import metrics
+from   header_index import HeaderIndex
 
 ALFOSC_HEADERS = [
     'DATE-OBS',
@@ -26,7 +26,7 @@ ALFOSC_HEADERS = [
 
 
 
-PYPEIT_TEMPLATE = jinja2.Template("""
+PYPEIT_TEMPLATE = """
 # User-defined execution parameters
 [rdx]
 spectrograph = not_alfosc
@@ -59,10 +59,73 @@ data read
 | {{ x.filename }}| {{ x.frametype }} | {{ x.ra }} | {{ x.dec }} | {{ x.target }} | {{ x.grism }} | {{ x.slit }} | {{ x.binning }} | {{ x.mjd }} | {{ x.airmass }} | {{ x.exptime }} |
 {% endfor %}
 data end
-""")
+"""
 
-def extract_frame(hdrs, idx, frametype):
-    h = hdrs.summary[idx]
+
+@functools.lru_cache(maxsize=1)
+def pypeit_template():
+    import jinja2
+    return jinja2.Template(PYPEIT_TEMPLATE)
+
+# maximum distance between a science frame and its arcs and flats
+MATCH_RADIUS_DEG = 1.
+
+class NightIndex:
+    # Lookup structures for the calibration association, built once per night
+
+    def __init__(self, hdrs):
+        # imported here, so the module loads fast for commands that do not build the index
+        import astropy.time as time
+        import scipy.spatial
+
+        self.summary = hdrs.summary
+
+        # unit vectors for the pointing match; frames without coordinates never match
+        ra = np.radians(np.ma.filled(np.ma.asarray(self.summary['RA'], dtype=float), np.nan))
+        dec = np.radians(np.ma.filled(np.ma.asarray(self.summary['DEC'], dtype=float), np.nan))
+        xyz = np.column_stack([np.cos(dec)*np.cos(ra), np.cos(dec)*np.sin(ra), np.sin(dec)])
+        self.has_coords = np.all(np.isfinite(xyz), axis=1)
+        # tree index -> frame index
+        self.tree_idx = np.flatnonzero(self.has_coords)
+        self.tree = scipy.spatial.cKDTree(xyz[self.has_coords])
+        self.xyz = xyz
+
+        # DATE-OBS -> MJD in one vectorized conversion
+        date_obs = self.summary['DATE-OBS']
+        has_date = ~np.ma.getmaskarray(date_obs)
+        self.mjd = np.full(len(self.summary), np.nan)
+        if np.any(has_date):
+            self.mjd[has_date] = time.Time(list(np.asarray(date_obs)[has_date])).mjd
+
+        # rank of each frame in time, used to emit frames chronologically
+        self.mjd_rank = np.empty(len(self.summary), dtype=int)
+        self.mjd_rank[np.argsort(self.mjd, kind='stable')] = np.arange(len(self.summary))
+
+        self.imagetyp = np.ma.filled(self.summary['IMAGETYP'].astype(str), '')
+        self.detwin1 = np.ma.filled(self.summary['DETWIN1'].astype(str), '')
+
+    def chronological(self, mask):
+        idx = np.flatnonzero(mask)
+        return idx[np.argsort(self.mjd_rank[idx])]
+
+    def match_pointings(self, frame_idx_list, radius_deg=MATCH_RADIUS_DEG):
+        # one batched query for all targets; chord length on the unit sphere
+        if not frame_idx_list:
+            return []
+        chord = 2*np.sin(np.radians(radius_deg)/2.)
+        first = [np.flatnonzero(frame_idx)[0] for frame_idx in frame_idx_list]
+        nearby = self.tree.query_ball_point(np.nan_to_num(self.xyz[first]), chord)
+        ret = []
+        for i, idx in zip(first, nearby):
+            mask = np.zeros(len(self.summary), dtype=bool)
+            if self.has_coords[i]:
+                mask[self.tree_idx[np.asarray(idx, dtype=int)]] = True
+            ret.append(mask)
+        return ret
+
+
+def extract_frame(night, idx, frametype):
+    h = night.summary[idx]
     ret = {
         'filename': os.path.basename(h['file']),
         'frametype': frametype,
@@ -72,96 +135,197 @@ def extract_frame(hdrs, idx, frametype):
         'grism': h['ALGRNM'].replace('#', ''),
         'slit': h['ALAPRTNM'],
         'binning': '1,1',
-        'mjd': time.Time(h['DATE-OBS']).mjd,
+        'mjd': night.mjd[idx],
         'airmass': h['AIRMASS'],
         'exptime': h['EXPTIME']
     }
     return ret
 
 
-def produce_dataset(hdrs, frame_idx, raw_dir, day, target_name, overwrite):
-
-    coords = coordinates.SkyCoord(hdrs.summary['RA'], hdrs.summary['DEC'], unit=(u.deg, u.deg))
+def render_dataset(night, frame_idx, nearby_idx, raw_dir, day, target_name):
+    """Manifest entry and content of the .pypeit file of a target."""
 
     # FIXME: this assumes one instrument configuration per target
-    assert len(np.unique(hdrs.summary['DETWIN1'][frame_idx])) == 1
-    detwin1 = hdrs.summary['DETWIN1'][frame_idx][0]
+    assert len(np.unique(night.detwin1[frame_idx])) == 1
+    detwin1 = night.detwin1[frame_idx][0]
 
     # list of frames to use in the pypeit template
     frames = []
     
     # find bias frame with same DETWIN1 configuration
-    bias_frames = np.logical_and(hdrs.summary['IMAGETYP'] == 'BIAS', hdrs.summary['DETWIN1'] == detwin1)
-    for idx in np.arange(len(hdrs.summary))[bias_frames]:
-        frames.append(extract_frame(hdrs, idx, 'bias'))
+    bias_frames = np.logical_and(night.imagetyp == 'BIAS', night.detwin1 == detwin1)
+    for idx in night.chronological(bias_frames):
+        frames.append(extract_frame(night, idx, 'bias'))
 
     # FIXME: we assume that one target has one set of coordinates
     # TODO: ensure that
-    sci_coords   = coordinates.SkyCoord(hdrs.summary['RA'][frame_idx][0], hdrs.summary['DEC'][frame_idx][0], unit=(u.deg, u.deg))
-    frame_offset = sci_coords.separation(coords)
+    # nearby_idx holds all frames within MATCH_RADIUS_DEG of the first science frame
 
     # now find the matching arcs for that observation
-    wave_idx = np.logical_and(hdrs.summary['IMAGETYP'] == 'WAVE,LAMP', frame_offset < 1*u.deg)
-    flat_idx = np.logical_and(hdrs.summary['IMAGETYP'] == 'FLAT,LAMP', frame_offset < 1*u.deg)
+    wave_idx = np.logical_and(night.imagetyp == 'WAVE,LAMP', nearby_idx)
+    flat_idx = np.logical_and(night.imagetyp == 'FLAT,LAMP', nearby_idx)
 
-    for idx in np.arange(len(hdrs.summary))[wave_idx]:
-        frames.append(extract_frame(hdrs, idx, 'tilt,arc'))
-    for idx in np.arange(len(hdrs.summary))[flat_idx]:
-        frames.append(extract_frame(hdrs, idx, 'trace,illumflat,pixelflat'))
+    for idx in night.chronological(wave_idx):
+        frames.append(extract_frame(night, idx, 'tilt,arc'))
+    for idx in night.chronological(flat_idx):
+        frames.append(extract_frame(night, idx, 'trace,illumflat,pixelflat'))
 
-    for idx in np.arange(len(hdrs.summary))[frame_idx]:
-        frames.append(extract_frame(hdrs, idx, 'science'))
+    for idx in night.chronological(frame_idx):
+        frames.append(extract_frame(night, idx, 'science'))
+
+    # calibration products are shared between datasets with the same calibration frames
+    calib_frames = [(x['filename'], x['frametype']) for x in frames if x['frametype'] != 'science']
+    calibs_dir = calib_store.calib_dir(calib_store.calib_key(calib_frames, detwin1, frames[-1]['grism'], frames[-1]['slit'], frames[-1]['binning']))
 
     dest_file = 'datasets/%s-%s.pypeit' % (day, target_name)
-    header_file = 'datasets/%s-%s.header' % (day, target_name)
-    
+
+    # manifest entry for this dataset
+    frametypes = [x['frametype'] for x in frames]
+    entry = {
+        'dataset': dest_file,
+        'day': day,
+        'target': target_name,
+        'grism': frames[-1]['grism'],
+        'slit': frames[-1]['slit'],
+        'detwin1': detwin1,
+        'calib_dir': calibs_dir,
+        'n_bias': frametypes.count('bias'),
+        'n_arc': frametypes.count('tilt,arc'),
+        'n_flat': frametypes.count('trace,illumflat,pixelflat'),
+        'n_science': frametypes.count('science'),
+    }
+    entry['calibrated'] = entry['n_bias'] > 0 and entry['n_arc'] > 0 and entry['n_flat'] > 0
+
+    sci_dir = 'sci/%s-%s' % (day, target_name)
+    qa_dir = 'QA/%s-%s' % (day, target_name)
+    content = pypeit_template().render(raw_files=frames, grism=frames[-1]['grism'], slit=frames[-1]['slit'], raw_data_dir=raw_dir, calibs_dir=calibs_dir, sci_dir=sci_dir, qa_dir=qa_dir)
+    return entry, content
+
+
+def produce_dataset(night, frame_idx, nearby_idx, raw_dir, day, target_name, overwrite):
+    entry, content = render_dataset(night, frame_idx, nearby_idx, raw_dir, day, target_name)
+    dest_file = entry['dataset']
+
     if os.path.isfile(dest_file):
         if overwrite != True:
             print('   * %s Already exists. Skipping' % dest_file)
-            return
+            entry['status'] = 'skipped'
+            return entry
 
-    calibs_dir = 'calibs/%s-%s' % (day, target_name)
-    sci_dir = 'sci/%s-%s' % (day, target_name)
-    qa_dir = 'QA/%s-%s' % (day, target_name)
-    
     print('   * Generating pypeit file %s' % dest_file)
     with open(dest_file, 'w') as f:
-        f.write(PYPEIT_TEMPLATE.render(raw_files=frames, grism=frames[-1]['grism'], slit=frames[-1]['slit'], raw_data_dir=raw_dir, calibs_dir=calibs_dir, sci_dir=sci_dir, qa_dir=qa_dir))
+        f.write(content)
+    entry['status'] = 'created'
+    return entry
+
+
+def find_days(patterns, start, end):
+    # DAY arguments may be glob patterns matching directories in raw/
+    days = set()
+    for pattern in patterns:
+        days.update(os.path.basename(d) for d in glob.glob('raw/%s' % pattern) if os.path.isdir(d))
+    if start is not None or end is not None:
+        for d in glob.glob('raw/*'):
+            day = os.path.basename(d)
+            if os.path.isdir(d) and (start is None or day >= start) and (end is None or day <= end):
+                days.add(day)
+    return sorted(days)
 
-@click.command()
-@click.argument('day')
-@click.option('--overwrite', is_flag=True, help="Overwrite configuration file")
-def main(day, overwrite):
-    print('Producing datasets for %s' % day)
-    fits_dir = 'raw/%s' % day
-    fits_files = glob.glob('%s/*.fits' % fits_dir)
-    print(' * Found %d frames' % len(fits_files))
-    
-    # load headers
-    print(' * Loading headers..')
-    hdrs = ccdproc.ImageFileCollection(fits_dir, keywords=ALFOSC_HEADERS)
-    
 
+def write_manifest(entries, days, manifest):
+    # entries of nights that were not processed in this run are kept
+    old_entries = []
+    if os.path.isfile(manifest):
+        with open(manifest) as f:
+            old_entries = [x for x in json.load(f) if x['day'] not in days]
+
+    with open(manifest, 'w') as f:
+        json.dump(sorted(old_entries + entries, key=lambda x: x['dataset']), f, indent=1)
+    print(' * Wrote manifest %s (%d datasets)' % (manifest, len(entries)))
+
+
+def night_targets(hdrs, night, verbose=True):
+    """(name, frame mask) of every standard and science target of a night."""
     # find the standard frames
-    std_frames = np.logical_and(hdrs.summary['IMAGETYP'] == 'STD', hdrs.summary['IMAGECAT'] == 'CALIB')
-    print(' * Found %d STD frames' % np.count_nonzero(std_frames))
-    
+    std_frames = np.logical_and(night.imagetyp == 'STD', hdrs.summary['IMAGECAT'] == 'CALIB')
     # find the science frames
     sci_frames = hdrs.summary['IMAGECAT'] == 'SCIENCE'
-    print(' * Found %d SCI frames' % np.count_nonzero(sci_frames))
+    if verbose:
+        print(' * Found %d STD frames' % np.count_nonzero(std_frames))
+        print(' * Found %d SCI frames' % np.count_nonzero(sci_frames))
 
     std_names = np.unique(hdrs.summary['OBJECT'][std_frames])
     sci_names = np.unique(hdrs.summary['OBJECT'][sci_frames])
 
+    targets = []
     for std_tgt_name in std_names:
-        print(' * STD-%s' % std_tgt_name)
         idx = np.logical_and(std_frames, hdrs.summary['OBJECT'] == std_tgt_name)
-        produce_dataset(hdrs, idx, fits_dir, day, 'STD-%s' % std_tgt_name, overwrite)
+        targets.append(('STD-%s' % std_tgt_name, np.ma.filled(idx, False)))
 
     for sci_tgt_name in sci_names:
-        print(' * %s' % sci_tgt_name)
         idx = np.logical_and(sci_frames, hdrs.summary['OBJECT'] == sci_tgt_name)
-        produce_dataset(hdrs, idx, fits_dir, day, sci_tgt_name, overwrite)
+        targets.append((sci_tgt_name, np.ma.filled(idx, False)))
+    return targets
+
+
+def produce_night(day, overwrite, header_jobs=None, trim=False, trim_jobs=4):
+    print('Producing datasets for %s' % day)
+    fits_dir = 'raw/%s' % day
+    if trim:
+        # PypeIt works on the trimmed copies of the raw frames
+        with metrics.span('trim', day):
+            import trim_image
+            fits_dir = trim_image.trim_night(day, jobs=trim_jobs)
+    fits_files = glob.glob('%s/*.fits' % fits_dir)
+    print(' * Found %d frames' % len(fits_files))
+    
+    # load headers
+    print(' * Loading headers..')
+    with metrics.span('headers', day, n_frames=len(fits_files)):
+        hdrs = HeaderIndex(fits_dir, ALFOSC_HEADERS, jobs=header_jobs)
+    
+    with metrics.span('night_index', day):
+        night = NightIndex(hdrs)
+
+    targets = night_targets(hdrs, night)
+
+    # match the pointings of all targets at once
+    with metrics.span('match_pointings', day, n_targets=len(targets)):
+        nearby = night.match_pointings([idx for _, idx in targets])
+
+    entries = []
+    with metrics.span('write_datasets', day, n_targets=len(targets)):
+        for (target_name, idx), nearby_idx in zip(targets, nearby):
+            print(' * %s' % target_name)
+            entries.append(produce_dataset(night, idx, nearby_idx, fits_dir, day, target_name, overwrite))
+    return entries
+
+
+@click.command()
+@click.argument('days', nargs=-1)
+@click.option('--start', default=None, help="First night of a date range (YYYY-MM-DD)")
+@click.option('--end', default=None, help="Last night of a date range (YYYY-MM-DD)")
+@click.option('--jobs', type=click.IntRange(min=1), default=1, help="Number of nights processed in parallel")
+@click.option('--manifest', default='datasets/manifest.json', help="Manifest listing all datasets")
+@click.option('--trim', is_flag=True, help="Trim the raw frames into trimmed/ and reduce the trimmed frames")
+@click.option('--trim-jobs', type=click.IntRange(min=1), default=None, help="Number of processes trimming the frames of a night (default: 4, 1 with --jobs)")
+@click.option('--overwrite', is_flag=True, help="Overwrite configuration file")
+def main(days, start, end, jobs, manifest, trim, trim_jobs, overwrite):
+    days = find_days(days, start, end)
+    if len(days) == 0:
+        raise click.UsageError('No matching nights found in raw/')
+
+    entries = []
+    if jobs == 1 or len(days) == 1:
+        for day in days:
+            entries += produce_night(day, overwrite, trim=trim, trim_jobs=trim_jobs or 4)
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as pool:
+            for result in pool.map(produce_night, days, [overwrite]*len(days), [1]*len(days), [trim]*len(days),
+                                   [trim_jobs or 1]*len(days)):
+                entries += result
+
+    write_manifest(entries, days, manifest)
 
 if __name__ == '__main__':
     main()
@@ -2,13 +2,13 @@
 import click
 import astropy.io.fits as fits
 import glob
-import ccdproc
 import astropy.coordinates as coordinates
 import astropy.units as u
 import astropy.time as time
 import numpy as np
 import jinja2
 import os
+from   header_index import HeaderIndex
 
 LRIS_HEADERS = [
     'DATE-OBS',
@@ -185,7 +185,7 @@ def main(day, arm, overwrite):
     
     # load headers
     print(' * Loading headers..')
-    hdrs = ccdproc.ImageFileCollection(fits_dir, keywords=LRIS_HEADERS)
+    hdrs = HeaderIndex(fits_dir, LRIS_HEADERS)
     print(hdrs.summary)
     
     """
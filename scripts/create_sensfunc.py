@@ -1,33 +1,23 @@
 #!/usr/bin/env python
 import glob
-import subprocess
 import click
-import astropy.io.fits as fits
-import os
+from   sensfunc_build import build_sensfuncs
 
 
 @click.command()
 @click.argument('day')
 @click.option('--overwrite', is_flag=True, help="Overwrite configuration file")
+@click.option('--jobs', type=click.IntRange(min=1), default=1, help="Number of standards processed in parallel")
+@click.option('--debug/--no-debug', default=False, help="Show the pypeit_sensfunc debug plots, one standard after the other")
+@click.option('--timeout', type=float, default=1800, help="Stop pypeit_sensfunc after this many seconds (not with --debug)")
 
-def main(day, overwrite):
+def main(day, overwrite, jobs, debug, timeout):
     print(' * Searching for std frames on %s' % day)
-    std_1dframes = glob.glob('sci/%s-STD-*/spec1d*.fits' % day)
+    std_1dframes = sorted(glob.glob('sci/%s-STD-*/spec1d*.fits' % day))
 
-    
-    for frame in std_1dframes:
-        hdr = fits.getheader(frame)
-        mjd = hdr['MJD']
-        dest_path = 'sens/%.4f.fits' % mjd
-        print(' * %s -> %s' % (frame, dest_path))
-
-        if os.path.isfile(dest_path):
-            if overwrite == False:
-                raise ValueError('* ERR: already exists!')
-            else:
-                print('Destination file already exists, but will be overwritten.')
-
-        subprocess.run(['pypeit_sensfunc', '-s', 'etc/sensfunc.par', frame, '-o', dest_path, '--debug'])
+    failed = build_sensfuncs(std_1dframes, overwrite, jobs, debug, timeout=timeout)
+    if failed:
+        raise click.ClickException('%d sensitivity functions could not be built' % len(failed))
 
 if __name__ == '__main__':
     main()
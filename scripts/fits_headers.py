@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+import concurrent.futures
+import gzip
+import os
+
+import numpy as np
+
+import warm_worker
+
+# Minimal FITS header reader. Only the 2880-byte blocks of the primary
+# header are read (up to the END card, or until all requested keywords
+# were seen) and only the requested cards are parsed. This avoids building
+# full astropy Header objects when we only need a handful of keywords.
+
+BLOCK_SIZE = 2880
+CARD_SIZE = 80
+
+def _parse_string(raw):
+    # FITS strings are quoted with ', a literal quote is written as ''
+    out = []
+    i = 1
+    while i < len(raw):
+        c = raw[i]
+        if c == "'":
+            if raw[i+1:i+2] == "'":
+                out.append("'")
+                i += 2
+                continue
+            break
+        out.append(c)
+        i += 1
+    return ''.join(out).rstrip()
+
+
+def parse_value(raw):
+    raw = raw.strip()
+    if raw.startswith("'"):
+        return _parse_string(raw)
+
+    value = raw.split('/', 1)[0].strip()
+    if value == '':
+        return None
+    if value == 'T':
+        return True
+    if value == 'F':
+        return False
+    try:
+        return int(value)
+    except ValueError:
+        pass
+    try:
+        return float(value.replace('D', 'E'))
+    except ValueError:
+        return value
+
+
+def _split_card(card):
+    if card.startswith('HIERARCH '):
+        key, sep, value = card[9:].partition('=')
+        return (key.strip(), value) if sep else (None, None)
+    if card[8:10] == '= ':
+        return card[:8].strip(), card[10:]
+    return card[:8].strip(), None
+
+
+def read_cards(f, keywords=None):
+    """Parse the primary header from the open binary file f.
+
+    Returns {keyword: value} for the requested keywords (all value cards if
+    keywords is None). The first occurrence of a keyword wins, as in astropy.
+    """
+    wanted = None if keywords is None else set(keywords)
+    found = {}
+    last_key = None
+
+    while True:
+        block = f.read(BLOCK_SIZE)
+        if len(block) < BLOCK_SIZE:
+            break
+        text = block.decode('ascii', errors='replace')
+        for i in range(0, BLOCK_SIZE, CARD_SIZE):
+            card = text[i:i+CARD_SIZE]
+            key, raw = _split_card(card)
+
+            if key == 'END':
+                return found
+            if key == 'CONTINUE' and last_key is not None:
+                # long string convention: the previous value ends with '&'
+                value = found[last_key]
+                if isinstance(value, str) and value.endswith('&'):
+                    found[last_key] = value[:-1] + parse_value(card[8:])
+                continue
+
+            last_key = None
+            if raw is None or key in found:
+                continue
+            if wanted is not None and key not in wanted:
+                continue
+
+            found[key] = parse_value(raw)
+            last_key = key
+
+        if wanted is not None and len(found) == len(wanted) and last_key is None:
+            break
+
+    return found
+
+
+def read_header(fname, keywords=None):
+    opener = gzip.open if fname.endswith('.gz') else open
+    with opener(fname, 'rb') as f:
+        return read_cards(f, keywords)
+
+
+def _read_chunk(fnames, keywords):
+    return [read_header(fname, keywords) for fname in fnames]
+
+
+def read_headers(fnames, keywords=None, jobs=None):
+    """Read the headers of many files in a process pool.
+
+    Returns a list of dicts in the same order as fnames.
+    """
+    fnames = list(fnames)
+    jobs = jobs or os.cpu_count() or 1
+    if warm_worker.in_process(jobs) or len(fnames) < 64:
+        return _read_chunk(fnames, keywords)
+
+    chunk = max(16, len(fnames) // (4*jobs))
+    chunks = [fnames[i:i+chunk] for i in range(0, len(fnames), chunk)]
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as pool:
+        results = pool.map(_read_chunk, chunks, [keywords]*len(chunks))
+        return [hdr for result in results for hdr in result]
+
+
+def _dtype(values):
+    present = [v for v in values if v is not None]
+    if not present:
+        return 'U1'
+    if all(isinstance(v, bool) for v in present):
+        return '?'
+    if all(isinstance(v, int) and not isinstance(v, bool) for v in present):
+        return 'i8'
+    if all(isinstance(v, (int, float)) and not isinstance(v, bool) for v in present):
+        return 'f8'
+    return 'U%d' % max(1, max(len(str(v)) for v in present))
+
+
+def to_array(fnames, headers, keywords):
+    """Convert headers into a masked NumPy structured array with a 'file' column."""
+    names = ['file'] + list(keywords)
+    columns = [[os.path.basename(f) for f in fnames]] + [[hdr.get(key) for hdr in headers] for key in keywords]
+    dtype = [(name, _dtype(col)) for name, col in zip(names, columns)]
+
+    data = np.zeros(len(fnames), dtype=dtype)
+    mask = np.zeros(len(fnames), dtype=[(name, '?') for name in names])
+    for name, col in zip(names, columns):
+        missing = np.array([v is None for v in col], dtype=bool)
+        if data.dtype[name].kind == 'U':
+            col = ['' if v is None else str(v) for v in col]
+        else:
+            col = [0 if v is None else v for v in col]
+        data[name] = col
+        mask[name] = missing
+    return np.ma.array(data, mask=mask)
+
+
+def read_header_array(fnames, keywords, jobs=None):
+    fnames = list(fnames)
+    return to_array(fnames, read_headers(fnames, keywords, jobs), keywords)
@@ -0,0 +1,152 @@
+import functools
+import os
+
+import astropy.constants as constants
+import astropy.convolution as convolution
+import astropy.io.fits as fits
+import astropy.units as units
+import numpy as np
+import scipy.ndimage
+
+# In-process flux calibration of PypeIt spec1d files. This follows what
+# pypeit_flux_calib does for a single-detector longslit (extinct_correct=True,
+# extrap_sens=False): the zeropoint of the sensitivity function is
+# interpolated onto the wavelength grid of each trace, converted to a
+# counts/pixel -> F_lambda factor (divided by the wavelength step of each
+# pixel) and corrected for atmospheric extinction. Spectra that extend
+# beyond the sensitivity function are an error, as in PypeIt.
+
+PYPEIT_FLUX_SCALE = 1e-17
+
+# width of the median filter of the wavelength steps, fraction of the spectrum
+DELTA_WAVE_FILTER = 0.03
+
+def zp_unit_const():
+    # converts an AB zeropoint into units of PYPEIT_FLUX_SCALE erg/s/cm^2/A
+    return -2.5*np.log10(((units.angstrom**2/constants.c)*(PYPEIT_FLUX_SCALE*units.erg/units.s/units.cm**2/units.angstrom)).to('Jy').value) + 8.9
+
+ZP_UNIT_CONST = zp_unit_const()
+
+
+def load_sens(fname):
+    # memoized as long as the sens file does not change
+    return _load_sens(fname, os.stat(fname).st_mtime_ns)
+
+
+@functools.lru_cache(maxsize=64)
+def _load_sens(fname, mtime_ns):
+    with fits.open(fname) as hdu:
+        data = hdu[1].data
+        wave = np.atleast_2d(data['SENS_WAVE'])[0].astype(float)
+        zeropoint = np.atleast_2d(data['SENS_ZEROPOINT'])[0].astype(float)
+
+    # drop the zero padding of the sensitivity table
+    good = wave > 1
+    return wave[good], zeropoint[good]
+
+
+@functools.lru_cache(maxsize=8)
+def load_extinction(fname=None, longitude=None, latitude=None):
+    """Return (wave, mag/airmass) of the extinction curve.
+
+    Either read from a two-column text file, or taken from PypeIt's curve
+    for the observatory closest to longitude/latitude.
+    """
+    if fname is not None:
+        wave, mag = np.loadtxt(fname, usecols=(0, 1), unpack=True)
+        return wave, mag
+
+    from pypeit import flux_calib
+    extinct = flux_calib.load_extinction_data(longitude, latitude, 'closest')
+    return np.asarray(extinct['wave'], dtype=float), np.asarray(extinct['mag_ext'], dtype=float)
+
+
+def running_median(seq, width):
+    # as pypeit.utils.fast_running_median: reflected padding of the sequence
+    width = int(np.fmax(np.fmin(width, len(seq)-1), 1))
+    padded = np.concatenate((seq[0:width][::-1], seq, seq[-1:(-1-width):-1]))
+    return scipy.ndimage.median_filter(padded, width, mode='reflect')[width:-width]
+
+
+def delta_wave(wave, good):
+    """Wavelength step of every pixel, as pypeit.core.wavecal.wvutils.get_delta_wave.
+
+    The differences of the good wavelengths are median filtered and smoothed
+    with a Gaussian; masked pixels get 0.
+    """
+    width = 2*int(np.round(wave.size*DELTA_WAVE_FILTER/2.0)) + 1
+    diff = np.diff(wave[good])
+    diff = running_median(np.append(diff, diff[-1]), width)
+    kernel = convolution.Gaussian1DKernel(np.fmax(width/10.0, 3.0))
+    result = np.zeros_like(wave, dtype=float)
+    result[good] = convolution.convolve(diff, kernel, boundary='extend')
+    return result
+
+
+def sens_factor(wave, sens_wave, sens_zeropoint):
+    # counts/pixel/s -> F_lambda; the spectrum must lie within the sensitivity function (extrap_sens=False)
+    good = wave > 1
+    factor = np.zeros_like(wave, dtype=float)
+    if not good.any():
+        return factor
+    if wave[good].min() < sens_wave[0] or wave[good].max() > sens_wave[-1]:
+        raise ValueError('Spectrum (%.1f-%.1f A) extends beyond the sensitivity function (%.1f-%.1f A)'
+                         % (wave[good].min(), wave[good].max(), sens_wave[0], sens_wave[-1]))
+    zeropoint = np.interp(wave[good], sens_wave, sens_zeropoint)
+    factor[good] = np.power(10.0, -0.4*(zeropoint - ZP_UNIT_CONST))/np.square(wave[good])/delta_wave(wave, good)[good]
+    return factor
+
+
+def extinction_correction(wave, airmass, ext_wave, ext_mag):
+    mag = np.interp(wave, ext_wave, ext_mag)
+    return np.power(10.0, 0.4*mag*airmass)
+
+
+def flux_trace(data, prefix, exptime, sens, extinction, airmass):
+    wave = np.asarray(data[prefix + '_WAVE'], dtype=float)
+    counts = np.asarray(data[prefix + '_COUNTS'], dtype=float)
+    ivar = np.asarray(data[prefix + '_COUNTS_IVAR'], dtype=float)
+
+    factor = sens_factor(wave, *sens) * extinction_correction(wave, airmass, *extinction) / exptime
+    flam = counts * factor
+    flam_ivar = np.zeros_like(flam)
+    good = factor > 0
+    flam_ivar[good] = ivar[good] / np.square(factor[good])
+    flam_sig = np.zeros_like(flam)
+    flam_sig[flam_ivar > 0] = 1/np.sqrt(flam_ivar[flam_ivar > 0])
+
+    return {prefix + '_FLAM': flam, prefix + '_FLAM_IVAR': flam_ivar, prefix + '_FLAM_SIG': flam_sig}
+
+
+def flux_calibrate(fname, sensfile, extinction_file=None):
+    """Flux calibrate all traces of a spec1d file in place."""
+    sens = load_sens(sensfile)
+
+    with fits.open(fname) as hdulist:
+        hdr = hdulist[0].header
+        exptime = hdr['EXPTIME']
+        airmass = hdr['AIRMASS']
+        extinction = load_extinction(extinction_file, hdr.get('LON-OBS'), hdr.get('LAT-OBS'))
+
+        new_hdus = [hdulist[0].copy()]
+        for hdu in hdulist[1:]:
+            if not isinstance(hdu, fits.BinTableHDU) or 'OPT_COUNTS' not in hdu.columns.names:
+                new_hdus.append(hdu.copy())
+                continue
+
+            columns = {}
+            for prefix in ('OPT', 'BOX'):
+                if prefix + '_COUNTS' in hdu.columns.names:
+                    columns.update(flux_trace(hdu.data, prefix, exptime, sens, extinction, airmass))
+
+            # replace existing flux columns, keep all others in place
+            cols = [c for c in hdu.columns if c.name not in columns]
+            cols += [fits.Column(name=name, format='D', array=value) for name, value in columns.items()]
+            new_hdus.append(fits.BinTableHDU.from_columns(cols, header=hdu.header, name=hdu.name))
+
+        new_hdus[0].header['FLUXED'] = (True, 'Flux calibrated')
+        new_hdus[0].header['SENSFILE'] = (os.path.basename(sensfile), 'Sensitivity function')
+
+        tmp_fname = fname + '.tmp'
+        fits.HDUList(new_hdus).writeto(tmp_fname, overwrite=True)
+    os.replace(tmp_fname, fname)
@@ -2,8 +2,8 @@
 import click
 import os
 
-import astropy.io.fits as fits
 import astropy.time as time
+from   header_index import HeaderIndex
 
 
 
@@ -12,8 +12,14 @@ import astropy.time as time
 @click.argument('fits_files', nargs=-1)
 def main(fits_files):
     print('|        filename | frametype |            ra |           dec |          target | dispname |   decker | binning |                mjd |         airmass |  exptime |')
+
+    # one index per raw directory, so repeated calls do not reopen the frames
+    indices = {}
     for fname in fits_files:
-        hdr = fits.getheader(fname)
+        fits_dir = os.path.dirname(fname) or '.'
+        if fits_dir not in indices:
+            indices[fits_dir] = HeaderIndex(fits_dir, [])
+        hdr = indices[fits_dir].header(fname)
         ra, dec = hdr['RA'], hdr['DEC']
         target = hdr['OBJECT']
         grism = hdr['ALGRNM'].replace('#', '')
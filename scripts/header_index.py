@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+import click
+import contextlib
+import fnmatch
+import functools
+import json
+import os
+import sqlite3
+
+import fits_headers
+
+# Persistent header index of a raw night directory. Every frame is keyed by
+# its file name, size and mtime, so only new or modified frames are opened
+# again. The full primary header is kept, which allows create_header to
+# reuse the index instead of opening the raw frame.
+
+INDEX_NAME = '.header_index.sqlite'
+FILE_INDEX_NAME = '.file_index.json'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS headers (
+    filename TEXT PRIMARY KEY,
+    size     INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    header   TEXT NOT NULL
+)
+"""
+
+class HeaderIndex:
+
+    def __init__(self, fits_dir, keywords, pattern='*.fits', jobs=None):
+        self.location = fits_dir
+        self.jobs = jobs
+        self.keywords = list(keywords)
+        self.pattern = pattern
+        self.index_file = os.path.join(fits_dir, INDEX_NAME)
+        self.headers = self.refresh()
+        self.summary = self._summary()
+
+    def _connect(self):
+        con = sqlite3.connect(self.index_file, timeout=60)
+        con.execute(SCHEMA)
+        return con
+
+    def _scan_dir(self):
+        entries = {}
+        with os.scandir(self.location) as it:
+            for entry in it:
+                if entry.is_file() and fnmatch.fnmatch(entry.name, self.pattern):
+                    st = entry.stat()
+                    entries[entry.name] = (st.st_size, st.st_mtime_ns)
+        return entries
+
+    def _read_headers(self, fnames):
+        headers = fits_headers.read_headers([os.path.join(self.location, fname) for fname in fnames], jobs=self.jobs)
+        return dict(zip(fnames, headers))
+
+    def refresh(self):
+        on_disk = self._scan_dir()
+
+        with contextlib.closing(self._connect()) as con:
+            known = {row[0]: (row[1], row[2]) for row in con.execute('SELECT filename, size, mtime_ns FROM headers')}
+
+            changed = sorted(f for f, stat in on_disk.items() if known.get(f) != stat)
+            removed = [f for f in known if fnmatch.fnmatch(f, self.pattern) and f not in on_disk]
+
+            if changed:
+                print('   * Indexing %d new or modified frames' % len(changed))
+                new_headers = self._read_headers(changed)
+                con.executemany('INSERT OR REPLACE INTO headers VALUES (?, ?, ?, ?)',
+                                [(f, on_disk[f][0], on_disk[f][1], json.dumps(new_headers[f])) for f in changed])
+            if removed:
+                con.executemany('DELETE FROM headers WHERE filename = ?', [(f,) for f in removed])
+            con.commit()
+
+            return {row[0]: json.loads(row[1]) for row in con.execute('SELECT filename, header FROM headers ORDER BY filename')
+                    if fnmatch.fnmatch(row[0], self.pattern)}
+
+    def _summary(self):
+        names = list(self.headers.keys())
+        import astropy.table as table
+        return table.Table(fits_headers.to_array(names, list(self.headers.values()), self.keywords), masked=True)
+
+    def header(self, fname):
+        return self.headers[os.path.basename(fname)]
+
+
+def get_header(fname):
+    # Header of a single raw frame, served from (and added to) the index of its directory
+    st = os.stat(fname)
+    return _get_header(fname, st.st_size, st.st_mtime_ns)
+
+
+@functools.lru_cache(maxsize=1024)
+def _get_header(fname, size, mtime_ns):
+    hdrs = HeaderIndex(os.path.dirname(fname) or '.', [], pattern=os.path.basename(fname))
+    return hdrs.header(fname)
+
+
+def _raw_file_index(raw_dir):
+    # filename -> path for all nights; a night is only listed again if its directory changed
+    index_file = os.path.join(raw_dir, FILE_INDEX_NAME)
+    nights = {}
+    if os.path.isfile(index_file):
+        with open(index_file) as f:
+            nights = json.load(f)
+
+    changed = False
+    current = {}
+    with os.scandir(raw_dir) as it:
+        for entry in it:
+            if not entry.is_dir():
+                continue
+            mtime_ns = entry.stat().st_mtime_ns
+            night = nights.get(entry.name)
+            if night is None or night['mtime_ns'] != mtime_ns:
+                night = {'mtime_ns': mtime_ns, 'files': sorted(f for f in os.listdir(entry.path) if fnmatch.fnmatch(f, '*.fits'))}
+                changed = True
+            current[entry.name] = night
+    changed |= len(current) != len(nights)
+
+    if changed:
+        tmp_file = '%s.%d' % (index_file, os.getpid())
+        with open(tmp_file, 'w') as f:
+            json.dump(current, f)
+        os.replace(tmp_file, index_file)
+
+    return {fname: os.path.join(raw_dir, name, fname) for name in sorted(current) for fname in current[name]['files']}
+
+
+_file_index = {}
+
+def find_raw(fname, raw_dir='raw'):
+    """Path of the raw frame fname in any night below raw_dir."""
+    if raw_dir not in _file_index or fname not in _file_index[raw_dir]:
+        _file_index[raw_dir] = _raw_file_index(raw_dir)
+    return _file_index[raw_dir][fname]
+
+
+@click.command()
+@click.argument('day')
+def main(day):
+    fits_dir = 'raw/%s' % day
+    print('Indexing headers in %s' % fits_dir)
+    hdrs = HeaderIndex(fits_dir, [])
+    print(' * %d frames indexed in %s' % (len(hdrs.headers), hdrs.index_file))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,218 @@
+import asyncio
+import concurrent.futures
+import datetime
+import itertools
+import os
+import signal
+import subprocess
+import time
+
+import metrics
+
+# Runner for the external PypeIt tools. Jobs are started by an asyncio loop,
+# at most max_jobs at a time and, if a memory budget is given, only as long
+# as their expected peak memory fits into it. Waiting jobs are started in
+# order of priority (e.g. the expected runtime, for longest-first
+# scheduling), otherwise in order of submission; a job that does not fit
+# into the memory left holds back the jobs behind it, so it is not starved
+# by smaller ones. The output of every job goes to its own log file. A job
+# that exceeds its timeout is terminated together with all its child
+# processes, so a hung tool only costs its own slot. Jobs that timed out,
+# were killed by a signal or could not be started (e.g. for lack of memory)
+# are retried; a non-zero exit code is a failure of the reduction and is
+# not retried.
+
+LOG_DIR = 'logs'
+
+# seconds between SIGTERM and SIGKILL of a job that timed out
+KILL_GRACE = 10
+
+# seconds before the first retry, doubled for every further attempt
+RETRY_DELAY = 5
+
+
+def log_path(stage, name, day=None):
+    return os.path.join(LOG_DIR, day or 'undated', '%s_%s.log' % (stage, name))
+
+
+class Job:
+
+    def __init__(self, cmd, stage, name, log_file=None, day=None, timeout=None, priority=0, cost=None, memory=None):
+        self.cmd = [str(x) for x in cmd]
+        self.stage = stage
+        self.name = name
+        self.day = day if day is not None else metrics.night_of(*self.cmd)
+        self.log_file = log_file or log_path(stage, os.path.basename(name), self.day)
+        self.timeout = timeout
+        # scheduling: higher priority first; expected wall time (s) and peak memory (MB)
+        self.priority = priority
+        self.cost = cost
+        self.memory = memory
+
+
+class JobResult:
+
+    def __init__(self, job, returncode, attempts, wall, timed_out=False, maxrss_mb=None):
+        self.job = job
+        self.returncode = returncode
+        self.attempts = attempts
+        self.wall = wall
+        self.timed_out = timed_out
+        self.maxrss_mb = maxrss_mb
+
+    @property
+    def ok(self):
+        return self.returncode == 0
+
+    def __repr__(self):
+        state = 'timed out' if self.timed_out else 'returncode %s' % self.returncode
+        return '<JobResult %s: %s after %d attempts, %.1f s>' % (self.job.name, state, self.attempts, self.wall)
+
+
+def format_duration(seconds):
+    return '%d:%02d:%02d' % (seconds//3600, seconds%3600//60, seconds%60)
+
+
+def _kill(proc, sig):
+    # the job runs in its own session, so its children are terminated as well
+    try:
+        os.killpg(proc.pid, sig)
+    except ProcessLookupError:
+        pass
+
+
+class JobRunner:
+    """Run jobs concurrently, at most max_jobs at a time.
+
+    timeout is the default for jobs without their own timeout (None: no
+    limit), retries the number of retries after a transient failure and
+    memory the budget (MB) for the expected peak memory of the running jobs.
+    A job that exceeds the budget on its own is started when no other job
+    runs.
+    """
+
+    def __init__(self, max_jobs=4, timeout=None, retries=1, memory=None):
+        self.max_jobs = max(1, max_jobs)
+        self.timeout = timeout
+        self.retries = retries
+        self.memory = memory
+        self._waiters = None
+        self._queue = []
+        self._order = itertools.count()
+        self._running = 0
+        self._memory_used = 0.
+
+    def _fits(self, job):
+        if self.memory is None or not job.memory or self._running == 0:
+            return True
+        return self._memory_used + job.memory <= self.memory
+
+    def _dispatch(self):
+        # highest priority first; nothing is started past a job that does not fit into the memory left
+        for entry in sorted(self._queue, key=lambda x: x[:2]):
+            if self._running >= self.max_jobs:
+                break
+            job, slot = entry[2:]
+            if slot.done():
+                continue
+            if not self._fits(job):
+                break
+            self._queue.remove(entry)
+            self._running += 1
+            self._memory_used += job.memory or 0.
+            slot.set_result(None)
+
+    def _release(self, job):
+        self._running -= 1
+        self._memory_used -= job.memory or 0.
+        self._dispatch()
+
+    async def _acquire(self, job):
+        entry = (-job.priority, next(self._order), job, asyncio.get_running_loop().create_future())
+        self._queue.append(entry)
+        # dispatch once all jobs submitted together are queued, so they start in order of priority
+        asyncio.get_running_loop().call_soon(self._dispatch)
+        try:
+            await entry[3]
+        except asyncio.CancelledError:
+            if entry in self._queue:
+                self._queue.remove(entry)
+            else:
+                self._release(job)
+            raise
+
+    async def _attempt(self, job, attempt):
+        # returns (returncode, timed out, wall time, peak RSS); returncode None if the job could not be started
+        os.makedirs(os.path.dirname(job.log_file) or '.', exist_ok=True)
+        with open(job.log_file, 'w' if attempt == 1 else 'a') as log:
+            if attempt > 1:
+                log.write('\n# attempt %d\n' % attempt)
+                log.flush()
+            start = time.perf_counter()
+            try:
+                proc = subprocess.Popen(job.cmd, stdout=log, stderr=subprocess.STDOUT, stdin=subprocess.DEVNULL,
+                                        start_new_session=True)
+            except OSError as e:
+                log.write('# cannot start %s: %s\n' % (job.cmd[0], e))
+                # a missing executable does not come back with a retry
+                return 127 if isinstance(e, FileNotFoundError) else None, False, 0., None
+
+        # wait4 blocks, so every running job waits in a thread of its own
+        loop = asyncio.get_running_loop()
+        waiter = asyncio.ensure_future(loop.run_in_executor(self._waiters, metrics.wait_process, proc, job.stage, job.day, start))
+        timeout = job.timeout if job.timeout is not None else self.timeout
+        try:
+            returncode = await asyncio.wait_for(asyncio.shield(waiter), timeout)
+            return returncode, False, time.perf_counter() - start, proc.maxrss_mb
+        except asyncio.TimeoutError:
+            _kill(proc, signal.SIGTERM)
+            try:
+                await asyncio.wait_for(asyncio.shield(waiter), KILL_GRACE)
+            except asyncio.TimeoutError:
+                _kill(proc, signal.SIGKILL)
+            returncode = await waiter
+            return returncode, True, time.perf_counter() - start, proc.maxrss_mb
+        except asyncio.CancelledError:
+            _kill(proc, signal.SIGKILL)
+            await waiter
+            raise
+
+    async def run(self, job):
+        """Run a job once a slot is free. Returns a JobResult with the wall time of the last attempt."""
+        attempt = 0
+        while True:
+            attempt += 1
+            await self._acquire(job)
+            try:
+                if job.cost is not None:
+                    until = datetime.datetime.now() + datetime.timedelta(seconds=job.cost)
+                    print('   * %s started, expected %s (until %s)' % (' '.join(job.cmd), format_duration(job.cost), until.strftime('%H:%M')))
+                returncode, timed_out, wall, maxrss_mb = await self._attempt(job, attempt)
+            finally:
+                self._release(job)
+
+            # killed by a signal, timed out or not started: worth another try
+            transient = returncode is None or returncode < 0 or timed_out
+            if not transient or attempt > self.retries:
+                break
+            print(' * %s %s, retrying (see %s)' % (job.name, 'timed out' if timed_out else 'failed', job.log_file))
+            await asyncio.sleep(RETRY_DELAY * 2**(attempt-1))
+
+        result = JobResult(job, returncode if returncode is not None else -1, attempt, wall, timed_out, maxrss_mb)
+        if not result.ok:
+            print(' * ERR: %s %s, see %s' % (job.name, 'timed out' if timed_out else 'failed (%s)' % result.returncode, job.log_file))
+        return result
+
+    async def _main(self, coroutine):
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_jobs) as self._waiters:
+            return await coroutine
+
+    def execute(self, coroutine):
+        """Run a coroutine that awaits self.run(...), e.g. jobs with dependencies."""
+        return asyncio.run(self._main(coroutine))
+
+    def run_all(self, jobs):
+        """Run all jobs, in order of submission as slots become free. Returns the JobResults in the same order."""
+        async def gather():
+            return await asyncio.gather(*[self.run(job) for job in jobs])
+        return list(self.execute(gather()))
@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+import click
+import contextlib
+import datetime
+import glob
+import json
+import os
+import re
+import resource
+import subprocess
+import sys
+import time
+
+# Timing spans for the pipeline scripts. Every span records the wall time,
+# the CPU time of the script and of its finished child processes, and the
+# peak memory, and is appended as one JSON line to metrics/<night>.jsonl.
+# External tools are started with run_process (or waited for with
+# wait_process), which records the CPU time and the peak RSS of that very
+# process. Set ALFOSC_METRICS=0 to disable.
+
+METRICS_DIR = 'metrics'
+
+ENABLED = os.environ.get('ALFOSC_METRICS', '1') != '0'
+
+# name of the running script, set by alfosc.py for its subcommands
+SCRIPT = os.path.basename(sys.argv[0])
+
+_NIGHT = re.compile(r'(\d{4}-\d{2}-\d{2})')
+
+def night_of(*paths):
+    """Night (YYYY-MM-DD) of the first path that contains one."""
+    for path in paths:
+        match = _NIGHT.search(str(path))
+        if match:
+            return match.group(1)
+    return None
+
+
+def metrics_file(day=None):
+    return os.path.join(METRICS_DIR, '%s.jsonl' % (day or 'undated'))
+
+
+def record(stage, day=None, **fields):
+    if not ENABLED:
+        return
+    entry = {'time': datetime.datetime.now().isoformat(timespec='milliseconds'),
+             'script': SCRIPT, 'stage': stage, 'day': day, 'pid': os.getpid()}
+    entry.update(fields)
+    os.makedirs(METRICS_DIR, exist_ok=True)
+    # one write per line in append mode, so several processes can share the file
+    with open(metrics_file(day), 'a') as f:
+        f.write(json.dumps(entry, default=str) + '\n')
+
+
+def _maxrss_mb(usage):
+    # ru_maxrss is in kB on Linux and in bytes on macOS
+    return round(usage.ru_maxrss / (1024.*1024. if sys.platform == 'darwin' else 1024.), 1)
+
+
+@contextlib.contextmanager
+def span(stage, day=None, **fields):
+    """Time the enclosed block. The yielded dict can be used to add fields to the record."""
+    if not ENABLED:
+        yield fields
+        return
+
+    start = time.perf_counter()
+    cpu = time.process_time()
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    status = 'ok'
+    try:
+        yield fields
+    except BaseException:
+        status = 'error'
+        raise
+    finally:
+        now = resource.getrusage(resource.RUSAGE_CHILDREN)
+        record(stage, day, status=status,
+               wall=round(time.perf_counter() - start, 4),
+               cpu=round(time.process_time() - cpu, 4),
+               child_cpu=round((now.ru_utime + now.ru_stime) - (children.ru_utime + children.ru_stime), 4),
+               maxrss_mb=_maxrss_mb(resource.getrusage(resource.RUSAGE_SELF)),
+               **fields)
+
+
+def wait_process(proc, stage, day=None, start=None):
+    """Wait for a subprocess.Popen and return its exit code, recording the resources used by that process.
+
+    The peak RSS of the process is also stored as proc.maxrss_mb.
+    """
+    if start is None:
+        start = time.perf_counter()
+    if not hasattr(os, 'wait4'):
+        proc.maxrss_mb = None
+        return proc.wait()
+
+    # wait4 returns the resource usage of exactly this child
+    _, status, usage = os.wait4(proc.pid, 0)
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    proc.maxrss_mb = _maxrss_mb(usage)
+    record(stage, day, status='ok' if proc.returncode == 0 else 'failed',
+           wall=round(time.perf_counter() - start, 4),
+           child_cpu=round(usage.ru_utime + usage.ru_stime, 4),
+           child_maxrss_mb=_maxrss_mb(usage),
+           cmd=' '.join(proc.args[:3]), returncode=proc.returncode)
+    return proc.returncode
+
+
+def run_process(cmd, stage, day=None, **kwargs):
+    """subprocess.run(cmd).returncode, recording the resources used by that process."""
+    start = time.perf_counter()
+    return wait_process(subprocess.Popen(cmd, **kwargs), stage, day, start)
+
+
+def read_metrics(days=None):
+    rows = []
+    patterns = days or ['*']
+    for fname in sorted({f for pattern in patterns for f in glob.glob(os.path.join(METRICS_DIR, '%s.jsonl' % pattern))}):
+        with open(fname) as f:
+            rows += [json.loads(line) for line in f if line.strip()]
+    return rows
+
+
+@click.group()
+def main():
+    pass
+
+
+@main.command()
+@click.argument('days', nargs=-1)
+@click.option('--top', type=int, default=20, help="Number of stages to show")
+@click.option('--by-night', is_flag=True, help="Show every night separately")
+def summary(days, top, by_night):
+    """Slowest stages across nights (DAYS may be glob patterns, default: all)."""
+    import astropy.table as table
+    import numpy as np
+
+    rows = read_metrics(days)
+    if not rows:
+        raise click.ClickException('No metrics found in %s' % METRICS_DIR)
+
+    groups = {}
+    for row in rows:
+        key = (row['script'], row['stage']) + ((row['day'] or '',) if by_night else ())
+        groups.setdefault(key, []).append(row)
+
+    def total(group, key):
+        return sum(x.get(key) or 0. for x in group)
+
+    def peak(group, key):
+        values = [x[key] for x in group if x.get(key) is not None]
+        return max(values) if values else np.nan
+
+    names = ['script', 'stage'] + (['night'] if by_night else [])
+    result = table.Table(rows=list(groups.keys()), names=names, dtype=[str]*len(names))
+    groups = list(groups.values())
+    result['n'] = [len(group) for group in groups]
+    result['wall'] = [total(group, 'wall') for group in groups]
+    result['wall_max'] = [peak(group, 'wall') for group in groups]
+    result['cpu'] = [total(group, 'cpu') for group in groups]
+    result['child_cpu'] = [total(group, 'child_cpu') for group in groups]
+    result['rss_mb'] = [peak(group, 'maxrss_mb') for group in groups]
+    result['child_rss_mb'] = [peak(group, 'child_maxrss_mb') for group in groups]
+    result['failed'] = [sum(x.get('status') != 'ok' for x in group) for group in groups]
+    for col in ['wall', 'wall_max', 'cpu', 'child_cpu']:
+        result[col].format = '.2f'
+    for col in ['rss_mb', 'child_rss_mb']:
+        result[col].format = '.0f'
+
+    result.sort('wall', reverse=True)
+    result[:top].pprint(max_lines=-1, max_width=-1)
+    print(' * %d records from %d nights' % (len(rows), len({x['day'] for x in rows})))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,3 +1,6 @@
+import os
+import tempfile
+
 class bcolors:
     HEADER = '\033[95m'
     OKBLUE = '\033[94m'
@@ -8,3 +11,10 @@ class bcolors:
     BOLD = '\033[1m'
     UNDERLINE = '\033[4m'
 
+
+WORK_DIR = 'work'
+
+def make_workdir(prefix):
+    # mkdtemp creates the directory atomically, so parallel jobs never share one
+    os.makedirs(WORK_DIR, exist_ok=True)
+    return tempfile.mkdtemp(prefix=prefix + '.', dir=WORK_DIR)
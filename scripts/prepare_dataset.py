@@ -1,37 +1,129 @@
 #!/usr/bin/env python
 import click
+import csv
+import fnmatch
+import glob
 import os
+import shutil
+import zipfile
+
+import fits_headers
+
+INVENTORY_HEADERS = ['OBJECT', 'DATE-OBS', 'OBS_MODE', 'IMAGETYP', 'FAFLTNM', 'FBFLTNM', 'EXPTIME', 'ALFLTNM',
+                     'STFLTNM', 'AIRMASS', 'PROPID', 'ALAPRTNM', 'ALGRNM', 'NAXIS1', 'NAXIS2']
+
+class _Tee:
+    # File-like object that copies every byte read from src into dst
+    def __init__(self, src, dst):
+        self.src = src
+        self.dst = dst
+
+    def read(self, size=-1):
+        data = self.src.read(size)
+        self.dst.write(data)
+        return data
+
+
+def read_inventory_header(f):
+    # The ALFOSC primary header has no data; the image size lives in the first extension
+    hdr = fits_headers.read_cards(f)
+    missing = [key for key in INVENTORY_HEADERS if key not in hdr]
+    if missing and hdr.get('NAXIS') == 0 and hdr.get('EXTEND'):
+        ext = fits_headers.read_cards(f, missing)
+        hdr.update(ext)
+    return {key: hdr.get(key) for key in INVENTORY_HEADERS}
+
+
+def flattened_name(member, date):
+    # alfosc/A*fits and alfosc/calib/A*fits end up directly in raw/<date>
+    dirname, basename = os.path.split(member)
+    if dirname.strip('/') in ('{date}/alfosc'.format(date=date), '{date}/alfosc/calib'.format(date=date)) \
+            and fnmatch.fnmatch(basename, 'A*fits'):
+        return basename
+    return None
+
+
+def ingest_archive(archive, date, cleanup):
+    # Stream the archive member by member and parse the headers on the fly
+    dest_dir = 'raw/{date}'.format(date=date)
+    os.makedirs(dest_dir, exist_ok=True)
+
+    inventory = {}
+    with zipfile.ZipFile(archive) as zf:
+        for member in zf.infolist():
+            if member.is_dir():
+                continue
+
+            basename = flattened_name(member.filename, date)
+            if basename is None:
+                if cleanup and member.filename.startswith('{date}/alfosc/'.format(date=date)):
+                    continue
+                zf.extract(member, 'raw/')
+                continue
+
+            with zf.open(member) as src, open(os.path.join(dest_dir, basename), 'wb') as dst:
+                inventory[basename] = read_inventory_header(_Tee(src, dst))
+                shutil.copyfileobj(src, dst, 1024*1024)
+
+    return inventory
+
+
+def scan_directory(date):
+    inventory = {}
+    for fname in sorted(glob.glob('raw/{date}/*.fits'.format(date=date))):
+        with open(fname, 'rb') as f:
+            inventory[os.path.basename(fname)] = read_inventory_header(f)
+    return inventory
+
+
+def _format(value):
+    return '' if value is None else str(value)
+
+
+def write_inventory(inventory, date):
+    rows = [['FILE'] + INVENTORY_HEADERS]
+    for fname in sorted(inventory):
+        rows.append([fname] + [_format(inventory[fname][key]) for key in INVENTORY_HEADERS])
+
+    # head.info mimics the 'dfits | fitsort' layout, head.csv is for machines
+    widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+    with open('raw/{date}/head.info'.format(date=date), 'w') as f:
+        for row in rows:
+            f.write('\t'.join(value.ljust(width) for value, width in zip(row, widths)).rstrip() + '\n')
+
+    with open('raw/{date}/head.csv'.format(date=date), 'w', newline='') as f:
+        csv.writer(f).writerows(rows)
+
 
 @click.command()
 @click.argument('date')
 @click.option('--cleanup', is_flag=True, help="Remove unncessary folders and original data archive")
 def main(date, cleanup):
 
-    # Unzip archive
-    os.system('unzip -o raw/{date} -d raw/'.format(date=date))
+    archive = 'raw/{date}.zip'.format(date=date)
 
-    # Flatten directory structure
-    os.system('mv raw/{date}/alfosc/A*fits raw/{date}'.format(date=date))
-    os.system('mv raw/{date}/alfosc/calib/A*fits raw/{date}'.format(date=date))
+    # Unpack archive, flatten directory structure and create inventory in one pass
+    if os.path.isfile(archive):
+        print(' * Unpacking %s' % archive)
+        inventory = ingest_archive(archive, date, cleanup)
+    else:
+        print(' * No archive found. Creating inventory of raw/%s' % date)
+        inventory = scan_directory(date)
+    print(' * Found %d frames' % len(inventory))
 
     # Remove old folder and zip file
     if cleanup:
-        os.system('rm -rf raw/{date}/alfosc')
-        os.system('rm -rf raw/{date}.zip')
-    
-    # Create inventory
-
-    cmd = 'dfits -x 0 raw/{date}/*.fits | fitsort OBJECT DATE-OBS OBS_MODE IMAGETYP FAFLTNM FBFLTNM EXPTIME ALFLTNM STFLTNM AIRMASS PROPID ALAPRTNM ALGRNM NAXIS1 NAXIS2 > raw/{date}/head.info'.format(date=date)
-    
-    try:
-        os.system(cmd)
-
-        # and open with Visual Studio
-        cmd = 'code raw/{date}/head.info'.format(date=date)
-        os.system(cmd)
-
-    except:
-        print('Please check. If seems that you have not installed either dfits, fitsort or Visual studio Code.')
+        shutil.rmtree('raw/{date}/alfosc'.format(date=date), ignore_errors=True)
+        if os.path.isfile(archive):
+            os.remove(archive)
+
+    write_inventory(inventory, date)
+
+    # and open with Visual Studio
+    if shutil.which('code') is None:
+        print('Please check. If seems that you have not installed Visual studio Code.')
+    else:
+        os.system('code raw/{date}/head.info'.format(date=date))
 
 if __name__ == '__main__':
     main()
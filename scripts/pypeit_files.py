@@ -0,0 +1,54 @@
+import functools
+import os
+
+# Helpers to read and patch the .pypeit files written by create_datasets.py
+
+def read_pypeit(fname):
+    """Return the parameters (key = value lines) and the data table rows of a .pypeit file.
+
+    The result is memoized as long as the file does not change; do not modify it.
+    """
+    return _read_pypeit(fname, os.stat(fname).st_mtime_ns)
+
+
+@functools.lru_cache(maxsize=256)
+def _read_pypeit(fname, mtime_ns):
+    params = {}
+    rows = []
+    columns = None
+    with open(fname) as f:
+        for line in f:
+            line = line.strip()
+            if line.startswith('|'):
+                cells = [x.strip() for x in line.split('|')[1:-1]]
+                if columns is None:
+                    columns = cells
+                else:
+                    rows.append(dict(zip(columns, cells)))
+            elif line.startswith('path '):
+                params['path'] = line[5:].strip()
+            elif '=' in line and not line.startswith('#'):
+                key, value = line.split('=', 1)
+                params[key.strip()] = value.strip()
+    return params, rows
+
+
+def science_rows(rows):
+    return [x for x in rows if x['frametype'] == 'science']
+
+
+def calib_frames(rows):
+    return sorted((x['filename'], x['frametype']) for x in rows if x['frametype'] != 'science')
+
+
+def set_param(fname, key, value):
+    # rewrite a 'key = value' line in place, keeping the rest of the file untouched
+    with open(fname) as f:
+        lines = f.readlines()
+    for ii, line in enumerate(lines):
+        if line.split('=', 1)[0].strip() == key:
+            lines[ii] = '%s = %s\n' % (key, value)
+    tmp_fname = fname + '.tmp'
+    with open(tmp_fname, 'w') as f:
+        f.writelines(lines)
+    os.replace(tmp_fname, fname)
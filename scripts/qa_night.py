@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+import click
+import concurrent.futures
+import glob
+import os
+
+import astropy.io.fits as fits
+import jinja2
+import numpy as np
+
+import metrics
+import warm_worker
+from   fits_headers import read_headers
+from   spec1d_catalog import get_catalog
+
+# Batch QA of a night without a display. For every science spec1d file the
+# signal-to-noise ratio and a preview of the spectrum of the selected trace
+# are rendered, and for every standard of the night its sensitivity
+# function. The figures are drawn with the Agg backend in a process pool;
+# long spectra are decimated to the minimum and maximum of every bin, so
+# spikes and absorption lines stay visible. An index page links all figures.
+
+QA_DIR = 'QA'
+MAX_POINTS = 4000
+DPI = 80
+
+INDEX_TEMPLATE = jinja2.Template("""<!DOCTYPE html>
+<html>
+<head><meta charset="utf-8"><title>QA {{ day }}</title>
+<style>body { font-family: sans-serif; } img { width: 32%; } h2 { margin-bottom: 0.2em; }</style>
+</head>
+<body>
+<h1>QA {{ day }}</h1>
+{% if sens %}<h2>Sensitivity functions</h2>
+{% for x in sens %}<a href="{{ x.png }}"><img src="{{ x.png }}" title="{{ x.title }}"></a>
+{% endfor %}{% endif %}
+{% for target, spectra in targets %}<h2>{{ target }}</h2>
+{% for x in spectra %}<p>{{ x.title }}</p>
+{% for png in x.pngs %}<a href="{{ png }}"><img src="{{ png }}"></a>
+{% endfor %}{% endfor %}{% endfor %}
+</body>
+</html>
+""")
+
+def decimate(x, y, max_points=MAX_POINTS):
+    """Reduce (x, y) to at most about max_points, keeping the minimum and maximum of every bin."""
+    n = len(x)
+    if n <= max_points:
+        return x, y
+    size = int(np.ceil(2.*n/max_points))
+    n_full = n//size*size
+
+    blocks = y[:n_full].reshape(-1, size)
+    finite = np.isfinite(blocks)
+    offset = np.arange(0, n_full, size)
+    imin = np.argmin(np.where(finite, blocks, np.inf), axis=1) + offset
+    imax = np.argmax(np.where(finite, blocks, -np.inf), axis=1) + offset
+
+    idx = np.sort(np.concatenate([imin, imax, np.arange(n_full, n)]))
+    return x[idx], y[idx]
+
+
+def load_trace(fname, trace):
+    # flux and inverse variance of a trace, fluxed if available
+    data = fits.getdata(fname, trace)
+    names = data.columns.names
+    prefix = 'OPT_FLAM' if 'OPT_FLAM' in names else 'OPT_COUNTS'
+    wave = np.asarray(data['OPT_WAVE'], dtype=float)
+    flux = np.asarray(data[prefix], dtype=float)
+    ivar = np.asarray(data[prefix + '_IVAR'], dtype=float)
+    order = np.argsort(wave, kind='stable')
+    return wave[order], flux[order], ivar[order], prefix == 'OPT_FLAM'
+
+
+def render_spectrum(fname, trace, snr_png, flux_png, wlen_min, max_points):
+    import matplotlib.pyplot as plt
+    wave, flux, ivar, fluxed = load_trace(fname, trace)
+    idx = wave > wlen_min
+    snr = flux*np.sqrt(np.clip(ivar, 0, None))
+
+    for png, values, ylabel in ((snr_png, snr, 'Signal-to-noise ratio'),
+                                (flux_png, flux, '$F_\\lambda$' if fluxed else 'Counts')):
+        fig = plt.figure(figsize=(9*np.sqrt(2), 9))
+        ax = fig.add_subplot(111)
+        ax.plot(*decimate(wave[idx], values[idx], max_points), color='tab:blue', lw=1)
+        ax.set_xlabel('Wavelength $\\left({\\rm vacuum,\\,\\AA}\\right)$')
+        ax.set_ylabel(ylabel)
+        ax.set_title('%s [%s]' % (os.path.basename(fname), trace), fontsize=16)
+        fig.savefig(png, dpi=DPI)
+        plt.close(fig)
+
+
+def render_sens(fname, png, wlen_min, max_points):
+    import matplotlib.pyplot as plt
+    data = fits.getdata(fname, 1)
+    wave = np.atleast_2d(data['SENS_WAVE'])[0]
+    zeropoint = np.atleast_2d(data['SENS_ZEROPOINT'])[0]
+    idx = wave > wlen_min
+
+    fig = plt.figure(figsize=(9*np.sqrt(2), 9))
+    ax = fig.add_subplot(111)
+    ax.plot(*decimate(wave[idx], zeropoint[idx], max_points), color='tab:blue', lw=2)
+    ax.set_xlabel('Wavelength $\\left({\\rm vacuum,\\,\\AA}\\right)$')
+    ax.set_ylabel('Sensivity function')
+    ax.set_title(os.path.basename(fname), fontsize=16)
+    fig.savefig(png, dpi=DPI)
+    plt.close(fig)
+
+
+def render_batch(jobs, wlen_min, max_points):
+    # worker process: plotsettings for the looks of the figures, Agg for speed
+    import matplotlib
+    matplotlib.use('Agg')
+    import plotsettings  # noqa: F401
+
+    failed = []
+    for job in jobs:
+        try:
+            with metrics.span('render_%s' % job[0], metrics.night_of(job[1])):
+                if job[0] == 'sens':
+                    render_sens(job[1], job[2], wlen_min, max_points)
+                else:
+                    render_spectrum(job[1], job[2], job[3], job[4], wlen_min, max_points)
+        except (OSError, KeyError, ValueError) as e:
+            print(' * ERR: cannot render %s: %s' % (job[1], e))
+            failed.append(job[1])
+    return failed
+
+
+def up_to_date(png, fname):
+    return os.path.isfile(png) and os.path.getmtime(png) >= os.path.getmtime(fname)
+
+
+def night_sens(day):
+    # sens files of the standards observed in this night, named after their MJD
+    frames = sorted(glob.glob('sci/%s-STD-*/spec1d*.fits' % day))
+    sens = ['sens/%.4f.fits' % hdr['MJD'] for hdr in read_headers(frames, ['MJD']) if hdr.get('MJD') is not None]
+    return [x for x in sens if os.path.isfile(x)]
+
+
+@click.command()
+@click.argument('day')
+@click.option('--objid', default=None, help="Trace to show, default is the trace closest to pixel 250")
+@click.option('--jobs', type=click.IntRange(min=1), default=4, help="Number of rendering processes")
+@click.option('--max-points', type=int, default=MAX_POINTS, help="Maximum number of points per curve")
+@click.option('--wlen-min', type=float, default=3000)
+@click.option('--overwrite', is_flag=True, help="Render figures again even if they are up to date")
+def main(day, objid, jobs, max_points, wlen_min, overwrite):
+    qa_dir = os.path.join(QA_DIR, day)
+    os.makedirs(qa_dir, exist_ok=True)
+
+    spectra = sorted(f for f in glob.glob('sci/%s-*/spec1d*.fits' % day) if '-STD-' not in f)
+    sens = night_sens(day)
+    print(' * %d spectra and %d sensitivity functions for %s' % (len(spectra), len(sens), day))
+
+    with metrics.span('select_traces', day, n_spectra=len(spectra)):
+        traces = get_catalog(spectra=spectra).select(spectra, objid) if spectra else []
+
+    todo = []
+    sens_entries = []
+    for fname in sens:
+        png = os.path.basename(fname).replace('.fits', '_sens.png')
+        sens_entries.append({'png': png, 'title': fname})
+        if overwrite or not up_to_date(os.path.join(qa_dir, png), fname):
+            todo.append(('sens', fname, os.path.join(qa_dir, png)))
+
+    targets = {}
+    for fname, trace in zip(spectra, traces):
+        # spectra without trace table (coadds) are shown with their first extension
+        trace = trace or 1
+        base = os.path.basename(fname).replace('.fits', '')
+        pngs = [base + '_snr.png', base + '_flux.png']
+        targets.setdefault(os.path.basename(os.path.dirname(fname)), []).append({'pngs': pngs, 'title': '%s [%s]' % (fname, trace)})
+        if overwrite or not all(up_to_date(os.path.join(qa_dir, png), fname) for png in pngs):
+            todo.append(('spectrum', fname, trace, os.path.join(qa_dir, pngs[0]), os.path.join(qa_dir, pngs[1])))
+
+    print(' * Rendering %d figures' % len(todo))
+    failed = []
+    if todo:
+        if warm_worker.in_process(jobs):
+            failed = render_batch(todo, wlen_min, max_points)
+        else:
+            chunks = [todo[i::jobs] for i in range(jobs) if todo[i::jobs]]
+            with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as pool:
+                for result in pool.map(render_batch, chunks, [wlen_min]*len(chunks), [max_points]*len(chunks)):
+                    failed += result
+
+    index = os.path.join(qa_dir, 'index.html')
+    with open(index, 'w') as f:
+        f.write(INDEX_TEMPLATE.render(day=day, sens=sens_entries, targets=sorted(targets.items())))
+    print(' * QA page written to %s' % index)
+
+    if failed:
+        raise click.ClickException('%d figures could not be rendered' % len(failed))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,212 @@
+#!/usr/bin/env python
+import asyncio
+import click
+import datetime
+import glob
+import os
+
+import calib_store
+import metrics
+from   header_index import get_header
+from   job_runner import Job, JobRunner, format_duration
+from   pypeit_files import read_pypeit, calib_frames, science_rows, set_param
+from   runtime_history import RuntimeHistory, dataset_features
+
+# Reduce all datasets of a night. Datasets with identical calibration frames
+# share one directory in the calibration store: the calibrations are
+# processed once with 'run_pypeit -c' and the science reductions of the
+# group run afterwards, reusing the calibration products. Calibration sets
+# that are already complete in the store are not processed again. The bias
+# and flat stacks are shared between calibration sets as well: the first
+# set that needs one builds it, the others wait for it and link it. The
+# run_pypeit sessions are started by a JobRunner; their output goes to
+# logs/<night>/. The runtime and memory of every session are predicted from
+# the runtime history: the longest chains of work start first and the
+# sessions are packed under the memory budget. Every session is added to
+# the history afterwards.
+
+def store_dir(params, rows):
+    # datasets written before the calibration store are moved into it; DETWIN1
+    # of the science frames, as in create_datasets.py
+    sci = science_rows(rows)[-1]
+    calibs = calib_frames(rows)
+    detwin1 = get_header(os.path.join(params['path'], sci['filename']))['DETWIN1']
+    return calib_store.calib_dir(calib_store.calib_key(calibs, detwin1, sci['dispname'], sci['decker'], sci['binning']))
+
+
+def dataset_components(fname):
+    """(kind, key) of the bias and flat stacks of a dataset that can be shared with other calibration sets."""
+    params, rows = read_pypeit(fname)
+    sci = science_rows(rows)[-1]
+    detwin1 = get_header(os.path.join(params['path'], sci['filename']))['DETWIN1']
+    calibs = calib_frames(rows)
+    bias = [f for f, t in calibs if 'bias' in t.split(',')]
+    flats = [f for f, t in calibs if {'pixelflat', 'illumflat', 'trace'} & set(t.split(','))]
+    components = []
+    if bias:
+        components.append(('bias', calib_store.bias_key(bias, detwin1, sci['binning'])))
+    if flats:
+        components.append(('flat', calib_store.flat_key(flats, sci['dispname'], sci['decker'], detwin1, sci['binning'])))
+    return components
+
+
+class SharedComponents:
+    """Bias and flat stacks being built by the calibration sets of this process."""
+
+    def __init__(self):
+        # (kind, key) -> event set once the building calibration set finished
+        self.building = {}
+
+    async def prepare(self, calib_dir, components):
+        """Link the components that are in the store into calib_dir. Returns the components calib_dir has to build.
+
+        A component that another calibration set is building is waited for. The
+        components are always taken in the same order (bias before flats), so
+        no two calibration sets wait for each other.
+        """
+        claimed = []
+        for component in components:
+            while not calib_store.link_component(*component, calib_dir):
+                if component not in self.building:
+                    self.building[component] = asyncio.Event()
+                    claimed.append(component)
+                    break
+                # if the other set fails, the component is claimed again
+                await self.building[component].wait()
+        return claimed
+
+    def publish(self, calib_dir, claimed, ok):
+        for component in claimed:
+            if ok:
+                calib_store.publish_component(*component, calib_dir)
+            self.building.pop(component).set()
+
+
+def group_datasets(datasets, dry_run):
+    groups = {}
+    for fname in datasets:
+        params, rows = read_pypeit(fname)
+        calib_dir = params['calib_dir']
+        if not calib_store.is_store_dir(calib_dir):
+            calib_dir = store_dir(params, rows)
+            print(' * %s: moving calibrations to %s' % (fname, calib_dir))
+            if not dry_run:
+                set_param(fname, 'calib_dir', calib_dir)
+        groups.setdefault(calib_dir, []).append(fname)
+    return groups
+
+
+def pypeit_job(fname, model, features, calibs=False, timeout=None):
+    stage = 'run_pypeit_calibs' if calibs else 'run_pypeit'
+    wall, memory = model.predict(features, stage)
+    return Job(['run_pypeit', fname] + (['-c'] if calibs else []), stage, fname, timeout=timeout,
+               priority=wall, cost=wall, memory=memory)
+
+
+def plan_jobs(groups, todo, model, features, timeout=None):
+    """The calibration job (None if in the store) and the science jobs of every calibration set."""
+    plan = {}
+    for calib_dir, members in groups.items():
+        science = [pypeit_job(fname, model, features[fname], timeout=timeout) for fname in members]
+        calibs = None
+        if calib_dir in todo:
+            # the calibrations get the priority of the whole chain they unblock
+            calibs = pypeit_job(members[0], model, features[members[0]], True, timeout)
+            calibs.priority = calibs.cost + max(x.cost for x in science)
+        plan[calib_dir] = (calibs, science)
+    return plan
+
+
+def expected_makespan(plan, jobs):
+    # lower bound of the wall time: the total work spread over all slots, or the longest chain
+    work = sum(x.cost for calibs, science in plan.values() for x in [calibs] + science if x is not None)
+    chain = max((x.cost + (calibs.cost if calibs else 0.) for calibs, science in plan.values() for x in science), default=0.)
+    return max(work/jobs, chain)
+
+
+async def run_recorded(runner, history, features, job):
+    # run a session and add it to the runtime history
+    result = await runner.run(job)
+    history.record(job.name, job.stage, features, result.wall, result.maxrss_mb, result.returncode)
+    return result
+
+
+async def reduce_group(runner, history, features, shared, calib_dir, calibs, science):
+    """Reduce the datasets of one calibration set. Returns the datasets that failed."""
+    members = [x.name for x in science]
+    with calib_store.in_use(calib_dir):
+        if calibs is not None:
+            claimed = await shared.prepare(calib_dir, dataset_components(calibs.name))
+            result = await run_recorded(runner, history, features[calibs.name], calibs)
+            shared.publish(calib_dir, claimed, result.ok)
+            if not result.ok:
+                print(' * Calibrations failed for %s' % ', '.join(members))
+                return members
+            calib_store.mark_complete(calib_dir)
+        else:
+            calib_store.touch(calib_dir)
+
+        # fan out the science reductions once the calibrations exist
+        results = await asyncio.gather(*[run_recorded(runner, history, features[job.name], job) for job in science])
+    return [job.name for job, result in zip(science, results) if not result.ok]
+
+
+async def reduce_groups(runner, history, features, plan):
+    # the longest chains come first, so they build the shared bias and flat stacks
+    shared = SharedComponents()
+    order = sorted(plan, key=lambda x: -plan[x][0].priority if plan[x][0] else 0.)
+    failed = await asyncio.gather(*[reduce_group(runner, history, features, shared, calib_dir, *plan[calib_dir])
+                                    for calib_dir in order])
+    return sum(failed, [])
+
+
+@click.command()
+@click.argument('day')
+@click.option('--jobs', type=click.IntRange(min=1), default=8, help="Maximum number of parallel run_pypeit sessions")
+@click.option('--dry-run', is_flag=True, help="Only show the execution plan")
+@click.option('--timeout', type=float, default=None, help="Stop a run_pypeit session after this many seconds (default: no limit)")
+@click.option('--memory', default=None, help="Memory budget for all run_pypeit sessions, e.g. 64G (default: no limit)")
+def main(day, jobs, dry_run, timeout, memory):
+    datasets = sorted(glob.glob('datasets/%s-*.pypeit' % day))
+    print(' * Found %d datasets for %s' % (len(datasets), day))
+
+    with metrics.span('group_datasets', day, n_datasets=len(datasets)):
+        groups = group_datasets(datasets, dry_run)
+    done = [calib_dir for calib_dir in groups if calib_store.is_complete(calib_dir)]
+    todo = [calib_dir for calib_dir in groups if not calib_store.is_complete(calib_dir)]
+    print(' * %d calibration sets, %d of them already in the store' % (len(groups), len(done)))
+    components = {x for calib_dir in todo for x in dataset_components(groups[calib_dir][0])}
+    print(' * %d calibration sets to build share %d bias and %d flat stacks, %d of them in the store'
+          % (len(todo), sum(x[0] == 'bias' for x in components), sum(x[0] == 'flat' for x in components),
+             sum(calib_store.is_complete(calib_store.component_dir(*x)) for x in components)))
+
+    with metrics.span('cost_model', day, n_datasets=len(datasets)):
+        history = RuntimeHistory()
+        model = history.model()
+        features = {fname: dataset_features(fname) for fname in datasets}
+        plan = plan_jobs(groups, todo, model, features, timeout)
+
+    for calib_dir in sorted(groups):
+        state = 'reuse' if calib_dir in done else 'build'
+        print(' * %s (%s): %s' % (calib_dir, state, ', '.join(groups[calib_dir])))
+        calibs, science = plan[calib_dir]
+        for job in ([calibs] if calibs else []) + science:
+            print('   * %-60s %s %6.0f MB' % (' '.join(job.cmd), format_duration(job.cost), job.memory))
+
+    makespan = expected_makespan(plan, jobs)
+    until = datetime.datetime.now() + datetime.timedelta(seconds=makespan)
+    print(' * Expected duration with %d sessions: %s (until %s), cost model fitted to %d reductions'
+          % (jobs, format_duration(makespan), until.strftime('%H:%M'), model.n_runs))
+
+    if dry_run:
+        return
+
+    runner = JobRunner(jobs, memory=calib_store.parse_size(memory)/1024.**2 if memory else None)
+    failed = runner.execute(reduce_groups(runner, history, features, plan))
+
+    print(' * Done. %d datasets failed' % len(failed))
+    for fname in failed:
+        print('   * %s' % fname)
+
+if __name__ == '__main__':
+    main()
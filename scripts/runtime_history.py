@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+import click
+import contextlib
+import datetime
+import os
+import sqlite3
+
+import numpy as np
+
+import metrics
+from   header_index import get_header
+from   pypeit_files import read_pypeit, science_rows
+
+# History of the run_pypeit sessions and a cost model fitted to it. Every
+# reduction is recorded with its wall time, its peak memory and the inputs
+# that drive them: the number of frames of every frametype and the setup
+# (grism, slit, DETWIN1, binning) of the .pypeit file. The cost model is a
+# ridge regression of the logarithm of the wall time and of the peak memory
+# on these inputs; it predicts the cost of new datasets for scheduling.
+
+HISTORY_FILE = os.path.join(metrics.METRICS_DIR, 'runtime_history.sqlite')
+
+FRAMETYPES = ['bias', 'arc', 'tilt', 'pixelflat', 'illumflat', 'trace', 'science', 'standard']
+SETUP = ['dispname', 'decker', 'detwin1', 'binning']
+
+# predictions without any history
+DEFAULT_WALL = 900.
+DEFAULT_MEMORY = 4000.
+
+# regularization of the fit, pulls setups with few runs towards the average
+RIDGE = 1.
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    time       TEXT NOT NULL,
+    dataset    TEXT NOT NULL,
+    stage      TEXT NOT NULL,
+    %s,
+    dispname   TEXT,
+    decker     TEXT,
+    detwin1    TEXT,
+    binning    TEXT,
+    wall       REAL NOT NULL,
+    maxrss_mb  REAL,
+    returncode INTEGER NOT NULL
+);
+""" % ',\n    '.join('n_%s INTEGER NOT NULL' % x for x in FRAMETYPES)
+
+def dataset_features(fname):
+    """Number of frames per frametype and the setup of a .pypeit file."""
+    params, rows = read_pypeit(fname)
+    features = {'n_%s' % x: 0 for x in FRAMETYPES}
+    for row in rows:
+        for frametype in row['frametype'].split(','):
+            if frametype in FRAMETYPES:
+                features['n_%s' % frametype] += 1
+
+    setup = (science_rows(rows) or rows)[-1] if rows else {}
+    for key in ('dispname', 'decker', 'binning'):
+        features[key] = setup.get(key)
+
+    # DETWIN1 is not in the table, it is taken from the raw header of the science frame as in create_datasets.py
+    try:
+        features['detwin1'] = str(get_header(os.path.join(params['path'], setup['filename']))['DETWIN1'])
+    except (KeyError, OSError):
+        features['detwin1'] = None
+    return features
+
+
+class CostModel:
+    """Expected wall time (s) and peak memory (MB) of a reduction."""
+
+    def __init__(self, runs):
+        self.n_runs = len(runs)
+        self.levels = [(key, sorted({str(x[key]) for x in runs})) for key in ['stage'] + SETUP]
+        if not runs:
+            return
+        X = np.array([self._vector(x) for x in runs])
+        self.wall_coef = self._fit(X, np.log([max(x['wall'], 1e-3) for x in runs]))
+        memory = [x for x in runs if x['maxrss_mb']]
+        self.memory_coef = self._fit(np.array([self._vector(x) for x in memory]), np.log([x['maxrss_mb'] for x in memory])) if memory else None
+
+    def _vector(self, features):
+        # log of the frame counts, one-hot encoded stage and setup; unknown setups only get the average
+        x = [1.] + [np.log1p(features['n_%s' % t]) for t in FRAMETYPES]
+        for key, levels in self.levels:
+            x += [float(str(features.get(key)) == level) for level in levels]
+        return x
+
+    @staticmethod
+    def _fit(X, y):
+        # ridge regression, the intercept is not regularized
+        penalty = RIDGE*np.eye(X.shape[1])
+        penalty[0, 0] = 0.
+        return np.linalg.solve(X.T @ X + penalty, X.T @ y)
+
+    def predict(self, features, stage):
+        """(wall time, peak memory) of a dataset with these features."""
+        if not self.n_runs:
+            return DEFAULT_WALL, DEFAULT_MEMORY
+        x = np.array(self._vector(dict(features, stage=stage)))
+        wall = float(np.exp(x @ self.wall_coef))
+        memory = float(np.exp(x @ self.memory_coef)) if self.memory_coef is not None else DEFAULT_MEMORY
+        return wall, memory
+
+
+class RuntimeHistory:
+
+    def __init__(self, history_file=HISTORY_FILE):
+        self.history_file = history_file
+
+    def _connect(self):
+        os.makedirs(os.path.dirname(self.history_file) or '.', exist_ok=True)
+        con = sqlite3.connect(self.history_file, timeout=60)
+        con.row_factory = sqlite3.Row
+        con.executescript(SCHEMA)
+        return con
+
+    def record(self, dataset, stage, features, wall, maxrss_mb, returncode):
+        columns = ['n_%s' % x for x in FRAMETYPES] + SETUP
+        values = [datetime.datetime.now().isoformat(timespec='seconds'), dataset, stage] + [features[x] for x in columns]
+        values += [wall, maxrss_mb, returncode]
+        with contextlib.closing(self._connect()) as con:
+            con.execute('INSERT INTO runs (time, dataset, stage, %s, wall, maxrss_mb, returncode) VALUES (%s)'
+                        % (', '.join(columns), ', '.join('?'*len(values))), values)
+            con.commit()
+
+    def runs(self, successful=True):
+        with contextlib.closing(self._connect()) as con:
+            query = 'SELECT * FROM runs' + (' WHERE returncode = 0' if successful else '') + ' ORDER BY time'
+            return [dict(x) for x in con.execute(query)]
+
+    def model(self):
+        return CostModel(self.runs())
+
+
+@click.group()
+def main():
+    pass
+
+
+@main.command()
+@click.option('--last', type=int, default=20, help="Number of runs to show")
+def show(last):
+    """List the recorded reductions."""
+    import astropy.table as table
+    runs = RuntimeHistory().runs(successful=False)
+    if not runs:
+        raise click.ClickException('No reductions recorded in %s' % HISTORY_FILE)
+    result = table.Table(rows=[[x[key] for key in runs[0]] for x in runs[-last:]], names=list(runs[0]))
+    result['wall'].format = '.1f'
+    result.pprint(max_lines=-1, max_width=-1)
+    print(' * %d reductions recorded' % len(runs))
+
+
+@main.command()
+@click.argument('datasets', nargs=-1, required=True)
+def predict(datasets):
+    """Expected wall time and peak memory of .pypeit files."""
+    model = RuntimeHistory().model()
+    print(' * Cost model fitted to %d reductions' % model.n_runs)
+    for fname in datasets:
+        features = dataset_features(fname)
+        for stage in ('run_pypeit_calibs', 'run_pypeit'):
+            wall, memory = model.predict(features, stage)
+            print(' * %-40s %-18s %8.0f s %8.0f MB' % (fname, stage, wall, memory))
+
+if __name__ == '__main__':
+    main()
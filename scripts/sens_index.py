@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+import click
+import contextlib
+import glob
+import os
+import sqlite3
+
+import numpy as np
+
+from   fits_headers import read_header, read_headers
+from   sensfunc_build import read_provenance
+
+# Persistent index of the sensitivity functions in sens/. For every sens
+# file we record the MJD, grism, slit, standard star and airmass of the
+# standard it was derived from: the spec1d file recorded when the sens file
+# was built (sens/<mjd>.json), otherwise the standard with the same MJD.
+# Files are keyed by size and mtime, so only new or modified sens files are
+# read again. get_sens_index keeps the index in memory for later commands of
+# the same process (the warm worker).
+
+INDEX_NAME = '.sens_index.sqlite'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sens (
+    filename TEXT PRIMARY KEY,
+    size     INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    mjd      REAL NOT NULL,
+    grism    TEXT,
+    slit     TEXT,
+    std_name TEXT,
+    airmass  REAL
+)
+"""
+
+SETUP_KEYWORDS = ['MJD', 'DISPNAME', 'DECKER', 'TARGET', 'AIRMASS']
+
+def normalize_grism(grism):
+    return None if grism is None else str(grism).replace('#', '')
+
+
+def _mjd_from_filename(fname):
+    try:
+        return float(os.path.basename(fname).replace('.fits', ''))
+    except ValueError:
+        return None
+
+
+def std_headers():
+    # the sens files are named after the MJD of the standard, '%.4f' % MJD
+    frames = glob.glob('sci/*-STD-*/spec1d*.fits')
+    return {'%.4f' % hdr['MJD']: hdr for hdr in read_headers(frames, SETUP_KEYWORDS) if hdr.get('MJD') is not None}
+
+
+def describe(fname, standards):
+    hdr = read_header(fname, SETUP_KEYWORDS)
+    provenance = read_provenance(fname)
+    recorded = {}
+    if provenance is not None and os.path.isfile(provenance['spec1d']):
+        recorded = read_header(provenance['spec1d'], SETUP_KEYWORDS)
+
+    mjd = next((x for x in (hdr.get('MJD'), recorded.get('MJD'), _mjd_from_filename(fname)) if x is not None), None)
+    if mjd is None:
+        return None
+
+    # fill in what the sens file does not record from the standard's spec1d header
+    std = standards.get('%.4f' % mjd, {})
+    for key in SETUP_KEYWORDS:
+        if hdr.get(key) is None:
+            hdr[key] = recorded[key] if recorded.get(key) is not None else std.get(key)
+
+    return (float(mjd), normalize_grism(hdr['DISPNAME']), hdr['DECKER'], hdr['TARGET'], hdr['AIRMASS'])
+
+
+class SensIndex:
+
+    def __init__(self, sens_dir='sens'):
+        self.location = sens_dir
+        self.index_file = os.path.join(sens_dir, INDEX_NAME)
+        self._on_disk = None
+        self.refresh()
+
+    def _connect(self):
+        con = sqlite3.connect(self.index_file, timeout=60)
+        con.execute(SCHEMA)
+        return con
+
+    def refresh(self):
+        on_disk = {}
+        for fname in glob.glob(os.path.join(self.location, '*.fits')):
+            st = os.stat(fname)
+            on_disk[os.path.basename(fname)] = (st.st_size, st.st_mtime_ns)
+        if on_disk == self._on_disk:
+            return
+
+        with contextlib.closing(self._connect()) as con:
+            known = {row[0]: (row[1], row[2]) for row in con.execute('SELECT filename, size, mtime_ns FROM sens')}
+            changed = sorted(f for f, stat in on_disk.items() if known.get(f) != stat)
+            removed = [f for f in known if f not in on_disk]
+
+            if changed:
+                standards = std_headers()
+                for f in changed:
+                    entry = describe(os.path.join(self.location, f), standards)
+                    if entry is None:
+                        print(' * WARNING: cannot determine the MJD of %s. Ignoring it.' % f)
+                        con.execute('DELETE FROM sens WHERE filename = ?', (f,))
+                        continue
+                    con.execute('INSERT OR REPLACE INTO sens VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                                (f, on_disk[f][0], on_disk[f][1]) + entry)
+            if removed:
+                con.executemany('DELETE FROM sens WHERE filename = ?', [(f,) for f in removed])
+            con.commit()
+
+            rows = con.execute('SELECT filename, mjd, grism, slit, std_name, airmass FROM sens ORDER BY mjd').fetchall()
+
+        self.filename = np.array([os.path.join(self.location, x[0]) for x in rows], dtype=object)
+        self.mjd = np.array([x[1] for x in rows], dtype=float)
+        self.grism = np.array([x[2] for x in rows], dtype=object)
+        self.slit = np.array([x[3] for x in rows], dtype=object)
+        self.std_name = np.array([x[4] for x in rows], dtype=object)
+        self.airmass = np.array([x[5] if x[5] is not None else np.nan for x in rows], dtype=float)
+        self._on_disk = on_disk
+
+    def __len__(self):
+        return len(self.mjd)
+
+    def _candidates(self, grism, slit, allow_any_grism=False):
+        # restrict to the setup, relaxing the slit if nothing matches
+        same_grism = np.ones(len(self), dtype=bool) if grism is None else self.grism == normalize_grism(grism)
+        same_slit = np.ones(len(self), dtype=bool) if slit is None else self.slit == slit
+        for mask in (same_grism & same_slit, same_grism):
+            if np.any(mask):
+                return np.flatnonzero(mask)
+        if not allow_any_grism:
+            raise ValueError('No sensitivity function for grism %s in %s' % (grism, self.location))
+        print(' * WARNING: no sensitivity function for grism %s, using the other grisms' % grism)
+        return np.arange(len(self))
+
+    def match(self, mjds, grisms=None, slits=None, allow_any_grism=False):
+        """Resolve many frames to the sens file closest in time with the same setup.
+
+        Frames are grouped by setup and each group is matched with a single
+        searchsorted over the (sorted) MJDs of the candidate sens files. A
+        ValueError is raised if there is no sens file for the grism of a
+        frame, unless allow_any_grism is set.
+        """
+        if len(self) == 0:
+            raise ValueError('No sensitivity functions found in %s' % self.location)
+
+        mjds = np.asarray(mjds, dtype=float)
+        grisms = [None]*len(mjds) if grisms is None else [normalize_grism(x) for x in grisms]
+        slits = [None]*len(mjds) if slits is None else list(slits)
+
+        result = np.empty(len(mjds), dtype=object)
+        setups = {}
+        for ii, setup in enumerate(zip(grisms, slits)):
+            setups.setdefault(setup, []).append(ii)
+
+        for (grism, slit), members in setups.items():
+            members = np.array(members)
+            cand = self._candidates(grism, slit, allow_any_grism)
+            cand_mjd = self.mjd[cand]
+            right = np.clip(np.searchsorted(cand_mjd, mjds[members]), 0, len(cand)-1)
+            left = np.clip(right-1, 0, len(cand)-1)
+            closer_left = np.abs(mjds[members] - cand_mjd[left]) <= np.abs(mjds[members] - cand_mjd[right])
+            result[members] = self.filename[cand[np.where(closer_left, left, right)]]
+
+        return list(result)
+
+    def lookup(self, mjd, grism=None, slit=None, allow_any_grism=False):
+        return self.match([mjd], [grism], [slit], allow_any_grism)[0]
+
+
+_indexes = {}
+
+def get_sens_index(sens_dir='sens'):
+    """SensIndex of sens_dir, read again only if sens files were added, removed or modified."""
+    if sens_dir not in _indexes:
+        _indexes[sens_dir] = SensIndex(sens_dir)
+    else:
+        _indexes[sens_dir].refresh()
+    return _indexes[sens_dir]
+
+
+@click.command()
+@click.option('--sens-dir', default='sens')
+def main(sens_dir):
+    index = get_sens_index(sens_dir)
+    for ii in range(len(index)):
+        print('%s %.4f %s %s %s %.3f' % (index.filename[ii], index.mjd[ii], index.grism[ii], index.slit[ii],
+                                         index.std_name[ii], index.airmass[ii]))
+    print(' * %d sensitivity functions indexed' % len(index))
+
+if __name__ == '__main__':
+    main()
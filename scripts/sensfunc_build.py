@@ -0,0 +1,94 @@
+import hashlib
+import json
+import os
+
+import metrics
+from   fits_headers import read_headers
+from   job_runner import Job, JobRunner
+
+# Build the sensitivity functions of a list of standard star spec1d frames.
+# The inputs of every sens file (spec1d file and sensfunc parameters) are
+# recorded in a JSON file next to it, so unchanged standards are skipped
+# when the build is repeated. The pypeit_sensfunc sessions run in a
+# JobRunner, the log of every session is written next to its sens file.
+# With the debug plots the sessions run one after the other in the
+# terminal instead, so the user can answer their prompts.
+
+SENSFUNC_PAR = 'etc/sensfunc.par'
+
+def input_hash(frame, par_file=SENSFUNC_PAR):
+    sha = hashlib.sha1()
+    for fname in (frame, par_file):
+        with open(fname, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024*1024), b''):
+                sha.update(chunk)
+    return sha.hexdigest()
+
+
+def provenance_file(dest_path):
+    return os.path.splitext(dest_path)[0] + '.json'
+
+
+def read_provenance(dest_path):
+    fname = provenance_file(dest_path)
+    if not os.path.isfile(fname):
+        return None
+    with open(fname) as f:
+        return json.load(f)
+
+
+def write_provenance(dest_path, frame, digest, par_file=SENSFUNC_PAR):
+    with open(provenance_file(dest_path), 'w') as f:
+        json.dump({'spec1d': frame, 'par_file': par_file, 'hash': digest}, f, indent=1)
+
+
+def sensfunc_job(frame, dest_path, debug, par_file=SENSFUNC_PAR, timeout=None):
+    cmd = ['pypeit_sensfunc', '-s', par_file, frame, '-o', dest_path]
+    if debug:
+        cmd.append('--debug')
+    return Job(cmd, 'pypeit_sensfunc', frame, os.path.splitext(dest_path)[0] + '.log', timeout=timeout)
+
+
+def build_sensfuncs(frames, overwrite, jobs=1, debug=False, par_file=SENSFUNC_PAR, timeout=None):
+    """Run pypeit_sensfunc for all frames whose inputs changed.
+
+    Sessions running longer than timeout seconds are stopped. Returns the
+    list of frames that could not be built.
+    """
+    todo = []
+    failed = []
+    for frame, hdr in zip(frames, read_headers(frames, ['MJD'])):
+        dest_path = 'sens/%.4f.fits' % hdr['MJD']
+        digest = input_hash(frame, par_file)
+
+        if os.path.isfile(dest_path):
+            provenance = read_provenance(dest_path)
+            if provenance is not None and provenance['hash'] == digest:
+                print(' * %s -> %s is up to date. Skipping' % (frame, dest_path))
+                continue
+            if overwrite == False:
+                if provenance is None:
+                    print(' * %s -> %s already exists. Skipping' % (frame, dest_path))
+                else:
+                    print(' * ERR: %s -> %s already exists, but its inputs changed. Use --overwrite' % (frame, dest_path))
+                    failed.append(frame)
+                continue
+            print(' * %s -> %s already exists, but will be overwritten.' % (frame, dest_path))
+        else:
+            print(' * %s -> %s' % (frame, dest_path))
+
+        todo.append((frame, dest_path, digest))
+
+    sessions = [sensfunc_job(frame, dest_path, debug, par_file) for frame, dest_path, _ in todo]
+    if debug:
+        # the debug plots wait for the user: in the terminal and not timed out
+        returncodes = [metrics.run_process(job.cmd, job.stage, job.day) for job in sessions]
+    else:
+        returncodes = [result.returncode for result in JobRunner(jobs, timeout).run_all(sessions)]
+    for (frame, dest_path, digest), returncode in zip(todo, returncodes):
+        if returncode == 0:
+            write_provenance(dest_path, frame, digest, par_file)
+        else:
+            failed.append(frame)
+
+    return failed
@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+import click
+import contextlib
+import glob
+import os
+import sqlite3
+
+import numpy as np
+
+# Persistent catalog of all traces extracted by PypeIt. The .txt file next to
+# every spec1d file lists its traces; the catalog keeps them in one table,
+# keyed by the size and mtime of the .txt file, so only new or modified
+# reductions are parsed again. Trace selection for many spectra is then a
+# single query over the columns of the catalog. get_catalog keeps the catalog
+# in memory for later commands of the same process (the warm worker).
+
+CATALOG_NAME = '.spec1d_catalog.sqlite'
+
+# the trace closest to this spatial pixel is selected by default
+CENTER_PIXPOS = 250
+
+COLUMNS = ['slit', 'name', 'spat_pixpos', 'spat_fracpos', 'box_width', 'opt_fwhm', 's2n']
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    filename TEXT PRIMARY KEY,
+    size     INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS traces (
+    filename     TEXT NOT NULL,
+    objid        INTEGER NOT NULL,
+    slit         INTEGER,
+    name         TEXT NOT NULL,
+    spat_pixpos  REAL,
+    spat_fracpos REAL,
+    box_width    REAL,
+    opt_fwhm     REAL,
+    s2n          REAL,
+    PRIMARY KEY (filename, objid)
+);
+"""
+
+def trace_file(fname):
+    return fname.replace('.fits', '.txt')
+
+
+def read_traces(fname_txt):
+    import astropy.table as table
+    cat = table.Table.read(fname_txt, format='ascii.fixed_width')
+    return [(ii,) + tuple(row[col] if col in cat.colnames else None for col in COLUMNS) for ii, row in enumerate(cat)]
+
+
+def _value(x):
+    # numpy scalars -> python, masked -> NULL
+    if x is None or np.ma.is_masked(x):
+        return None
+    return x.item() if hasattr(x, 'item') else x
+
+
+class Spec1dCatalog:
+
+    def __init__(self, sci_dir='sci', spectra=()):
+        self.location = sci_dir
+        self.catalog_file = os.path.join(sci_dir, CATALOG_NAME)
+        self._on_disk = None
+        self.refresh(spectra)
+
+    def _connect(self):
+        con = sqlite3.connect(self.catalog_file, timeout=60)
+        con.executescript(SCHEMA)
+        return con
+
+    def refresh(self, spectra=()):
+        """Update the catalog for all reductions in sci_dir and the given spec1d files."""
+        txt_files = set(glob.glob(os.path.join(self.location, '*', 'spec1d*.txt')))
+        txt_files |= {trace_file(f) for f in spectra if os.path.isfile(trace_file(f))}
+
+        on_disk = {}
+        for fname in txt_files:
+            st = os.stat(fname)
+            on_disk[os.path.normpath(fname)] = (st.st_size, st.st_mtime_ns)
+        if on_disk == self._on_disk:
+            return
+
+        with contextlib.closing(self._connect()) as con:
+            known = {row[0]: (row[1], row[2]) for row in con.execute('SELECT filename, size, mtime_ns FROM files')}
+            changed = sorted(f for f, stat in on_disk.items() if known.get(f) != stat)
+            removed = [f for f in known if f not in on_disk and not os.path.isfile(f)]
+
+            for f in changed:
+                con.execute('DELETE FROM traces WHERE filename = ?', (f,))
+                con.executemany('INSERT INTO traces VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                                [(f,) + tuple(_value(x) for x in row) for row in read_traces(f)])
+                con.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?)', (f,) + on_disk[f])
+            for f in removed:
+                con.execute('DELETE FROM traces WHERE filename = ?', (f,))
+                con.execute('DELETE FROM files WHERE filename = ?', (f,))
+            con.commit()
+
+            rows = con.execute('SELECT filename, objid, %s FROM traces ORDER BY filename, objid' % ', '.join(COLUMNS)).fetchall()
+
+        self.filename = np.array([x[0] for x in rows], dtype=object)
+        self.objid = np.array([x[1] for x in rows], dtype=int)
+        for ii, col in enumerate(COLUMNS):
+            values = [x[ii+2] for x in rows]
+            if col in ('name', 'slit'):
+                setattr(self, col, np.array(values, dtype=object))
+            else:
+                setattr(self, col, np.array([np.nan if v is None else v for v in values], dtype=float))
+        self._on_disk = on_disk
+
+    def __len__(self):
+        return len(self.objid)
+
+    def _rows(self, spectra):
+        # position of every catalog row in spectra, -1 for rows of other files
+        keys = {os.path.normpath(trace_file(f)): ii for ii, f in enumerate(spectra)}
+        return np.array([keys.get(f, -1) for f in self.filename], dtype=int)
+
+    def table(self, spectra):
+        """Traces of the given spec1d files as one table."""
+        import astropy.table as table
+        spec = self._rows(spectra)
+        idx = np.flatnonzero(spec >= 0)
+        idx = idx[np.lexsort((self.objid[idx], spec[idx]))]
+        cat = table.Table([np.array(spectra, dtype=object)[spec[idx]], self.objid[idx]], names=['spec1d', 'objid'])
+        for col in COLUMNS:
+            cat[col] = getattr(self, col)[idx]
+        return cat
+
+    def select(self, spectra, objid=None, pixpos=CENTER_PIXPOS):
+        """Name of the selected trace of every spec1d file, None if the file is not in the catalog.
+
+        Without objid the trace closest to pixpos is selected. objid is either
+        the row number in the trace table of each file or a trace name.
+        """
+        spec = self._rows(spectra)
+        names = np.full(len(spectra), None, dtype=object)
+        idx = np.flatnonzero(spec >= 0)
+
+        if objid is None:
+            # sort by file, then by the distance to pixpos; the first row of every file wins
+            idx = idx[np.lexsort((np.abs(self.spat_pixpos[idx] - pixpos), spec[idx]))]
+            first = np.unique(spec[idx], return_index=True)[1]
+            names[spec[idx[first]]] = self.name[idx[first]]
+            return list(names)
+
+        try:
+            selected = idx[self.objid[idx] == int(objid)]
+        except ValueError:
+            selected = idx[self.name[idx] == objid]
+        names[spec[selected]] = self.name[selected]
+
+        in_catalog = np.zeros(len(spectra), dtype=bool)
+        in_catalog[spec[idx]] = True
+        missing = np.flatnonzero(in_catalog & np.equal(names, None))
+        if len(missing):
+            raise KeyError('objid %s not found in catalog %s' % (objid, ', '.join(trace_file(spectra[ii]) for ii in missing)))
+        return list(names)
+
+
+_catalogs = {}
+
+def get_catalog(sci_dir='sci', spectra=()):
+    """Spec1dCatalog of sci_dir, read again only if trace files were added, removed or modified."""
+    if sci_dir not in _catalogs:
+        _catalogs[sci_dir] = Spec1dCatalog(sci_dir, spectra)
+    else:
+        _catalogs[sci_dir].refresh(spectra)
+    return _catalogs[sci_dir]
+
+
+@click.command()
+@click.argument('spectra', nargs=-1)
+@click.option('--sci-dir', default='sci')
+def main(spectra, sci_dir):
+    catalog = get_catalog(sci_dir, spectra)
+    if spectra:
+        print(catalog.table(list(spectra)))
+    print(' * %d traces in %d spec1d files indexed' % (len(catalog), len(np.unique(catalog.filename))))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+import click
+import glob
+import itertools
+import os
+
+import astropy.io.fits as fits
+import astropy.table as table
+import numpy as np
+
+from   job_runner import JobRunner
+from   sensfunc_build import SENSFUNC_PAR, input_hash, sensfunc_job
+
+# Grid search over sensfunc parameters for one standard star. Every trial
+# writes its own parameter file; the trial directory is named after a hash
+# of the spec1d file and the parameter file, so trials that were already
+# computed in an earlier sweep are reused. Each trial is scored by the
+# residuals between the measured and the fitted zeropoint (in total and
+# in the difficult regions around 4000 A and beyond 9000 A) and by the
+# roughness of the fit.
+
+SWEEP_DIR = 'sweep'
+
+BLUE_WINDOW = (3800., 4200.)
+RED_WINDOW = (9000., 11000.)
+
+def parse_param(param):
+    # 'polyorder=7,9,11' or 'UVIS.nresln=10,20'
+    if '=' not in param:
+        raise click.BadParameter('expected KEY=VALUE[,VALUE...], got %s' % param, param_hint='--param')
+    key, values = param.split('=', 1)
+    return key.strip(), [x.strip() for x in values.split(',')]
+
+
+def set_par_value(lines, key, value):
+    """Set 'key = value' in the parameter file, optionally in a [[SECTION]] given as SECTION.key."""
+    section, _, name = key.rpartition('.')
+    current = None
+    for ii, line in enumerate(lines):
+        stripped = line.strip()
+        if stripped.startswith('['):
+            current = stripped.strip('[]')
+            continue
+        if section and current != section:
+            continue
+        body = stripped.lstrip('#').strip()
+        if body.split('=', 1)[0].strip() == name and '=' in body:
+            indent = line[:len(line) - len(line.lstrip())]
+            lines[ii] = '%s%s = %s\n' % (indent, name, value)
+            return lines
+    raise click.BadParameter('%s not found in the sensfunc parameter file' % key, param_hint='--param')
+
+
+def write_trial_par(template, trial, fname):
+    lines = list(template)
+    for key, value in trial.items():
+        lines = set_par_value(lines, key, value)
+    with open(fname, 'w') as f:
+        f.writelines(lines)
+
+
+def _rms(x):
+    return np.sqrt(np.mean(np.square(x))) if len(x) else np.nan
+
+
+def score_sensfunc(fname):
+    data = fits.getdata(fname, 1)
+    wave = np.atleast_2d(data['SENS_WAVE'])[0]
+    zeropoint = np.atleast_2d(data['SENS_ZEROPOINT'])[0]
+    names = data.columns.names
+    fit = np.atleast_2d(data['SENS_ZEROPOINT_FIT'])[0] if 'SENS_ZEROPOINT_FIT' in names else zeropoint
+    gpm = np.atleast_2d(data['SENS_ZEROPOINT_GPM'])[0].astype(bool) if 'SENS_ZEROPOINT_GPM' in names else np.ones(len(wave), dtype=bool)
+    gpm &= wave > 1
+
+    resid = (zeropoint - fit)[gpm]
+    wave = wave[gpm]
+    blue = (wave > BLUE_WINDOW[0]) & (wave < BLUE_WINDOW[1])
+    red = (wave > RED_WINDOW[0]) & (wave < RED_WINDOW[1])
+
+    # roughness: rms of the second derivative of the fit, in mag per (100 A)^2
+    fit = fit[gpm]
+    step = np.median(np.diff(wave)) / 100. if len(wave) > 2 else 1.
+    roughness = _rms(np.diff(fit, 2) / step**2)
+
+    return {'rms': _rms(resid), 'rms_4000': _rms(resid[blue]), 'rms_9000': _rms(resid[red]), 'roughness': roughness}
+
+
+@click.command()
+@click.argument('frame')
+@click.option('--param', 'params', multiple=True, required=True, help="Parameter grid, e.g. polyorder=7,9,11 or UVIS.nresln=10,20")
+@click.option('--par-file', default=SENSFUNC_PAR, help="Parameter file used as template")
+@click.option('--jobs', type=click.IntRange(min=1), default=4, help="Number of parallel pypeit_sensfunc sessions")
+@click.option('--smooth-weight', type=float, default=1., help="Weight of the roughness in the score")
+@click.option('--timeout', type=float, default=1800, help="Stop a trial after this many seconds")
+def main(frame, params, par_file, jobs, smooth_weight, timeout):
+    grid = [parse_param(x) for x in params]
+    keys = [key for key, _ in grid]
+    trials = [dict(zip(keys, values)) for values in itertools.product(*[values for _, values in grid])]
+
+    with open(par_file) as f:
+        template = f.readlines()
+
+    sweep_dir = os.path.join(SWEEP_DIR, os.path.basename(frame).replace('.fits', ''))
+    print(' * %d trials for %s in %s' % (len(trials), frame, sweep_dir))
+
+    jobs_list = []
+    for trial in trials:
+        # write the parameter file first to find out whether this trial was already run
+        tmp_par = os.path.join(sweep_dir, 'trial.%d.par' % os.getpid())
+        os.makedirs(sweep_dir, exist_ok=True)
+        write_trial_par(template, trial, tmp_par)
+        trial_dir = os.path.join(sweep_dir, input_hash(frame, tmp_par)[:12])
+        os.makedirs(trial_dir, exist_ok=True)
+        os.replace(tmp_par, os.path.join(trial_dir, 'sensfunc.par'))
+        jobs_list.append((trial, trial_dir))
+
+    cached = sum(os.path.isfile(os.path.join(d, 'sens.fits')) for _, d in jobs_list)
+    print(' * %d trials already computed' % cached)
+
+    todo = [trial_dir for _, trial_dir in jobs_list if not os.path.isfile(os.path.join(trial_dir, 'sens.fits'))]
+    results = JobRunner(jobs, timeout).run_all([sensfunc_job(frame, os.path.join(d, 'sens.fits'), False, os.path.join(d, 'sensfunc.par')) for d in todo])
+    for trial_dir, result in zip(todo, results):
+        if not result.ok:
+            # a partial sens.fits must not be cached or scored; the log is kept
+            for fname in glob.glob(os.path.join(trial_dir, 'sens.*')):
+                if not fname.endswith('.log'):
+                    os.remove(fname)
+
+    rows = []
+    for trial, trial_dir in jobs_list:
+        sens_file = os.path.join(trial_dir, 'sens.fits')
+        if not os.path.isfile(sens_file):
+            print(' * Trial %s failed, see %s/sens.log' % (trial, trial_dir))
+            continue
+        row = dict(trial)
+        row.update(score_sensfunc(sens_file))
+        row['score'] = np.nansum([row['rms'], row['rms_4000'], row['rms_9000']]) + smooth_weight*row['roughness']
+        row['sens_file'] = sens_file
+        rows.append(row)
+
+    if len(rows) == 0:
+        raise click.ClickException('All trials failed')
+
+    report = table.Table(rows=rows, names=keys + ['rms', 'rms_4000', 'rms_9000', 'roughness', 'score', 'sens_file'])
+    report.sort('score')
+    for col in ['rms', 'rms_4000', 'rms_9000', 'roughness', 'score']:
+        report[col].format = '.4f'
+    report_file = os.path.join(sweep_dir, 'report.txt')
+    report.write(report_file, format='ascii.fixed_width', overwrite=True)
+
+    print(report)
+    print(' * Ranked report written to %s' % report_file)
+    print(' * Best parameters: %s' % ', '.join('%s=%s' % (key, report[key][0]) for key in keys))
+
+if __name__ == '__main__':
+    main()
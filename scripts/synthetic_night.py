@@ -0,0 +1,262 @@
+#!/usr/bin/env python
+import click
+import os
+import shutil
+import stat
+import sys
+import zlib
+
+import astropy.io.fits as fits
+import astropy.time as time
+import numpy as np
+
+# Synthetic ALFOSC data for benchmarks. Raw nights are written with the
+# header keywords used by the pipeline (tiny images, the pipeline only reads
+# headers); the PypeIt products (spec1d files with their .txt trace tables
+# and sens files) are written by stub executables that replace run_pypeit
+# and the pypeit_* tools, so a full night can be processed offline and
+# without PypeIt installed.
+
+SCRIPTS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+DETWIN1 = '[1:2148, 1:2102]'
+GRISMS = ['Grism_#4', 'Grism_#4', 'Grism_#4', 'Grism_#7']
+SLITS = ['Slit_1.0', 'Slit_1.0', 'Slit_1.3']
+
+N_BIAS = 10
+N_ARC = 2
+N_FLAT = 2
+N_SCIENCE = 3
+FRAMES_PER_TARGET = N_ARC + N_FLAT + N_SCIENCE
+
+N_PIX = 2000
+
+# wavelength range of the spectra and of the sensitivity functions, which must cover the spectra
+WAVE_RANGE = (3200., 9600.)
+SENS_RANGE = (3000., 10000.)
+# calibration products written by the run_pypeit stub
+CALIB_PRODUCTS = ['Bias_B_0_DET01.fits', 'Edges_B_0_DET01.fits.gz', 'Slits_B_0_DET01.fits.gz', 'Flat_B_0_DET01.fits',
+                  'Arc_B_0_DET01.fits', 'Tiltimg_B_0_DET01.fits', 'WaveCalib_B_0_DET01.fits', 'Tilts_B_0_DET01.fits']
+
+TRACES = [('SPAT0120-SLIT0250-DET01', 120.), ('SPAT0248-SLIT0250-DET01', 248.), ('SPAT0400-SLIT0250-DET01', 400.)]
+
+def night_days(n_frames, first_day='2020-07-01'):
+    """Nights of about 100 frames each for a total of n_frames."""
+    n_nights = max(1, int(round(n_frames/100.)))
+    start = time.Time(first_day)
+    return [(start + time.TimeDelta(ii, format='jd')).iso[:10] for ii in range(n_nights)]
+
+
+def write_frame(fname, header, frame_size):
+    data = np.zeros((frame_size, frame_size), dtype=np.uint16)
+    fits.HDUList([fits.PrimaryHDU(header=header), fits.ImageHDU(data)]).writeto(fname, overwrite=True)
+
+
+def raw_header(day, rng, mjd, imagetyp, imagecat, target, ra, dec, grism, slit, exptime):
+    hdr = fits.Header()
+    hdr['DATE-OBS'] = time.Time(mjd, format='mjd').isot
+    hdr['RA'] = ra
+    hdr['DEC'] = dec
+    hdr['IMAGETYP'] = imagetyp
+    hdr['IMAGECAT'] = imagecat
+    hdr['OBJECT'] = target
+    hdr['EXPTIME'] = exptime
+    hdr['ALGRNM'] = grism
+    hdr['ALAPRTNM'] = slit
+    hdr['DETWIN1'] = DETWIN1
+    hdr['DETXBIN'] = 1
+    hdr['DETYBIN'] = 1
+    hdr['AIRMASS'] = round(1 + rng.uniform(0, 1), 3)
+    hdr['OBJRA'] = ra
+    hdr['OBJDEC'] = dec
+    hdr['OBJEQUIN'] = 2000.
+    hdr['RADECSYS'] = 'FK5'
+    hdr['OBJPMRA'] = 0.
+    hdr['OBJPMDEC'] = 0.
+    hdr['OBSERVAT'] = 'ORM'
+    hdr['DETNAME'] = 'CCD14'
+    hdr['CHIPID'] = 'CCD14'
+    hdr['PROPID'] = '61-001'
+    hdr['PROPTITL'] = 'Synthetic data'
+    hdr['OBSERVER'] = 'Benchmark'
+    hdr['GROUPID'] = 1
+    hdr['BLOCKID'] = 1
+    return hdr
+
+
+def make_night(root, day, n_frames=100, frame_size=16, seed=0):
+    """Write raw/<day> with biases, a standard per grism and science targets with arcs and flats."""
+    rng = np.random.default_rng(seed)
+    raw_dir = os.path.join(root, 'raw', day)
+    os.makedirs(raw_dir, exist_ok=True)
+
+    prefix = 'AL%s' % day.replace('-', '')[2:]
+    mjd = time.Time(day + 'T20:00:00').mjd
+    n_targets = max(1, (n_frames - N_BIAS - FRAMES_PER_TARGET) // FRAMES_PER_TARGET)
+
+    frames = []
+    for _ in range(N_BIAS):
+        frames.append(('BIAS', 'CALIB', 'bias', 0., 0., GRISMS[0], SLITS[0], 0.))
+
+    science = [('OBJECT', 'SCIENCE', 'ZTF%02d%s' % (ii, day.replace('-', '')), GRISMS[ii % len(GRISMS)], SLITS[ii % len(SLITS)], N_SCIENCE)
+               for ii in range(n_targets)]
+    # a standard for every grism of the night, the spectra are not fluxed with another grism
+    grisms = sorted({x[3] for x in science}, key=GRISMS.index)
+    targets = [('STD', 'CALIB', 'SP%04d' % rng.integers(10000), grism, SLITS[0], 1) for grism in grisms] + science
+
+    for imagetyp, imagecat, target, grism, slit, n_science in targets:
+        ra, dec = rng.uniform(0, 360), rng.uniform(-20, 70)
+        frames += [('WAVE,LAMP', 'CALIB', target, ra, dec, grism, slit, 1.)]*N_ARC
+        frames += [('FLAT,LAMP', 'CALIB', target, ra, dec, grism, slit, 5.)]*N_FLAT
+        frames += [(imagetyp, imagecat, target, ra, dec, grism, slit, 300.)]*n_science
+
+    for ii, (imagetyp, imagecat, target, ra, dec, grism, slit, exptime) in enumerate(frames):
+        hdr = raw_header(day, rng, mjd + ii*6./1440., imagetyp, imagecat, target, ra, dec, grism, slit, exptime)
+        write_frame(os.path.join(raw_dir, '%s%04d.fits' % (prefix, ii + 1)), hdr, frame_size)
+    return len(frames)
+
+
+def spectrum(rng, wave, scale):
+    counts = scale*(1 + 0.3*np.sin(wave/400.))*np.exp(-0.5*((wave - 6500)/2500)**2) + rng.normal(0, 1, len(wave))
+    ivar = np.full(len(wave), 1.)
+    return counts, ivar
+
+
+def write_spec1d(fname, row, rng):
+    """Spec1d file and .txt trace table for one science row of a .pypeit file."""
+    hdr = fits.Header()
+    hdr['MJD'] = float(row['mjd'])
+    hdr['DISPNAME'] = row['dispname']
+    hdr['DECKER'] = row['decker']
+    hdr['TARGET'] = row['target']
+    hdr['AIRMASS'] = float(row['airmass'])
+    hdr['EXPTIME'] = float(row['exptime'])
+    hdr['BINNING'] = row['binning']
+    hdr['LON-OBS'] = -17.885
+    hdr['LAT-OBS'] = 28.7567
+    hdr['ALT-OBS'] = 2382.
+    hdr['VERSPYP'] = '1.13.0'
+    hdr['EXT0000'] = TRACES[1][0]
+    hdr['HISTORY'] = 'PypeIt stub reduction of %s' % row['filename']
+
+    wave = np.linspace(*WAVE_RANGE, N_PIX) + rng.uniform(-2, 2)
+    hdus = [fits.PrimaryHDU(header=hdr)]
+    for name, _ in TRACES:
+        counts, ivar = spectrum(rng, wave, rng.uniform(50, 500))
+        cols = [fits.Column(name='OPT_WAVE', format='D', array=wave),
+                fits.Column(name='OPT_COUNTS', format='D', array=counts),
+                fits.Column(name='OPT_COUNTS_IVAR', format='D', array=ivar)]
+        hdu = fits.BinTableHDU.from_columns(cols, name=name)
+        hdu.header['WAVE_RMS'] = 0.05
+        hdu.header['FWHM'] = 3.2
+        hdus.append(hdu)
+    fits.HDUList(hdus).writeto(fname, overwrite=True)
+
+    with open(fname.replace('.fits', '.txt'), 'w') as f:
+        f.write('| slit |                    name | spat_pixpos | spat_fracpos | box_width | opt_fwhm |   s2n |\n')
+        for name, pixpos in TRACES:
+            f.write('|  250 | %s | %11.1f | %12.3f | %9.1f | %8.1f | %5.1f |\n' % (name, pixpos, pixpos/500., 3., 3.2, rng.uniform(5, 50)))
+
+
+def write_sens(dest_path, frame):
+    """Sens file for a standard star spec1d file."""
+    std = fits.getheader(frame, 0)
+    hdr = fits.Header()
+    for key in ('MJD', 'DISPNAME', 'DECKER', 'TARGET', 'AIRMASS'):
+        hdr[key] = std[key]
+    wave = np.linspace(*SENS_RANGE, 800)
+    zeropoint = 18 + 0.5*np.sin(wave/800.)
+    cols = [fits.Column(name='SENS_WAVE', format='%dD' % len(wave), array=wave[None]),
+            fits.Column(name='SENS_ZEROPOINT', format='%dD' % len(wave), array=zeropoint[None]),
+            fits.Column(name='SENS_ZEROPOINT_FIT', format='%dD' % len(wave), array=zeropoint[None])]
+    fits.HDUList([fits.PrimaryHDU(header=hdr), fits.BinTableHDU.from_columns(cols)]).writeto(dest_path, overwrite=True)
+
+
+def stub_run_pypeit(argv):
+    # run_pypeit <file> [-c]: calibrations write the missing products, science writes spec1d files
+    from pypeit_files import read_pypeit, science_rows
+    params, rows = read_pypeit(argv[0])
+    os.makedirs(params['calib_dir'], exist_ok=True)
+    if '-c' in argv:
+        for name in CALIB_PRODUCTS:
+            fname = os.path.join(params['calib_dir'], name)
+            print('%s %s' % ('Loaded' if os.path.isfile(fname) else 'Built', name))
+            if not os.path.isfile(fname):
+                with open(fname, 'w') as f:
+                    f.write('stub\n')
+        return 0
+    os.makedirs(params['scidir'], exist_ok=True)
+    rng = np.random.default_rng(zlib.crc32(argv[0].encode()))
+    for row in science_rows(rows):
+        base = row['filename'].replace('.fits', '')
+        write_spec1d(os.path.join(params['scidir'], 'spec1d_%s-%s_ALFOSC.fits' % (base, row['target'])), row, rng)
+    return 0
+
+
+def stub_sensfunc(argv):
+    # pypeit_sensfunc -s <par> <spec1d> -o <sens> [--debug]
+    write_sens(argv[argv.index('-o') + 1], argv[2])
+    return 0
+
+
+def stub_noop(argv):
+    # pypeit_flux_calib / pypeit_coadd_1dspec: only the parameter file is read
+    with open(argv[0]) as f:
+        f.read()
+    return 0
+
+
+STUBS = {
+    'run_pypeit': 'stub_run_pypeit',
+    'pypeit_sensfunc': 'stub_sensfunc',
+    'pypeit_flux_calib': 'stub_noop',
+    'pypeit_coadd_1dspec': 'stub_noop',
+}
+
+STUB_TEMPLATE = """#!%s
+import sys
+sys.path.insert(0, %r)
+import synthetic_night
+sys.exit(synthetic_night.%s(sys.argv[1:]))
+"""
+
+def write_stubs(bin_dir):
+    """Stub executables for the PypeIt tools, to be put first in PATH."""
+    os.makedirs(bin_dir, exist_ok=True)
+    for name, func in STUBS.items():
+        fname = os.path.join(bin_dir, name)
+        with open(fname, 'w') as f:
+            f.write(STUB_TEMPLATE % (sys.executable, SCRIPTS_DIR, func))
+        os.chmod(fname, os.stat(fname).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+    return bin_dir
+
+
+def make_tree(root, n_frames, frame_size=16, seed=0):
+    """Synthetic working directory with raw nights, stub executables and the etc/ files."""
+    days = night_days(n_frames)
+    total = 0
+    for ii, day in enumerate(days):
+        total += make_night(root, day, n_frames//len(days), frame_size, seed + ii)
+
+    for dname in ('datasets', 'sens', 'etc'):
+        os.makedirs(os.path.join(root, dname), exist_ok=True)
+    shutil.copy(os.path.join(SCRIPTS_DIR, '..', 'etc', 'sensfunc.par'), os.path.join(root, 'etc', 'sensfunc.par'))
+    wave = np.linspace(3000., 11000., 81)
+    np.savetxt(os.path.join(root, 'etc', 'extinction.dat'), np.column_stack([wave, 0.5*(3500./wave)**4 + 0.05]), fmt='%.4f')
+
+    write_stubs(os.path.join(root, 'bin'))
+    return days, total
+
+
+@click.command()
+@click.argument('root')
+@click.option('--frames', 'n_frames', type=int, default=100, help="Total number of raw frames, about 100 per night")
+@click.option('--frame-size', type=int, default=16, help="Size of the (empty) raw images in pixels")
+@click.option('--seed', type=int, default=0)
+def main(root, n_frames, frame_size, seed):
+    days, total = make_tree(root, n_frames, frame_size, seed)
+    print(' * Wrote %d frames for %d nights (%s to %s) into %s' % (total, len(days), days[0], days[-1], root))
+    print(' * Put %s first in PATH to use the PypeIt stubs' % os.path.join(root, 'bin'))
+
+if __name__ == '__main__':
+    main()
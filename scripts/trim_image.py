@@ -1,26 +1,128 @@
+#!/usr/bin/env python
 import astropy.io.fits as fits
+import astropy.table as table
 import click
+import concurrent.futures
+import glob
 import os
 
+# Trim raw frames to the part of the detector that is used for spectroscopy.
+# The input frames are memory-mapped and only the trimmed section is read and
+# written to a new file, the raw frames are never modified. The section is
+# given in unbinned detector pixels and converted to the array of every frame
+# with its readout window (DETWIN1) and binning, so frames with different
+# windows can be trimmed in one go.
 
+TRIM_DIR = 'trimmed'
 
-@click.command()
-@click.argument('images', nargs=-1)
-def main(images):
+# ALFOSC: rows 1-1800 and columns 601-1700 of the full frame
+DEFAULT_SECTION = '[601:1700,1:1800]'
+
+def parse_section(section):
+    # '[x1:x2,y1:y2]' (FITS convention, 1-based, inclusive)
+    x, y = section.strip().strip('[]').split(',')
+    x1, x2 = [int(v) for v in x.split(':')]
+    y1, y2 = [int(v) for v in y.split(':')]
+    return x1, x2, y1, y2
+
+
+def read_sections(fname):
+    """Per-setup trim sections from a table with the columns detwin1 and section."""
+    tab = table.Table.read(fname, format='ascii.csv')
+    return {str(row['detwin1']).replace(' ', ''): str(row['section']) for row in tab}
+
+
+def array_slice(section, detwin1, xbin=1, ybin=1):
+    """Convert a detector section into slices of the data array of a frame read out in detwin1."""
+    x1, x2, y1, y2 = parse_section(section)
+    wx1, wx2, wy1, wy2 = parse_section(detwin1)
+    x1, x2 = max(x1, wx1), min(x2, wx2)
+    y1, y2 = max(y1, wy1), min(y2, wy2)
+    if x1 > x2 or y1 > y2:
+        raise ValueError('Section %s is outside of the readout window %s' % (section, detwin1))
+    return (slice((y1 - wy1)//ybin, (y2 - wy1 + 1)//ybin), slice((x1 - wx1)//xbin, (x2 - wx1 + 1)//xbin))
+
+
+def trim_frame(image, dest_fname, sections=None, default_section=DEFAULT_SECTION):
+    """Write the trimmed frame image to dest_fname. Returns the shape of the trimmed data."""
+    # the scaled integers are copied as they are, so the data stay memory-mapped
+    with fits.open(image, memmap=True, do_not_scale_image_data=True) as hdulist:
+        primary = hdulist[0].header
+        detwin1 = primary.get('DETWIN1')
+        section = (sections or {}).get(str(detwin1).replace(' ', ''), default_section)
+
+        hdu = hdulist[1]
+        if detwin1 is None:
+            detwin1 = '[1:%d,1:%d]' % (hdu.header['NAXIS1'], hdu.header['NAXIS2'])
+        yslice, xslice = array_slice(section, detwin1, primary.get('DETXBIN', 1), primary.get('DETYBIN', 1))
+
+        header = hdu.header.copy()
+        header['TRIMSEC'] = (section, 'Trimmed detector section')
+        new_hdu = fits.ImageHDU(data=hdu.data[yslice, xslice], header=header, do_not_scale_image_data=True)
+        # the constructor drops the scaling of the raw integers, restore it
+        for key in ('BSCALE', 'BZERO'):
+            if key in header:
+                new_hdu.header[key] = header[key]
+
+        tmp_fname = dest_fname + '.tmp'
+        fits.HDUList([hdulist[0].copy(), new_hdu] + [x.copy() for x in hdulist[2:]]).writeto(tmp_fname, overwrite=True)
+        shape = new_hdu.data.shape
+    os.replace(tmp_fname, dest_fname)
+    return shape
+
+
+def trim_frames(images, dest_dir, sections=None, default_section=DEFAULT_SECTION, jobs=4, overwrite=False):
+    """Trim images into dest_dir; frames whose trimmed copy is newer than the raw frame are skipped."""
+    os.makedirs(dest_dir, exist_ok=True)
+    todo = []
     for image in images:
-        dest_fname = os.path.basename(image)
-        hdu = fits.open(image, mode='update')
+        dest_fname = os.path.join(dest_dir, os.path.basename(image))
+        if not overwrite and os.path.isfile(dest_fname) and os.path.getmtime(dest_fname) >= os.path.getmtime(image):
+            continue
+        todo.append((image, dest_fname))
+    print(' * Trimming %d of %d frames into %s' % (len(todo), len(images), dest_dir))
+
+    failed = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+        futures = {pool.submit(trim_frame, image, dest_fname, sections, default_section): image for image, dest_fname in todo}
+        for future, image in futures.items():
+            try:
+                future.result()
+            except (OSError, ValueError, KeyError, IndexError) as e:
+                print(' * ERR: cannot trim %s: %s' % (image, e))
+                failed.append(image)
+    return failed
 
-        data = hdu[1].data
-        print(data.shape)
-        new_data = data[0:1800,600:1700]
-        print(new_data.shape)
-        hdu[1].data = new_data
-        hdu.flush()
-        hdu.close()
 
-        
+def trim_night(day, sections=None, default_section=DEFAULT_SECTION, jobs=4, overwrite=False):
+    """Trim raw/<day> into trimmed/<day>, returns the trimmed night directory."""
+    dest_dir = os.path.join(TRIM_DIR, day)
+    failed = trim_frames(sorted(glob.glob('raw/%s/*.fits' % day)), dest_dir, sections, default_section, jobs, overwrite)
+    if failed:
+        raise RuntimeError('%d frames of %s could not be trimmed' % (len(failed), day))
+    return dest_dir
+
+
+@click.command()
+@click.argument('images', nargs=-1)
+@click.option('--day', default=None, help="Trim all frames of raw/DAY into trimmed/DAY")
+@click.option('--output-dir', default=None, help="Destination of the trimmed IMAGES")
+@click.option('--section', default=DEFAULT_SECTION, help="Detector section to keep, [x1:x2,y1:y2]")
+@click.option('--sections', 'sections_file', default=None, help="CSV table with trim sections per DETWIN1 (columns detwin1, section)")
+@click.option('--jobs', type=click.IntRange(min=1), default=4, help="Number of frames trimmed in parallel")
+@click.option('--overwrite', is_flag=True, help="Trim frames again even if they are up to date")
+def main(images, day, output_dir, section, sections_file, jobs, overwrite):
+    sections = read_sections(sections_file) if sections_file else None
+
+    if day is not None:
+        print(' * Trimmed frames are in %s' % trim_night(day, sections, section, jobs, overwrite))
+        return
 
+    if output_dir is None:
+        raise click.UsageError('Use --output-dir for IMAGES, the raw frames are not modified')
+    failed = trim_frames(images, output_dir, sections, section, jobs, overwrite)
+    if failed:
+        raise click.ClickException('%d frames could not be trimmed' % len(failed))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,216 @@
+#!/usr/bin/env python
+import contextlib
+import importlib
+import json
+import os
+import socket
+import sys
+
+import click
+
+# Long-lived worker for the post-reduction stages. The worker listens on a
+# Unix socket in work/ and runs the commands of alfosc.py in its own process,
+# so astropy & co. are imported once and the memoized .pypeit files, raw
+# headers and sens curves (LRU caches keyed by file and mtime) are reused by
+# all following commands. alfosc.py forwards the commands below to a running
+# worker of the same directory and runs them itself otherwise.
+
+SOCKET_PATH = os.path.join('work', 'alfosc.sock')
+
+# commands that only read and write files of the pipeline tree
+WARM_COMMANDS = {'catalog', 'sens', 'fluxcal', 'combine', 'coadd', 'convert', 'qa', 'headers'}
+
+# set in the worker; its commands never fork, a forked process would inherit
+# the stdout redirected to the client and starts with empty caches
+IN_WORKER = False
+
+def in_process(jobs):
+    """Whether a command runs its work in its own process instead of a process pool."""
+    return jobs == 1 or IN_WORKER
+
+def _send(sock, message):
+    sock.sendall((json.dumps(message) + '\n').encode())
+
+
+def _messages(sock):
+    with sock.makefile('r') as f:
+        for line in f:
+            yield json.loads(line)
+
+
+def forward(name, args, socket_path=SOCKET_PATH):
+    """Run a command in the worker. Returns its exit code, None if no worker is running."""
+    if os.environ.get('ALFOSC_WORKER', '1') == '0' or name not in WARM_COMMANDS or not os.path.exists(socket_path):
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+    except OSError:
+        # stale socket of a worker that is gone
+        sock.close()
+        return None
+
+    with sock:
+        _send(sock, {'command': name, 'args': list(args), 'cwd': os.getcwd()})
+        for message in _messages(sock):
+            if 'out' in message:
+                sys.stdout.write(message['out'])
+                sys.stdout.flush()
+            elif 'exit' in message:
+                return message['exit']
+    return 1
+
+
+class _SocketWriter:
+    # stdout of a command, sent line by line to the client
+    encoding = 'utf-8'
+
+    def __init__(self, sock):
+        self.sock = sock
+
+    def write(self, text):
+        # click may write encoded text
+        if isinstance(text, bytes):
+            text = text.decode(self.encoding, errors='replace')
+        if text:
+            _send(self.sock, {'out': text})
+        return len(text)
+
+    def flush(self):
+        pass
+
+    def isatty(self):
+        return False
+
+
+def cache_info():
+    import flux_calib
+    import header_index
+    import pypeit_files
+    import sens_index
+    import spec1d_catalog
+    return {'pypeit files': pypeit_files._read_pypeit.cache_info(), 'raw headers': header_index._get_header.cache_info(),
+            'sens curves': flux_calib._load_sens.cache_info(), 'sens indexes': len(sens_index._indexes),
+            'spec1d catalogs': len(spec1d_catalog._catalogs)}
+
+
+def run_command(name, args):
+    import alfosc
+    import metrics
+    command = importlib.import_module(alfosc.COMMANDS[name][0]).main
+    metrics.SCRIPT = alfosc.COMMANDS[name][0] + '.py'
+    try:
+        command.main(args, prog_name='alfosc.py %s' % name, standalone_mode=False)
+    except click.exceptions.Exit as e:
+        return e.exit_code
+    except click.ClickException as e:
+        e.show(file=sys.stdout)
+        return e.exit_code
+    except click.Abort:
+        return 1
+    except SystemExit as e:
+        return e.code if isinstance(e.code, int) else (0 if e.code is None else 1)
+    except Exception as e:
+        print(' * ERR: %s failed: %r' % (name, e))
+        return 1
+    return 0
+
+
+def serve(socket_path):
+    global IN_WORKER
+    IN_WORKER = True
+    root = os.getcwd()
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(socket_path)
+    server.listen()
+    print(' * Worker for %s listening on %s (pid %d)' % (root, socket_path, os.getpid()))
+
+    try:
+        while True:
+            conn, _ = server.accept()
+            with conn:
+                request = next(_messages(conn), None)
+                if request is None:
+                    continue
+                if request.get('command') == 'stop':
+                    _send(conn, {'exit': 0})
+                    break
+                if request.get('command') == 'status':
+                    _send(conn, {'out': ''.join(' * %s: %s\n' % item for item in cache_info().items())})
+                    _send(conn, {'exit': 0})
+                    continue
+                if os.path.realpath(request['cwd']) != os.path.realpath(root):
+                    _send(conn, {'out': ' * ERR: this worker serves %s\n' % root})
+                    _send(conn, {'exit': 1})
+                    continue
+
+                # requests are served one after the other, stdout goes to the client
+                print(' * %s %s' % (request['command'], ' '.join(request['args'])[:200]), file=sys.stderr)
+                with contextlib.redirect_stdout(_SocketWriter(conn)):
+                    try:
+                        returncode = run_command(request['command'], request['args'])
+                    except BrokenPipeError:
+                        continue
+                _send(conn, {'exit': returncode})
+    finally:
+        server.close()
+        os.remove(socket_path)
+
+
+def _request(command, socket_path):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+    except OSError:
+        raise click.ClickException('No worker running on %s' % socket_path)
+    with sock:
+        _send(sock, {'command': command, 'args': [], 'cwd': os.getcwd()})
+        for message in _messages(sock):
+            sys.stdout.write(message.get('out', ''))
+
+
+@click.group()
+def main():
+    pass
+
+
+@main.command('start')
+@click.option('--socket', 'socket_path', default=SOCKET_PATH)
+def start(socket_path):
+    """Run the worker in the foreground (stop it with Ctrl-C or 'warm_worker.py stop')."""
+    import matplotlib
+    matplotlib.use('Agg')
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+    os.makedirs(os.path.dirname(socket_path) or '.', exist_ok=True)
+    if os.path.exists(socket_path):
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            if sock.connect_ex(socket_path) == 0:
+                raise click.ClickException('A worker is already running on %s' % socket_path)
+        # stale socket of a worker that is gone
+        os.remove(socket_path)
+
+    # load the heavy libraries once
+    import astropy.io.fits, astropy.table  # noqa: F401
+    try:
+        serve(socket_path)
+    except KeyboardInterrupt:
+        pass
+
+
+@main.command('stop')
+@click.option('--socket', 'socket_path', default=SOCKET_PATH)
+def stop(socket_path):
+    """Stop the worker."""
+    _request('stop', socket_path)
+
+
+@main.command('status')
+@click.option('--socket', 'socket_path', default=SOCKET_PATH)
+def status(socket_path):
+    """Show the state of the caches of the worker."""
+    _request('status', socket_path)
+
+
+if __name__ == '__main__':
+    main()
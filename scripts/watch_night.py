@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+import asyncio
+import click
+import glob
+import os
+import time
+
+import calib_store
+import metrics
+from   create_datasets import ALFOSC_HEADERS, NightIndex, night_targets, render_dataset, write_manifest
+from   header_index import HeaderIndex
+from   job_runner import JobRunner
+from   pypeit_files import read_pypeit
+from   run_datasets import SharedComponents, dataset_components, pypeit_job, run_recorded
+from   runtime_history import RuntimeHistory, dataset_features
+
+# Live reduction of a night while it is observed. raw/<day> is polled; once
+# the new frames are complete (size and mtime unchanged between two polls),
+# the header index is updated incrementally, the targets are grouped again
+# and only the .pypeit files whose content changed are rewritten. A dataset
+# is reduced as soon as it has science frames, biases, arcs and flats and
+# did not change for a while (the next exposure of a sequence may be on
+# its way). If more frames of a target arrive later, its dataset is
+# reduced again; calibrations come from the calibration store. A reduction
+# that failed is tried again once its dataset settled again.
+
+POLL_INTERVAL = 10.
+
+# seconds a complete dataset must stay unchanged before it is reduced
+SETTLE = 60.
+
+def snapshot(fits_dir):
+    snap = {}
+    for fname in glob.glob(os.path.join(fits_dir, '*.fits')):
+        st = os.stat(fname)
+        snap[os.path.basename(fname)] = (st.st_size, st.st_mtime_ns)
+    return snap
+
+
+def write_atomic(fname, content):
+    tmp_fname = '%s.%d' % (fname, os.getpid())
+    with open(tmp_fname, 'w') as f:
+        f.write(content)
+    os.replace(tmp_fname, fname)
+
+
+def is_reduced(entry):
+    # spec1d files newer than the .pypeit file: reduced before the watcher started
+    sci_dir = 'sci/%s-%s' % (entry['day'], entry['target'])
+    spec1d = glob.glob(os.path.join(sci_dir, 'spec1d*.fits'))
+    return bool(spec1d) and min(os.path.getmtime(x) for x in spec1d) >= os.path.getmtime(entry['dataset'])
+
+
+class NightWatcher:
+
+    def __init__(self, day, runner, settle=SETTLE, timeout=None, manifest='datasets/manifest.json'):
+        self.day = day
+        self.fits_dir = 'raw/%s' % day
+        self.runner = runner
+        self.settle = settle
+        self.timeout = timeout
+        self.manifest = manifest
+        self.history = RuntimeHistory()
+
+        self.indexed = None
+        # dataset -> [manifest entry, content, time of the last change]
+        self.datasets = {}
+        # dataset -> content that was reduced successfully
+        self.reduced = {}
+        self.running = set()
+        self.calib_locks = {}
+        self.shared = SharedComponents()
+
+    def update(self):
+        """Regroup the frames of the night and rewrite the .pypeit files that changed."""
+        with metrics.span('watch_update', self.day) as fields:
+            hdrs = HeaderIndex(self.fits_dir, ALFOSC_HEADERS)
+            if not hdrs.headers:
+                return
+            night = NightIndex(hdrs)
+            targets = night_targets(hdrs, night, verbose=False)
+            nearby = night.match_pointings([idx for _, idx in targets])
+
+            changed = []
+            for (target_name, idx), nearby_idx in zip(targets, nearby):
+                try:
+                    entry, content = render_dataset(night, idx, nearby_idx, self.fits_dir, self.day, target_name)
+                except AssertionError:
+                    print(' * WARN: %s was observed with several detector windows, skipped' % target_name)
+                    continue
+                dest_file = entry['dataset']
+                known = self.datasets.get(dest_file)
+                if known is not None and known[1] == content:
+                    continue
+
+                if os.path.isfile(dest_file) and open(dest_file).read() == content:
+                    # unchanged since an earlier run
+                    self.datasets[dest_file] = [entry, content, os.path.getmtime(dest_file)]
+                    if is_reduced(entry):
+                        self.reduced[dest_file] = content
+                    continue
+
+                write_atomic(dest_file, content)
+                entry['status'] = 'created'
+                self.datasets[dest_file] = [entry, content, time.time()]
+                changed.append(dest_file)
+                print(' * %s %s (%d science, %d arc, %d flat frames)' % ('Updated' if known else 'Created', dest_file,
+                                                                         entry['n_science'], entry['n_arc'], entry['n_flat']))
+            fields.update(n_frames=len(hdrs.headers), n_changed=len(changed))
+
+        if changed:
+            write_manifest([x[0] for x in self.datasets.values()], [self.day], self.manifest)
+
+    def ready(self, now):
+        """Datasets that are complete, settled and not reduced in their current state."""
+        return sorted(dest_file for dest_file, (entry, content, changed) in self.datasets.items()
+                      if entry['calibrated'] and now - changed >= self.settle
+                      and self.reduced.get(dest_file) != content and dest_file not in self.running)
+
+    def failed(self, fname):
+        # tried again after another settle time
+        self.datasets[fname][2] = time.time()
+
+    async def reduce(self, fname, model):
+        self.running.add(fname)
+        content = self.datasets[fname][1]
+        try:
+            features = dataset_features(fname)
+            calib_dir = read_pypeit(fname)[0]['calib_dir']
+
+            with calib_store.in_use(calib_dir):
+                # datasets sharing calibrations build them once
+                async with self.calib_locks.setdefault(calib_dir, asyncio.Lock()):
+                    if not calib_store.is_complete(calib_dir):
+                        claimed = await self.shared.prepare(calib_dir, dataset_components(fname))
+                        job = pypeit_job(fname, model, features, True, self.timeout)
+                        ok = (await run_recorded(self.runner, self.history, features, job)).ok
+                        self.shared.publish(calib_dir, claimed, ok)
+                        if not ok:
+                            print(' * Calibrations failed for %s' % fname)
+                            self.failed(fname)
+                            return
+                        calib_store.mark_complete(calib_dir)
+                    else:
+                        calib_store.touch(calib_dir)
+
+                job = pypeit_job(fname, model, features, timeout=self.timeout)
+                if (await run_recorded(self.runner, self.history, features, job)).ok:
+                    self.reduced[fname] = content
+                    print(' * %s reduced' % fname)
+                else:
+                    self.failed(fname)
+        finally:
+            self.running.discard(fname)
+
+    def collect(self, tasks):
+        """Drop the finished reductions from tasks (task -> dataset), report those that raised."""
+        for task, fname in list(tasks.items()):
+            if not task.done():
+                continue
+            del tasks[task]
+            if not task.cancelled() and task.exception() is not None:
+                print(' * ERR: reduction of %s failed: %r' % (fname, task.exception()))
+                self.failed(fname)
+
+    async def watch(self, interval=POLL_INTERVAL, once=False):
+        print(' * Watching %s (Ctrl-C to stop)' % self.fits_dir)
+        previous = None
+        tasks = {}
+        while True:
+            current = snapshot(self.fits_dir)
+            # frames still being written change between two polls
+            if (once or current == previous) and current != self.indexed:
+                self.update()
+                self.indexed = current
+            previous = current
+
+            ready = self.ready(float('inf') if once else time.time())
+            if ready:
+                # the cost model is fitted once per poll
+                model = self.history.model()
+                for fname in ready:
+                    tasks[asyncio.ensure_future(self.reduce(fname, model))] = fname
+            self.collect(tasks)
+
+            if once:
+                if tasks:
+                    await asyncio.wait(tasks)
+                self.collect(tasks)
+                return
+            await asyncio.sleep(interval)
+
+
+@click.command()
+@click.argument('day')
+@click.option('--jobs', type=click.IntRange(min=1), default=4, help="Maximum number of parallel run_pypeit sessions")
+@click.option('--interval', type=float, default=POLL_INTERVAL, help="Seconds between two polls of the raw directory")
+@click.option('--settle', type=float, default=SETTLE, help="Seconds a dataset must stay unchanged before it is reduced")
+@click.option('--timeout', type=float, default=None, help="Stop a run_pypeit session after this many seconds (default: no limit)")
+@click.option('--memory', default=None, help="Memory budget for all run_pypeit sessions, e.g. 64G (default: no limit)")
+@click.option('--once', is_flag=True, help="Process the frames present now, wait for the reductions and exit")
+def main(day, jobs, interval, settle, timeout, memory, once):
+    if not os.path.isdir('raw/%s' % day):
+        raise click.ClickException('raw/%s does not exist' % day)
+    os.makedirs('datasets', exist_ok=True)
+
+    runner = JobRunner(jobs, memory=calib_store.parse_size(memory)/1024.**2 if memory else None)
+    watcher = NightWatcher(day, runner, settle, timeout)
+    try:
+        runner.execute(watcher.watch(interval, once))
+    except KeyboardInterrupt:
+        print(' * Stopped, running reductions were terminated')
+
+if __name__ == '__main__':
+    main()
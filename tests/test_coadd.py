@@ -0,0 +1,33 @@
+import numpy as np
+
+import coadd
+
+
+def test_combine_rejects_single_outlier():
+    rng = np.random.default_rng(1)
+    fluxes = 10. + 0.3*rng.normal(size=(3, 100))
+    ivars = np.ones_like(fluxes)
+    fluxes[1, 40] += 20.
+
+    flux, ivar, nused = coadd.combine(fluxes, ivars)
+    assert nused[40] == 2
+    assert np.isclose(flux[40], 0.5*(fluxes[0, 40] + fluxes[2, 40]))
+    assert np.isclose(ivar[40], 2.)
+    assert np.all(nused[np.arange(100) != 40] == 3)
+
+
+def test_combine_keeps_good_pixels_of_large_stacks():
+    rng = np.random.default_rng(2)
+    for n_spec in (4, 5, 8):
+        fluxes = 0.3*rng.normal(size=(n_spec, 100))
+        fluxes[0] += 20.
+        flux, ivar, nused = coadd.combine(fluxes, np.ones_like(fluxes))
+        assert np.all(nused == n_spec - 1)
+        assert np.allclose(flux, fluxes[1:].mean(axis=0))
+
+
+def test_combine_two_inputs():
+    fluxes = np.array([[1., 2.], [3., 40.]])
+    flux, ivar, nused = coadd.combine(fluxes, np.ones_like(fluxes))
+    assert np.allclose(flux, [2., 21.])
+    assert np.all(nused == 2)
@@ -0,0 +1,78 @@
+import os
+import shutil
+
+import astropy.io.fits as fits
+import numpy as np
+import pytest
+
+import flux_calib
+
+# Regression tests of the in-process flux calibration against PypeIt. The
+# comparison with a spectrum fluxed by pypeit_flux_calib needs a fluxed
+# spec1d file and its sensitivity function, given by PYPEIT_FLUXED_SPEC1D
+# and PYPEIT_SENSFUNC (e.g. from a night reduced with the PypeIt tools).
+
+EXPTIME = 300.
+
+
+def sensfunc(wave_min=3000., wave_max=10000.):
+    sens_wave = np.linspace(wave_min, wave_max, 2000)
+    sens_zeropoint = 20. - 2.*((sens_wave - 6000.)/4000.)**2
+    return sens_wave, sens_zeropoint
+
+
+def test_delta_wave_linear():
+    wave = np.linspace(3500., 9000., 2048)
+    dwave = flux_calib.delta_wave(wave, wave > 1)
+    assert np.allclose(dwave, wave[1] - wave[0])
+
+
+def test_delta_wave_masked():
+    wave = np.geomspace(3500., 9000., 2048)
+    wave[:10] = 0.
+    dwave = flux_calib.delta_wave(wave, wave > 1)
+    assert np.all(dwave[:10] == 0.)
+    assert np.allclose(dwave[100:-100], np.gradient(wave)[100:-100], rtol=1e-3)
+
+
+def test_sens_factor_per_pixel():
+    # twice the pixel size collects twice the counts for the same F_lambda
+    sens = sensfunc()
+    fine = np.linspace(4000., 8000., 2001)
+    coarse = fine[::2]
+    assert np.allclose(flux_calib.sens_factor(coarse, *sens), flux_calib.sens_factor(fine, *sens)[::2]/2., rtol=1e-6)
+
+
+def test_sens_factor_out_of_range():
+    with pytest.raises(ValueError, match='beyond the sensitivity function'):
+        flux_calib.sens_factor(np.linspace(2500., 9000., 1024), *sensfunc())
+    # masked pixels are not checked
+    wave = np.linspace(3500., 9000., 1024)
+    wave[:5] = 0.
+    assert np.all(flux_calib.sens_factor(wave, *sensfunc())[:5] == 0.)
+
+
+def test_sens_factor_matches_pypeit():
+    pypeit_flux_calib = pytest.importorskip('pypeit.flux_calib')
+    wave = np.geomspace(3500., 9000., 2048)
+    wave[-20:] = 0.
+    sens = sensfunc()
+    expected = pypeit_flux_calib.get_sensfunc_factor(wave, *sens, EXPTIME)
+    assert np.allclose(flux_calib.sens_factor(wave, *sens)/EXPTIME, expected, rtol=1e-6, atol=0.)
+
+
+@pytest.mark.skipif(not (os.environ.get('PYPEIT_FLUXED_SPEC1D') and os.environ.get('PYPEIT_SENSFUNC')),
+                    reason='PYPEIT_FLUXED_SPEC1D and PYPEIT_SENSFUNC not set')
+def test_flux_calibrate_matches_pypeit(tmp_path):
+    pytest.importorskip('pypeit')
+    fname = str(tmp_path/'spec1d.fits')
+    shutil.copy(os.environ['PYPEIT_FLUXED_SPEC1D'], fname)
+    flux_calib.flux_calibrate(fname, os.environ['PYPEIT_SENSFUNC'])
+
+    with fits.open(os.environ['PYPEIT_FLUXED_SPEC1D']) as expected, fits.open(fname) as result:
+        for hdu in expected[1:]:
+            if not isinstance(hdu, fits.BinTableHDU) or 'OPT_FLAM' not in hdu.columns.names:
+                continue
+            for column in ('OPT_FLAM', 'OPT_FLAM_IVAR', 'BOX_FLAM', 'BOX_FLAM_IVAR'):
+                if column in hdu.columns.names:
+                    assert np.allclose(result[hdu.name].data[column], hdu.data[column], rtol=1e-5, atol=0.), column
@@ -0,0 +1,55 @@
+import glob
+import os
+
+import astropy.io.fits as fits
+import numpy as np
+import pytest
+
+import sens_index
+import synthetic_night
+
+
+def write_sens(fname, mjd, grism, slit='Slit_1.0'):
+    hdr = fits.Header()
+    hdr['MJD'] = mjd
+    hdr['DISPNAME'] = grism
+    hdr['DECKER'] = slit
+    hdr['TARGET'] = 'SP0000'
+    hdr['AIRMASS'] = 1.2
+    wave = np.linspace(3000., 10000., 100)
+    cols = [fits.Column(name='SENS_WAVE', format='100D', array=wave[None]),
+            fits.Column(name='SENS_ZEROPOINT', format='100D', array=np.full((1, 100), 18.))]
+    fits.HDUList([fits.PrimaryHDU(header=hdr), fits.BinTableHDU.from_columns(cols)]).writeto(fname)
+
+
+@pytest.fixture
+def sens_dir(tmp_path, monkeypatch):
+    # the standards are looked up in sci/ of the working directory
+    monkeypatch.chdir(tmp_path)
+    os.makedirs('sens')
+    write_sens('sens/59031.9000.fits', 59031.9, 'Grism_#4')
+    write_sens('sens/59031.1000.fits', 59031.1, 'Grism_#7')
+    return 'sens'
+
+
+def test_match_same_grism(sens_dir):
+    index = sens_index.SensIndex(sens_dir)
+    # the Grism_#4 sensfunc is closer in time, but the grism decides
+    assert index.match([59031.85, 59031.85], ['Grism_7', 'Grism_#4']) == ['sens/59031.1000.fits', 'sens/59031.9000.fits']
+
+
+def test_match_unknown_grism(sens_dir):
+    index = sens_index.SensIndex(sens_dir)
+    with pytest.raises(ValueError, match='No sensitivity function for grism'):
+        index.lookup(59031.85, 'Grism_18')
+    assert index.lookup(59031.85, 'Grism_18', allow_any_grism=True) == 'sens/59031.9000.fits'
+
+
+def test_synthetic_night_has_standard_per_grism(tmp_path):
+    # the benchmark fluxes every target with a sensfunc of its own grism
+    synthetic_night.make_night(str(tmp_path), '2020-07-01', n_frames=100, frame_size=4)
+    headers = [fits.getheader(f) for f in glob.glob(str(tmp_path / 'raw' / '2020-07-01' / '*.fits'))]
+    science = {h['ALGRNM'] for h in headers if h['IMAGETYP'] == 'OBJECT'}
+    standards = [h['ALGRNM'] for h in headers if h['IMAGETYP'] == 'STD']
+    assert len(science) > 1
+    assert sorted(standards) == sorted(set(standards)) == sorted(science)